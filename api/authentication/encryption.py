@@ -9,12 +9,34 @@ from ..users.models import User
 from jose import JWTError, jwt
 
 from ..users.functions import get_all_user_data_by_email_or_name
+from ..utility.cache import TTLCache
+from ..utility.executors import BoundedExecutor, ExecutorQueueFullError
+from ..utility.metrics import register_metrics
 
 SECRET_KEY = os.getenv('HASHING_KEY')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10_000))
+USER_CACHE_TTL_SECONDS = float(os.getenv('USER_CACHE_TTL_SECONDS', 60))
+
+# The users that sent a valid token recently, by token subject (the email), so we don't query the
+# database on every authenticated request. The user routes invalidate the entry when they change the user.
+authenticated_users_cache = TTLCache(max_size=USER_CACHE_SIZE, ttl_seconds=USER_CACHE_TTL_SECONDS)
+
+# bcrypt takes ~100-300 ms of CPU per call, so it runs in a pool instead of on the event loop.
+# bcrypt releases the GIL, so threads already use all the cores; 'process' is available as well.
+password_hashing_executor = BoundedExecutor(
+    name='password-hashing',
+    kind=os.getenv('PASSWORD_HASHING_EXECUTOR', 'thread'),
+    max_workers=int(os.getenv('PASSWORD_HASHING_WORKERS', os.cpu_count() or 1)),
+    max_queue=int(os.getenv('PASSWORD_HASHING_MAX_QUEUE', 100)),
+)
+
+register_metrics('authenticated_users_cache', authenticated_users_cache.stats)
+register_metrics('password_hashing_executor', password_hashing_executor.stats)
+
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/v1/login")
 
@@ -28,16 +50,35 @@ class TokenData(BaseModel):
     username: str | None = None
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+hashing_queue_full_exception = HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many logins at the same time, try again in a few seconds.",
+        headers={"Retry-After": "1"},
+    )
+
+
+def _verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def _get_password_hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
     """
     Verifies if the password gives is correct.
 
     :param plain_password: The plain password received from the user
     :param hashed_password: The hashed password stored in the db
     :return: True if the password is current.
+    :raises HTTPException if too many passwords are waiting to be verified.
     """
 
-    return pwd_context.verify(plain_password, hashed_password)
+    try:
+        return await password_hashing_executor.run(_verify_password, plain_password, hashed_password)
+    except ExecutorQueueFullError:
+        raise hashing_queue_full_exception
 
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
@@ -55,8 +96,17 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password: str) -> str:
+    """
+    Hashes the password with bcrypt, in the password hashing pool.
+
+    :raises HTTPException if too many passwords are waiting to be hashed.
+    """
+
+    try:
+        return await password_hashing_executor.run(_get_password_hash, password)
+    except ExecutorQueueFullError:
+        raise hashing_queue_full_exception
 
 
 credentials_exception = HTTPException(
@@ -80,9 +130,22 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     except JWTError:
         raise credentials_exception
 
-    user = get_all_user_data_by_email_or_name(email=token_data.username)
+    user = authenticated_users_cache.get(token_data.username)
 
-    if not user:
-        raise credentials_exception
+    if user is None:
+        # A user updated or deleted while it's read isn't cached with its old data
+        generation = authenticated_users_cache.generation
+        user = await get_all_user_data_by_email_or_name(email=token_data.username)
+
+        if not user:
+            raise credentials_exception
+
+        authenticated_users_cache.set(token_data.username, user, generation)
+
+    return User(**user)
+
+
+def invalidate_cached_user(email: str) -> None:
+    """Removes the user from the authenticated users cache, after their data was modified or deleted."""
 
-    return User(**user)
\ No newline at end of file
+    authenticated_users_cache.invalidate(email)
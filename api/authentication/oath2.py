@@ -23,7 +23,7 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     email = form_data.username
     password = form_data.password
 
-    user = authenticate_user(email, password)
+    user = await authenticate_user(email, password)
 
     if not user:
         raise HTTPException(
@@ -39,13 +39,13 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     return {"access_token": access_token, "token_type": "bearer", "user_id": user['id']}
 
 
-def authenticate_user(email: str, password: str):
-    user = get_all_user_data_by_email_or_name(email=email)
+async def authenticate_user(email: str, password: str):
+    user = await get_all_user_data_by_email_or_name(email=email)
 
     if not user:
         return False
 
-    if not verify_password(password, user['password']):
+    if not await verify_password(password, user['password']):
         return False
 
     return user
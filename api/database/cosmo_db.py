@@ -1,41 +1,509 @@
+import json
 import os
-import azure
+import time
 
+import azure.cosmos.exceptions
+from azure.core import MatchConditions
 from dotenv import load_dotenv
-from azure.cosmos import CosmosClient, PartitionKey
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import CosmosClient, ContainerProxy, DatabaseProxy
+
+from .exceptions import ItemNotFoundError, ItemAlreadyExistsError, ItemModifiedError, InvalidContinuationTokenError, \
+    TooManyRequestsError
+from .repositories import Repository, UsersRepository, UserLookupsRepository, FormsRepository, \
+    FormPartitionedRepository, SubmissionsRepository, SubmissionsSearchRepository, JobsRepository, \
+    SubmissionsFilter, Page, current_request_charge_counter, encode_continuation_token, decode_continuation_token
 
 load_dotenv()
 
 DATABASE_NAME = "Assist-Tech-Challenge-DB"
 USERS_CONTAINER_NAME = "users-container"
 FORMS_CONTAINER_NAME = "forms-container"
-SUBMITTED_FORMS_CONTAINER_NAME = "form-submits-container"
+SUBMITTED_FORMS_CONTAINER_NAME = "form-submits-by-form-container"
+USER_LOOKUPS_CONTAINER_NAME = "users-lookup-container"
+SUBMISSIONS_SEARCH_CONTAINER_NAME = "form-submits-search-by-form-container"
+JOBS_CONTAINER_NAME = "jobs-container"
+
+# The submissions were first stored partitioned by their id, they are moved to SUBMITTED_FORMS_CONTAINER_NAME
+# with "python -m background_tasks.migrate_submissions_to_form_partitions"
+LEGACY_SUBMITTED_FORMS_CONTAINER_NAME = "form-submits-container"
 
 COSMOS_ENDPOINT = os.getenv('COSMOS_ENDPOINT')
 COSMOS_KEY = os.getenv('COSMOS_KEY')
 
-client = CosmosClient(url=COSMOS_ENDPOINT, credential=COSMOS_KEY)
-
-# Connect to the db
-database = client.create_database_if_not_exists(id=DATABASE_NAME)
-
+# While the submissions are moved, the ones that weren't moved yet are read from the legacy container.
+# Set it to false when the migration is done.
+READ_LEGACY_SUBMISSIONS = os.getenv('READ_LEGACY_SUBMISSIONS', 'true').lower() == 'true'
 
 # Create a new container for each "category" like users, forms, docs, etc
 user_key = PartitionKey(path="/id")
-users_container: azure.cosmos.container.ContainerProxy = database.create_container_if_not_exists(
-    id=USERS_CONTAINER_NAME, partition_key=user_key, offer_throughput=400
-)
-
+user_lookup_key = PartitionKey(path="/id")
 form_key_path = PartitionKey(path="/id")
-forms_container: azure.cosmos.container.ContainerProxy  = database.create_container_if_not_exists(
-    id=FORMS_CONTAINER_NAME, partition_key=form_key_path, offer_throughput=400
-)
+form_submits_key_path = PartitionKey(path="/form_id")
+form_submits_search_key_path = PartitionKey(path="/form_id")
+job_key_path = PartitionKey(path="/id")
+
+# The client is created the first time it's needed, so importing the app doesn't require a Cosmos account
+_client: CosmosClient | None = None
+
+
+def get_client() -> CosmosClient:
+    """
+    Returns the async Cosmos client.
+    It shares one aiohttp session, so all the requests handled by a worker can have their Cosmos calls
+    in flight at the same time without blocking the event loop.
+    """
+
+    global _client
+
+    if _client is None:
+        _client = CosmosClient(url=COSMOS_ENDPOINT, credential=COSMOS_KEY)
+
+    return _client
+
+
+def get_container(container_name: str) -> ContainerProxy:
+    return get_client().get_database_client(DATABASE_NAME).get_container_client(container_name)
+
+
+async def create_database_and_containers():
+    """
+    Creates the database and the containers if they don't exist yet.
+    The async client can't do network calls at import time, so this is awaited when the app starts.
+    """
+
+    created_database = await get_client().create_database_if_not_exists(id=DATABASE_NAME)
+
+    await created_database.create_container_if_not_exists(
+        id=USERS_CONTAINER_NAME, partition_key=user_key, offer_throughput=400
+    )
+
+    await created_database.create_container_if_not_exists(
+        id=USER_LOOKUPS_CONTAINER_NAME, partition_key=user_lookup_key, offer_throughput=400
+    )
+
+    await created_database.create_container_if_not_exists(
+        id=FORMS_CONTAINER_NAME, partition_key=form_key_path, offer_throughput=400
+    )
+
+    # default_ttl=-1 lets Cosmos delete every item when its own 'ttl' passes, the items without 'ttl' are kept
+    await create_container_with_ttl(created_database, SUBMITTED_FORMS_CONTAINER_NAME, form_submits_key_path)
+
+    if READ_LEGACY_SUBMISSIONS:
+        await created_database.create_container_if_not_exists(
+            id=LEGACY_SUBMITTED_FORMS_CONTAINER_NAME, partition_key=form_key_path, offer_throughput=400
+        )
+
+    await create_container_with_ttl(created_database, SUBMISSIONS_SEARCH_CONTAINER_NAME, form_submits_search_key_path)
+
+    # The finished jobs have a ttl
+    await create_container_with_ttl(created_database, JOBS_CONTAINER_NAME, job_key_path)
+
+
+async def create_container_with_ttl(database: DatabaseProxy, container_name: str, partition_key: PartitionKey):
+    """Creates the container with the time to live enabled, or enables it if the container was created without it."""
+
+    container = await database.create_container_if_not_exists(
+        id=container_name, partition_key=partition_key, default_ttl=-1, offer_throughput=400
+    )
+
+    properties = await container.read()
+
+    if 'defaultTtl' not in properties:
+        await database.replace_container(container, partition_key=partition_key, default_ttl=-1)
+
+
+async def close_client():
+    """Closes the connection pool of the Cosmos client, when the app shuts down."""
+
+    global _client
+
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+# The names DateTimePart uses for the parts of a date
+cosmos_date_parts = {'year': 'yyyy', 'month': 'mm', 'day': 'dd', 'hour': 'hh'}
+
+
+def with_expiration_ttl(item: dict) -> dict:
+    """
+    Sets the 'ttl' of the item to the seconds left until its submission_expiration_time.
+    Cosmos counts the ttl from the last write of the item, so it's set again on every write.
+    """
+
+    seconds_left = int(item['submission_expiration_time'] - time.time())
+
+    # The ttl must be a positive number, an item that already expired is deleted a second after it's written
+    return {**item, 'ttl': max(seconds_left, 1)}
+
+
+class CosmosRepository(Repository):
+    """Point reads and writes on a container partitioned by '/id'."""
+
+    def __init__(self, container_name: str):
+        self.container_name = container_name
+        self.request_charge = 0.0
+
+    @property
+    def container(self) -> ContainerProxy:
+        return get_container(self.container_name)
+
+    def add_request_charge(self, headers: dict | None = None, *_) -> None:
+        """
+        Adds the request units of the last response, it's also the response_hook of the point operations.
+        It must be called right after the response, before awaiting anything else.
+        """
+
+        if headers is None:
+            headers = get_client().client_connection.last_response_headers
+
+        request_charge = float(headers.get('x-ms-request-charge', 0))
+        self.request_charge += request_charge
+
+        counter = current_request_charge_counter.get()
+
+        if counter is not None:
+            counter.total += request_charge
+
+    async def get(self, item_id: str, partition_key: str | None = None) -> dict:
+        try:
+            return await self.container.read_item(item=item_id, partition_key=partition_key or item_id,
+                                                  response_hook=self.add_request_charge)
+        except azure.cosmos.exceptions.CosmosResourceNotFoundError:
+            raise ItemNotFoundError(item_id)
+
+    async def create(self, item: dict) -> dict:
+        try:
+            return await self.container.create_item(item, response_hook=self.add_request_charge)
+        except azure.cosmos.exceptions.CosmosResourceExistsError:
+            raise ItemAlreadyExistsError(item['id'])
+
+    async def upsert(self, item: dict) -> dict:
+        return await self.container.upsert_item(item, response_hook=self.add_request_charge)
+
+    async def replace(self, item: dict, etag: str) -> dict:
+        try:
+            return await self.container.replace_item(item=item['id'], body=item, etag=etag,
+                                                     match_condition=MatchConditions.IfNotModified,
+                                                     response_hook=self.add_request_charge)
+        except azure.cosmos.exceptions.CosmosResourceNotFoundError:
+            raise ItemNotFoundError(item['id'])
+        except azure.cosmos.exceptions.CosmosAccessConditionFailedError:
+            raise ItemModifiedError(item['id'])
+
+    async def delete(self, item_id: str, partition_key: str | None = None) -> None:
+        """
+        :raises TooManyRequestsError if the request was throttled more times than the client retries, the bulk
+        deletes wait and try again.
+        """
+
+        try:
+            await self.container.delete_item(item=item_id, partition_key=partition_key or item_id,
+                                             response_hook=self.add_request_charge)
+        except azure.cosmos.exceptions.CosmosResourceNotFoundError:
+            raise ItemNotFoundError(item_id)
+        except azure.cosmos.exceptions.CosmosHttpResponseError as e:
+            if e.status_code == 429:
+                retry_after_ms = (e.headers or {}).get('x-ms-retry-after-ms')
+                raise TooManyRequestsError(float(retry_after_ms) / 1000 if retry_after_ms else None)
+            raise
+
+    async def query(self, query: str, params: list[dict] | None = None, **kwargs) -> list[dict]:
+        results = self.container.query_items(query=query, parameters=params, **kwargs)
+        items = []
+
+        async for page in results.by_page():
+            self.add_request_charge()
+            items += [item async for item in page]
+
+        return items
+
+    async def query_page(self, query: str, params: list[dict] | None, page_size: int,
+                         continuation_token: str | None = None, **kwargs) -> Page:
+        """
+        Returns one page of the query results, using the continuation tokens of Cosmos.
+        Only one page is read, so the memory and RUs don't depend on how many results the query has.
+        """
+
+        results = self.container.query_items(query=query, parameters=params, max_item_count=page_size, **kwargs)
+        pages = results.by_page(decode_continuation_token(continuation_token))
+
+        try:
+            # Cross partition queries can return empty pages that still have a continuation
+            while True:
+                page = await pages.__anext__()
+                self.add_request_charge()
+                items = [item async for item in page]
+
+                if items or pages.continuation_token is None:
+                    break
+        except StopAsyncIteration:
+            return Page(items=[], continuation_token=None)
+        except azure.cosmos.exceptions.CosmosHttpResponseError as e:
+            if e.status_code == 400 and continuation_token is not None:
+                raise InvalidContinuationTokenError()
+            raise
+
+        return Page(items=items, continuation_token=encode_continuation_token(pages.continuation_token))
+
+
+class CosmosFormPartitionedRepository(CosmosRepository, FormPartitionedRepository):
+    """Point reads and writes on a container partitioned by '/form_id'."""
+
+    async def get(self, item_id: str, form_id: str) -> dict:
+        return await super().get(item_id, partition_key=form_id)
+
+    async def delete(self, item_id: str, form_id: str) -> None:
+        await super().delete(item_id, partition_key=form_id)
+
+
+class CosmosUsersRepository(CosmosRepository, UsersRepository):
+
+    def __init__(self):
+        super().__init__(USERS_CONTAINER_NAME)
+
+    async def list_all(self) -> list[dict]:
+        return [item async for item in self.container.read_all_items()]
+
+
+class CosmosUserLookupsRepository(CosmosRepository, UserLookupsRepository):
+
+    def __init__(self):
+        super().__init__(USER_LOOKUPS_CONTAINER_NAME)
+
+
+class CosmosFormsRepository(CosmosRepository, FormsRepository):
+
+    def __init__(self):
+        super().__init__(FORMS_CONTAINER_NAME)
+
+    async def list_short_by_owner(self, owner_id: str, page_size: int, continuation_token: str | None = None) -> Page:
+        query = """SELECT form.id, form.title
+                        FROM c form
+                        WHERE form.owner_id = @user_id"""
+
+        return await self.query_page(query, [dict(name="@user_id", value=owner_id)], page_size, continuation_token)
+
+
+class CosmosSubmissionsRepository(CosmosFormPartitionedRepository, SubmissionsRepository):
+    """
+    The submissions, partitioned by form_id, so the queries of a form read one partition.
+
+    While READ_LEGACY_SUBMISSIONS is true, the submissions that weren't moved yet are also read from the
+    legacy container: the point reads fall back to it, the queries read the new container and then the legacy one.
+    A submission is always written to the new container and removed from the legacy one, so it's only in one of them.
+    """
+
+    def __init__(self):
+        super().__init__(SUBMITTED_FORMS_CONTAINER_NAME)
+
+        self.legacy = None
+
+        if READ_LEGACY_SUBMISSIONS:
+            self.legacy = CosmosRepository(LEGACY_SUBMITTED_FORMS_CONTAINER_NAME)
+            # The request units used on the legacy container are counted with the ones of the submissions
+            self.legacy.add_request_charge = self.add_request_charge
+
+    async def create(self, item: dict) -> dict:
+        return await super().create(with_expiration_ttl(item))
+
+    async def get(self, item_id: str, form_id: str) -> dict:
+        try:
+            return await super().get(item_id, form_id)
+        except ItemNotFoundError:
+            if self.legacy is None:
+                raise
+
+        item = await self.legacy.get(item_id)
+
+        if item['form_id'] != form_id:
+            raise ItemNotFoundError(item_id)
+
+        return item
+
+    async def upsert(self, item: dict) -> dict:
+        item = await super().upsert(with_expiration_ttl(item))
+
+        # An update of a submission that wasn't moved yet moves it
+        await self._delete_legacy(item['id'])
+
+        return item
+
+    async def delete(self, item_id: str, form_id: str) -> None:
+        try:
+            await super().delete(item_id, form_id)
+        except ItemNotFoundError:
+            if self.legacy is None or not await self._delete_legacy(item_id):
+                raise
+        else:
+            # While it's moved, it can be in both containers for a moment
+            await self._delete_legacy(item_id)
+
+    async def _delete_legacy(self, item_id: str) -> bool:
+        """Returns True if the submission was in the legacy container."""
+
+        if self.legacy is None:
+            return False
+
+        try:
+            await self.legacy.delete(item_id)
+        except ItemNotFoundError:
+            return False
+
+        return True
+
+    async def query_form_page(self, form_id: str, query: str, params: list[dict], page_size: int,
+                              continuation_token: str | None = None) -> Page:
+        """
+        Returns one page of a query of the submissions of a form, the params must include @form_id.
+        With the legacy container, its results come after the ones of the new container and the continuation token
+        also holds the container it's for.
+        """
+
+        if self.legacy is None:
+            return await self.query_page(query, params, page_size, continuation_token, partition_key=form_id)
+
+        raw_token = decode_continuation_token(continuation_token)
+
+        try:
+            in_legacy, token = json.loads(raw_token) if raw_token is not None else (False, None)
+        except (ValueError, TypeError):
+            raise InvalidContinuationTokenError()
+
+        if in_legacy:
+            page = await self.legacy.query_page(query, params, page_size, token)
+        else:
+            page = await self.query_page(query, params, page_size, token, partition_key=form_id)
+
+        if page.continuation_token is not None:
+            next_token = [in_legacy, page.continuation_token]
+        elif not in_legacy:
+            next_token = [True, None]
+        else:
+            next_token = None
+
+        return Page(items=page.items,
+                    continuation_token=encode_continuation_token(next_token and json.dumps(next_token)))
+
+    async def query_form(self, form_id: str, query: str, params: list[dict]) -> list[dict]:
+        items = await self.query(query, params, partition_key=form_id)
+
+        if self.legacy is not None:
+            items += await self.legacy.query(query, params)
+
+        return items
+
+    async def list_page_by_form(self, form_id: str, page_size: int, continuation_token: str | None = None,
+                                descending: bool = False, filters: SubmissionsFilter = SubmissionsFilter()) -> Page:
+        conditions = ["submission.form_id = @form_id"]
+        params = [dict(name="@form_id", value=form_id)]
+
+        # The range uses the index on submission_creation_time
+        if filters.created_from is not None:
+            conditions.append("submission.submission_creation_time >= @created_from")
+            params.append(dict(name="@created_from", value=filters.created_from))
+
+        if filters.created_until is not None:
+            conditions.append("submission.submission_creation_time < @created_until")
+            params.append(dict(name="@created_until", value=filters.created_until))
+
+        for part, value in filters.created_parts.items():
+            conditions.append(f'DateTimePart("{cosmos_date_parts[part]}", '
+                              f'TimestampToDateTime(submission.submission_creation_time * 1000)) = @{part}')
+            params.append(dict(name=f"@{part}", value=value))
+
+        if filters.text:
+            if not filters.text_fields:
+                return Page(items=[], continuation_token=None)
+
+            # The field names are JSON strings, which are also valid Cosmos string literals
+            text_conditions = [f"CONTAINS(ToString(submission.completed_dynamic_fields[{json.dumps(field)}]), @text)"
+                               for field in filters.text_fields]
+            conditions.append("(" + " OR ".join(text_conditions) + ")")
+            params.append(dict(name="@text", value=filters.text))
+
+        query = f"""
+SELECT
+
+submission.id,
+submission.form_id,
+submission.completed_dynamic_fields,
+submission.user_that_completed_id,
+submission.submission_creation_time,
+submission.submission_expiration_time
+
+FROM c submission WHERE {" AND ".join(conditions)}
+ORDER BY submission.submission_expiration_time {"DESC" if descending else "ASC"}"""
+
+        return await self.query_form_page(form_id, query, params, page_size, continuation_token)
+
+    async def list_ids_by_form(self, form_id: str) -> list[str]:
+        query = """SELECT form.id FROM c form WHERE form.form_id = @form_id"""
+
+        items = await self.query_form(form_id, query, [dict(name="@form_id", value=form_id)])
+
+        # A submission that is being moved can be in both containers
+        return list(dict.fromkeys(item['id'] for item in items))
+
+    async def list_expiration_times(self) -> list[dict]:
+        query = """SELECT form.id, form.form_id, form.submission_expiration_time FROM c form"""
+
+        items = await self.query(query)
+
+        if self.legacy is not None:
+            items += await self.legacy.query(query)
+
+        return items
+
+    async def list_expired(self, expired_before: int, limit: int) -> list[dict]:
+        # Cosmos deletes the submissions with a ttl by itself, this finds the ones it didn't delete yet
+        # and the ones written before the ttl was set. The range uses the index on submission_expiration_time.
+        query = """SELECT TOP @limit submission.id, submission.form_id
+                        FROM c submission
+                        WHERE submission.submission_expiration_time <= @expired_before"""
+
+        params = [dict(name="@limit", value=limit), dict(name="@expired_before", value=expired_before)]
+        items = await self.query(query, params)
+
+        if self.legacy is not None and len(items) < limit:
+            params[0] = dict(name="@limit", value=limit - len(items))
+            items += await self.legacy.query(query, params)
+
+        return items
+
+
+class CosmosSubmissionsSearchRepository(CosmosFormPartitionedRepository, SubmissionsSearchRepository):
+
+    def __init__(self):
+        super().__init__(SUBMISSIONS_SEARCH_CONTAINER_NAME)
+
+    async def upsert(self, item: dict) -> dict:
+        # The index item expires with its submission
+        return await super().upsert(with_expiration_ttl(item))
+
+    async def search_page(self, form_id: str, terms: list[str], page_size: int,
+                          continuation_token: str | None = None) -> Page:
+        # ARRAY_CONTAINS on the terms is answered from the index, the submissions themselves aren't scanned
+        conditions = ["entry.form_id = @form_id"]
+        params = [dict(name="@form_id", value=form_id)]
+
+        for i, term in enumerate(terms):
+            conditions.append(f"ARRAY_CONTAINS(entry.terms, @term{i})")
+            params.append(dict(name=f"@term{i}", value=term))
+
+        query = f"""SELECT entry.id, entry.tokens FROM c entry WHERE {" AND ".join(conditions)}"""
+
+        return await self.query_page(query, params, page_size, continuation_token, partition_key=form_id)
 
-form_submits_key_path = PartitionKey(path="/id")
-form_submits_container: azure.cosmos.container.ContainerProxy  = database.create_container_if_not_exists(
-    id=SUBMITTED_FORMS_CONTAINER_NAME, partition_key=form_key_path, offer_throughput=400
-)
 
+class CosmosJobsRepository(CosmosRepository, JobsRepository):
 
+    def __init__(self):
+        super().__init__(JOBS_CONTAINER_NAME)
 
+    async def list_unfinished(self) -> list[dict]:
+        query = """SELECT * FROM c job WHERE job.status IN ('queued', 'running')"""
 
+        return await self.query(query)
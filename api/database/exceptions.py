@@ -0,0 +1,37 @@
+class ItemNotFoundError(Exception):
+    """Raised by the storage backends when an item with the given id does not exist."""
+
+    def __init__(self, item_id: str):
+        super().__init__(f"Item '{item_id}' does not exist.")
+        self.item_id = item_id
+
+
+class ItemAlreadyExistsError(Exception):
+    """Raised by the storage backends when creating an item with an id that is already used."""
+
+    def __init__(self, item_id: str):
+        super().__init__(f"Item '{item_id}' already exists.")
+        self.item_id = item_id
+
+
+class ItemModifiedError(Exception):
+    """Raised by the storage backends when a conditional write finds that the item changed since it was read."""
+
+    def __init__(self, item_id: str):
+        super().__init__(f"Item '{item_id}' was modified.")
+        self.item_id = item_id
+
+
+class InvalidContinuationTokenError(Exception):
+    """Raised when a continuation token can't be decoded or doesn't belong to the query."""
+
+    def __init__(self):
+        super().__init__("The continuation token is invalid.")
+
+
+class TooManyRequestsError(Exception):
+    """Raised when the database is throttling the requests, after the retries of the database client."""
+
+    def __init__(self, retry_after_seconds: float | None = None):
+        super().__init__("The database received too many requests.")
+        self.retry_after_seconds = retry_after_seconds
@@ -0,0 +1,368 @@
+"""
+Local stand-ins for the Cosmos DB containers, used to run the API, the tests and the load tests without network.
+
+The items are stored in memory or in a SQLite file. Like in Cosmos, every write sets a new '_etag' and '_ts'
+on the stored item.
+"""
+import asyncio
+import copy
+import datetime
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+from .cosmo_db import USERS_CONTAINER_NAME, USER_LOOKUPS_CONTAINER_NAME, FORMS_CONTAINER_NAME, \
+    SUBMITTED_FORMS_CONTAINER_NAME, SUBMISSIONS_SEARCH_CONTAINER_NAME, JOBS_CONTAINER_NAME
+from .exceptions import ItemNotFoundError, ItemAlreadyExistsError, ItemModifiedError, InvalidContinuationTokenError
+from .repositories import Repository, FormPartitionedRepository, UsersRepository, UserLookupsRepository, \
+    FormsRepository, SubmissionsRepository, SubmissionsSearchRepository, JobsRepository, SubmissionsFilter, Page, \
+    encode_continuation_token, decode_continuation_token
+
+
+def _with_system_properties(item: dict) -> dict:
+    item = copy.deepcopy(item)
+    item['_etag'] = f'"{uuid.uuid4()}"'
+    item['_ts'] = int(time.time())
+
+    return item
+
+
+class LocalContainer(ABC):
+    """A collection of items with a unique 'id'."""
+
+    @abstractmethod
+    async def read(self, item_id: str) -> dict:
+        """
+        :raises ItemNotFoundError if the item doesn't exist.
+        """
+
+    @abstractmethod
+    async def write(self, item: dict, overwrite: bool) -> dict:
+        """
+        :raises ItemAlreadyExistsError if the item exists and overwrite is False.
+        """
+
+    @abstractmethod
+    async def replace(self, item: dict, etag: str) -> dict:
+        """
+        Writes the item only if the stored one still has the given '_etag'.
+
+        :raises ItemNotFoundError if the item doesn't exist.
+        :raises ItemModifiedError if the stored item has another '_etag'.
+        """
+
+    @abstractmethod
+    async def remove(self, item_id: str) -> None:
+        """
+        :raises ItemNotFoundError if the item doesn't exist.
+        """
+
+    @abstractmethod
+    async def find(self, match_any: bool = False, offset: int = 0, limit: int | None = None, **equals) -> list[dict]:
+        """
+        Returns the items whose top level fields are equal to the given values, in the order they were added.
+        By default, all the values must match, with match_any=True only one of them.
+        Without any values, it returns all the items.
+        offset and limit select a slice of the results.
+        """
+
+
+class MemoryContainer(LocalContainer):
+
+    def __init__(self):
+        self.items: dict[str, dict] = {}
+
+    async def read(self, item_id: str) -> dict:
+        if item_id not in self.items:
+            raise ItemNotFoundError(item_id)
+
+        return copy.deepcopy(self.items[item_id])
+
+    async def write(self, item: dict, overwrite: bool) -> dict:
+        if not overwrite and item['id'] in self.items:
+            raise ItemAlreadyExistsError(item['id'])
+
+        self.items[item['id']] = _with_system_properties(item)
+
+        return copy.deepcopy(self.items[item['id']])
+
+    async def replace(self, item: dict, etag: str) -> dict:
+        if item['id'] not in self.items:
+            raise ItemNotFoundError(item['id'])
+
+        if self.items[item['id']].get('_etag') != etag:
+            raise ItemModifiedError(item['id'])
+
+        self.items[item['id']] = _with_system_properties(item)
+
+        return copy.deepcopy(self.items[item['id']])
+
+    async def remove(self, item_id: str) -> None:
+        if self.items.pop(item_id, None) is None:
+            raise ItemNotFoundError(item_id)
+
+    async def find(self, match_any: bool = False, offset: int = 0, limit: int | None = None, **equals) -> list[dict]:
+        check = any if match_any else all
+
+        items = [item for item in self.items.values()
+                 if not equals or check(item.get(field) == value for field, value in equals.items())]
+
+        end = None if limit is None else offset + limit
+
+        return [copy.deepcopy(item) for item in items[offset:end]]
+
+
+class SQLiteContainer(LocalContainer):
+    """
+    Stores the items as JSON in a table of a SQLite database.
+    The queries run in a worker thread, so they don't block the event loop.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, lock: threading.Lock, table_name: str):
+        self.connection = connection
+        self.lock = lock
+        self.table_name = table_name
+
+        with self.lock:
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{self.table_name}" (id TEXT PRIMARY KEY, body TEXT NOT NULL)'
+            )
+            self.connection.commit()
+
+    def _execute(self, sql: str, params: tuple = ()) -> list[tuple]:
+        with self.lock:
+            cursor = self.connection.execute(sql, params)
+            rows = cursor.fetchall()
+            self.connection.commit()
+
+        return rows
+
+    async def _run(self, sql: str, params: tuple = ()) -> list[tuple]:
+        return await asyncio.to_thread(self._execute, sql, params)
+
+    async def read(self, item_id: str) -> dict:
+        rows = await self._run(f'SELECT body FROM "{self.table_name}" WHERE id = ?', (item_id,))
+
+        if not rows:
+            raise ItemNotFoundError(item_id)
+
+        return json.loads(rows[0][0])
+
+    async def write(self, item: dict, overwrite: bool) -> dict:
+        item = _with_system_properties(item)
+        verb = 'INSERT OR REPLACE' if overwrite else 'INSERT'
+
+        try:
+            await self._run(f'{verb} INTO "{self.table_name}" (id, body) VALUES (?, ?)',
+                            (item['id'], json.dumps(item)))
+        except sqlite3.IntegrityError:
+            raise ItemAlreadyExistsError(item['id'])
+
+        return item
+
+    async def replace(self, item: dict, etag: str) -> dict:
+        item = _with_system_properties(item)
+
+        rows = await self._run(f'UPDATE "{self.table_name}" SET body = ? '
+                               f"WHERE id = ? AND json_extract(body, '$._etag') = ? RETURNING id",
+                               (json.dumps(item), item['id'], etag))
+
+        if not rows:
+            # Tells a missing item from a modified one
+            await self.read(item['id'])
+            raise ItemModifiedError(item['id'])
+
+        return item
+
+    async def remove(self, item_id: str) -> None:
+        rows = await self._run(f'DELETE FROM "{self.table_name}" WHERE id = ? RETURNING id', (item_id,))
+
+        if not rows:
+            raise ItemNotFoundError(item_id)
+
+    async def find(self, match_any: bool = False, offset: int = 0, limit: int | None = None, **equals) -> list[dict]:
+        sql = f'SELECT body FROM "{self.table_name}"'
+
+        if equals:
+            conditions = [f"json_extract(body, '$.{field}') = ?" for field in equals]
+            sql += ' WHERE ' + (' OR ' if match_any else ' AND ').join(conditions)
+
+        sql += ' ORDER BY rowid LIMIT ? OFFSET ?'
+
+        rows = await self._run(sql, (*equals.values(), -1 if limit is None else limit, offset))
+
+        return [json.loads(row[0]) for row in rows]
+
+
+class LocalRepository(Repository):
+
+    def __init__(self, container: LocalContainer):
+        self.container = container
+
+    async def get(self, item_id: str) -> dict:
+        return await self.container.read(item_id)
+
+    async def create(self, item: dict) -> dict:
+        return await self.container.write(item, overwrite=False)
+
+    async def upsert(self, item: dict) -> dict:
+        return await self.container.write(item, overwrite=True)
+
+    async def replace(self, item: dict, etag: str) -> dict:
+        return await self.container.replace(item, etag)
+
+    async def delete(self, item_id: str) -> None:
+        await self.container.remove(item_id)
+
+    async def find_page(self, page_size: int, continuation_token: str | None = None, **equals) -> Page:
+        """Returns one page of the items matching the values. The continuation token holds the offset."""
+
+        offset = get_offset(continuation_token)
+
+        # Read one more item, to know if there is a next page
+        items = await self.container.find(offset=offset, limit=page_size + 1, **equals)
+
+        return get_page(items, offset, page_size)
+
+
+class LocalFormPartitionedRepository(LocalRepository, FormPartitionedRepository):
+    """The local containers aren't partitioned, the form_id is only checked."""
+
+    async def get(self, item_id: str, form_id: str) -> dict:
+        item = await self.container.read(item_id)
+
+        if item['form_id'] != form_id:
+            raise ItemNotFoundError(item_id)
+
+        return item
+
+    async def delete(self, item_id: str, form_id: str) -> None:
+        await self.get(item_id, form_id)
+        await self.container.remove(item_id)
+
+
+def get_offset(continuation_token: str | None) -> int:
+    raw_token = decode_continuation_token(continuation_token)
+
+    if raw_token is not None and not raw_token.isdigit():
+        raise InvalidContinuationTokenError()
+
+    return int(raw_token or 0)
+
+
+def get_page(items: list[dict], offset: int, page_size: int) -> Page:
+    """Makes a page from the items starting at the offset, with one item more than the page if there is a next page."""
+
+    if len(items) <= page_size:
+        return Page(items=items, continuation_token=None)
+
+    return Page(items=items[:page_size], continuation_token=encode_continuation_token(str(offset + page_size)))
+
+
+def matches_submissions_filter(submission: dict, filters: SubmissionsFilter) -> bool:
+    created_at = submission['submission_creation_time']
+
+    if filters.created_from is not None and created_at < filters.created_from:
+        return False
+
+    if filters.created_until is not None and created_at >= filters.created_until:
+        return False
+
+    if filters.created_parts:
+        created_at = datetime.datetime.fromtimestamp(created_at, tz=datetime.timezone.utc)
+
+        if any(getattr(created_at, part) != value for part, value in filters.created_parts.items()):
+            return False
+
+    if filters.text:
+        values = submission['completed_dynamic_fields']
+
+        return any(field in values and filters.text in str(values[field]) for field in filters.text_fields)
+
+    return True
+
+
+class LocalUsersRepository(LocalRepository, UsersRepository):
+
+    async def list_all(self) -> list[dict]:
+        return await self.container.find()
+
+
+class LocalUserLookupsRepository(LocalRepository, UserLookupsRepository):
+    pass
+
+
+class LocalFormsRepository(LocalRepository, FormsRepository):
+
+    async def list_short_by_owner(self, owner_id: str, page_size: int, continuation_token: str | None = None) -> Page:
+        page = await self.find_page(page_size, continuation_token, owner_id=owner_id)
+
+        return Page(items=[dict(id=item['id'], title=item['title']) for item in page.items],
+                    continuation_token=page.continuation_token)
+
+
+class LocalSubmissionsRepository(LocalFormPartitionedRepository, SubmissionsRepository):
+
+    async def list_page_by_form(self, form_id: str, page_size: int, continuation_token: str | None = None,
+                                descending: bool = False, filters: SubmissionsFilter = SubmissionsFilter()) -> Page:
+        # The local stand-in filters and sorts in Python, it's only meant for small data sets
+        offset = get_offset(continuation_token)
+
+        items = [item for item in await self.container.find(form_id=form_id)
+                 if matches_submissions_filter(item, filters)]
+        items.sort(key=lambda item: item['submission_expiration_time'], reverse=descending)
+
+        return get_page(items[offset:offset + page_size + 1], offset, page_size)
+
+    async def list_ids_by_form(self, form_id: str) -> list[str]:
+        return [item['id'] for item in await self.container.find(form_id=form_id)]
+
+    async def list_expiration_times(self) -> list[dict]:
+        items = await self.container.find()
+
+        return [dict(id=item['id'], form_id=item['form_id'],
+                     submission_expiration_time=item['submission_expiration_time'])
+                for item in items]
+
+    async def list_expired(self, expired_before: int, limit: int) -> list[dict]:
+        items = [dict(id=item['id'], form_id=item['form_id']) for item in await self.container.find()
+                 if item['submission_expiration_time'] <= expired_before]
+
+        return items[:limit]
+
+
+class LocalSubmissionsSearchRepository(LocalFormPartitionedRepository, SubmissionsSearchRepository):
+
+    async def search_page(self, form_id: str, terms: list[str], page_size: int,
+                          continuation_token: str | None = None) -> Page:
+        offset = get_offset(continuation_token)
+
+        items = [dict(id=item['id'], tokens=item['tokens']) for item in await self.container.find(form_id=form_id)
+                 if all(term in item['terms'] for term in terms)]
+
+        return get_page(items[offset:offset + page_size + 1], offset, page_size)
+
+
+class LocalJobsRepository(LocalRepository, JobsRepository):
+
+    async def list_unfinished(self) -> list[dict]:
+        return await self.container.find(status='queued') + await self.container.find(status='running')
+
+
+container_names = (USERS_CONTAINER_NAME, USER_LOOKUPS_CONTAINER_NAME, FORMS_CONTAINER_NAME,
+                   SUBMITTED_FORMS_CONTAINER_NAME, SUBMISSIONS_SEARCH_CONTAINER_NAME, JOBS_CONTAINER_NAME)
+
+
+def create_memory_containers() -> dict[str, LocalContainer]:
+    return {container_name: MemoryContainer() for container_name in container_names}
+
+
+def create_sqlite_containers(database_path: str) -> dict[str, LocalContainer]:
+    # One connection shared by the worker threads, the lock makes sure only one uses it at a time
+    connection = sqlite3.connect(database_path, check_same_thread=False)
+    lock = threading.Lock()
+
+    return {container_name: SQLiteContainer(connection, lock, container_name) for container_name in container_names}
@@ -0,0 +1,229 @@
+"""
+The operations the API needs from the storage layer.
+
+Every backend (Cosmos DB, in memory, SQLite) implements these interfaces, so the routers and the
+functions don't depend on where the data is stored.
+Items are plain dictionaries, the same way they are stored in the database.
+"""
+import base64
+import binascii
+from abc import ABC, abstractmethod
+from contextvars import ContextVar
+from typing import NamedTuple
+
+from .exceptions import InvalidContinuationTokenError
+
+
+class Page(NamedTuple):
+    """A page of query results. continuation_token is None when there are no more results."""
+    items: list[dict]
+    continuation_token: str | None
+
+
+class SubmissionsFilter(NamedTuple):
+    """
+    Conditions for listing the submissions of a form.
+
+    created_from and created_until (exclusive) are a range of submission_creation_time.
+    created_parts are the parts of the UTC creation date that can't be expressed as a range, for example
+    {'hour': 12} for the submissions created between 12:00 and 13:00 on any day. The keys can be
+    'year', 'month', 'day' and 'hour'.
+    If text is given, one of text_fields of completed_dynamic_fields must contain it.
+    """
+    created_from: int | None = None
+    created_until: int | None = None
+    created_parts: dict[str, int] = {}
+    text: str = ''
+    text_fields: tuple[str, ...] = ()
+
+
+def encode_continuation_token(raw_token: str | None) -> str | None:
+    """Makes the token of a backend opaque and safe to put in an URL."""
+
+    if raw_token is None:
+        return None
+
+    return base64.urlsafe_b64encode(raw_token.encode()).decode()
+
+
+def decode_continuation_token(token: str | None) -> str | None:
+    """
+    :raises InvalidContinuationTokenError if the token wasn't made by encode_continuation_token.
+    """
+
+    if token is None:
+        return None
+
+    try:
+        return base64.urlsafe_b64decode(token.encode()).decode()
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidContinuationTokenError()
+
+
+class RequestChargeCounter:
+    """
+    Counts the request units of the operations made by the current task and by the tasks it starts, without the ones
+    of the other requests the server handles at the same time. Only the Cosmos backend counts them.
+
+    Example:
+        with RequestChargeCounter() as counter:
+            await sweep_expired_form_submissions()
+
+        print(counter.total)
+    """
+
+    def __init__(self):
+        self.total = 0.0
+        self._token = None
+
+    def __enter__(self) -> 'RequestChargeCounter':
+        self._token = current_request_charge_counter.set(self)
+        return self
+
+    def __exit__(self, *_):
+        current_request_charge_counter.reset(self._token)
+
+
+# The tasks copy the context when they are created, so they share the counter of the task that started them
+current_request_charge_counter: ContextVar[RequestChargeCounter | None] = ContextVar('current_request_charge_counter',
+                                                                                      default=None)
+
+
+class Repository(ABC):
+    """The point reads and writes shared by all the containers. The id of the item is also its partition key."""
+
+    # The request units used by the operations of the repository, only the Cosmos backend counts them
+    request_charge: float = 0.0
+
+    @abstractmethod
+    async def get(self, item_id: str) -> dict:
+        """
+        :raises ItemNotFoundError if the item doesn't exist.
+        """
+
+    @abstractmethod
+    async def create(self, item: dict) -> dict:
+        """
+        :raises ItemAlreadyExistsError if an item with the same id exists.
+        """
+
+    @abstractmethod
+    async def upsert(self, item: dict) -> dict:
+        pass
+
+    @abstractmethod
+    async def replace(self, item: dict, etag: str) -> dict:
+        """
+        Replaces the item only if its '_etag' is still the given one, so a change made since it was read isn't lost.
+
+        :raises ItemNotFoundError if the item doesn't exist.
+        :raises ItemModifiedError if the item was written since it was read.
+        """
+
+    @abstractmethod
+    async def delete(self, item_id: str) -> None:
+        """
+        :raises ItemNotFoundError if the item doesn't exist.
+        """
+
+
+class UsersRepository(Repository, ABC):
+
+    @abstractmethod
+    async def list_all(self) -> list[dict]:
+        """Returns all the users. Only used by maintenance commands."""
+
+
+class UserLookupsRepository(Repository, ABC):
+    """
+    Maps an email or account name to the id of the user, so the users can be found with point reads.
+    The items look like {"id": "email-<sha256 of the email>", "user_id": "...", "field": "email"}.
+    """
+
+
+class FormsRepository(Repository, ABC):
+
+    @abstractmethod
+    async def list_short_by_owner(self, owner_id: str, page_size: int, continuation_token: str | None = None) -> Page:
+        """
+        Returns the id and title of the forms of a user, one page at a time.
+
+        :param continuation_token: The token of the previous page, None for the first page.
+        :raises InvalidContinuationTokenError if the token is invalid.
+        """
+
+
+class FormPartitionedRepository(Repository, ABC):
+    """
+    A container partitioned by the 'form_id' of the items, so all the items of a form are in one partition
+    and the queries of a form don't fan out to every partition.
+    The point reads and deletes need the form_id too.
+    """
+
+    @abstractmethod
+    async def get(self, item_id: str, form_id: str) -> dict:
+        """
+        :raises ItemNotFoundError if the item doesn't exist in the form.
+        """
+
+    @abstractmethod
+    async def delete(self, item_id: str, form_id: str) -> None:
+        """
+        :raises ItemNotFoundError if the item doesn't exist in the form.
+        """
+
+
+class SubmissionsRepository(FormPartitionedRepository, ABC):
+
+    @abstractmethod
+    async def list_page_by_form(self, form_id: str, page_size: int, continuation_token: str | None = None,
+                                descending: bool = False, filters: SubmissionsFilter = SubmissionsFilter()) -> Page:
+        """
+        Returns the submissions of a form that match the filters, one page at a time,
+        sorted by submission_expiration_time.
+
+        :param continuation_token: The token of the previous page, None for the first page.
+        :raises InvalidContinuationTokenError if the token is invalid.
+        """
+
+    @abstractmethod
+    async def list_ids_by_form(self, form_id: str) -> list[str]:
+        """Returns the ids of all the submissions of a form."""
+
+    @abstractmethod
+    async def list_expiration_times(self) -> list[dict]:
+        """Returns the id, form_id and submission_expiration_time of every submission."""
+
+    @abstractmethod
+    async def list_expired(self, expired_before: int, limit: int) -> list[dict]:
+        """
+        Returns the id and form_id of at most 'limit' submissions with the submission_expiration_time
+        before or equal to expired_before.
+        """
+
+
+class SubmissionsSearchRepository(FormPartitionedRepository, ABC):
+    """
+    The search index of the submissions, one item for every submission, with the same id.
+    The items look like {"id": "<submission id>", "form_id": "...", "submission_expiration_time": 1678068760,
+    "tokens": ["ion", "popescu"], "terms": ["i", "io", "ion", "p", "po", ...]}, the terms are the prefixes
+    of the tokens.
+    """
+
+    @abstractmethod
+    async def search_page(self, form_id: str, terms: list[str], page_size: int,
+                          continuation_token: str | None = None) -> Page:
+        """
+        Returns the id and tokens of the index items of a form that have all the terms, one page at a time.
+
+        :param continuation_token: The token of the previous page, None for the first page.
+        :raises InvalidContinuationTokenError if the token is invalid.
+        """
+
+
+class JobsRepository(Repository, ABC):
+    """The records of the background jobs, so their status survives a restart of the server."""
+
+    @abstractmethod
+    async def list_unfinished(self) -> list[dict]:
+        """Returns the jobs that are queued or running."""
@@ -0,0 +1,84 @@
+"""
+Selects where the data is stored.
+
+The backend is chosen with the STORAGE_BACKEND environment variable:
+    * 'cosmos' (default) - the Azure Cosmos DB account from COSMOS_ENDPOINT and COSMOS_KEY
+    * 'memory' - in process dictionaries, lost when the app stops
+    * 'sqlite' - a SQLite file, at SQLITE_DATABASE_PATH
+"""
+import os
+
+from dotenv import load_dotenv
+
+from . import cosmo_db, local_db
+from .repositories import UsersRepository, UserLookupsRepository, FormsRepository, SubmissionsRepository, \
+    SubmissionsSearchRepository, JobsRepository
+
+load_dotenv()
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'cosmos')
+SQLITE_DATABASE_PATH = os.getenv('SQLITE_DATABASE_PATH', './generated_data/local_db.sqlite3')
+
+valid_storage_backends = {'cosmos', 'memory', 'sqlite'}
+
+
+class Storage:
+    """
+    Holds the repositories of the selected backend.
+    The modules import the 'storage' object once, so switching the backend with 'use' is seen everywhere.
+    """
+
+    users: UsersRepository
+    user_lookups: UserLookupsRepository
+    forms: FormsRepository
+    submissions: SubmissionsRepository
+    submissions_search: SubmissionsSearchRepository
+    jobs: JobsRepository
+
+    def __init__(self, backend: str):
+        self.backend = ''
+        self.use(backend)
+
+    def use(self, backend: str, sqlite_database_path: str = SQLITE_DATABASE_PATH):
+        if backend not in valid_storage_backends:
+            raise ValueError(f"Unknown storage backend '{backend}', expected one of {valid_storage_backends}.")
+
+        self.backend = backend
+
+        if backend == 'cosmos':
+            self.users = cosmo_db.CosmosUsersRepository()
+            self.user_lookups = cosmo_db.CosmosUserLookupsRepository()
+            self.forms = cosmo_db.CosmosFormsRepository()
+            self.submissions = cosmo_db.CosmosSubmissionsRepository()
+            self.submissions_search = cosmo_db.CosmosSubmissionsSearchRepository()
+            self.jobs = cosmo_db.CosmosJobsRepository()
+            return
+
+        if backend == 'memory':
+            containers = local_db.create_memory_containers()
+        else:
+            containers = local_db.create_sqlite_containers(sqlite_database_path)
+
+        self.users = local_db.LocalUsersRepository(containers[cosmo_db.USERS_CONTAINER_NAME])
+        self.user_lookups = local_db.LocalUserLookupsRepository(containers[cosmo_db.USER_LOOKUPS_CONTAINER_NAME])
+        self.forms = local_db.LocalFormsRepository(containers[cosmo_db.FORMS_CONTAINER_NAME])
+        self.submissions = local_db.LocalSubmissionsRepository(containers[cosmo_db.SUBMITTED_FORMS_CONTAINER_NAME])
+        self.submissions_search = local_db.LocalSubmissionsSearchRepository(
+            containers[cosmo_db.SUBMISSIONS_SEARCH_CONTAINER_NAME]
+        )
+        self.jobs = local_db.LocalJobsRepository(containers[cosmo_db.JOBS_CONTAINER_NAME])
+
+    async def connect(self):
+        """Called when the app starts."""
+
+        if self.backend == 'cosmos':
+            await cosmo_db.create_database_and_containers()
+
+    async def close(self):
+        """Called when the app shuts down."""
+
+        if self.backend == 'cosmos':
+            await cosmo_db.close_client()
+
+
+storage = Storage(STORAGE_BACKEND)
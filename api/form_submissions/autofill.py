@@ -0,0 +1,180 @@
+"""
+Completes the fields of a form with the values found in a scanned document.
+
+The keywords of the form's fields are compiled once per form in a KeywordIndex, lowercase and without diacritics,
+so 'Nume', 'NUME' and 'Numé' are the same key. A key found in the document is matched to a field by:
+1. the exact keyword, for example 'nume' for 'Nume'
+2. a keyword it starts with, for example 'loc nastere' for 'Loc nastere si domiciliu'
+3. a keyword that is the same as the key after removing at most one letter from each of them, for the OCR mistakes,
+   for example 'nune' (a missing letter) or 'nome' (a wrong letter) for 'nume'
+Every step is a few dictionary lookups that depend on the length of the key, not on the number of keywords.
+"""
+import re
+from typing import Any, Callable
+
+from ..forms.models import FormularInDB
+from .models import FormSubmissionCreate
+from .search_index import fold_text
+from .validators import InvalidValue, make_coercer
+
+# The keywords shorter than this are only matched exactly, one letter away they would match too many keys
+MIN_FUZZY_KEYWORD_LENGTH = 4
+
+# The ranks of the matches, the lower the better
+EXACT_MATCH = 0
+PREFIX_MATCH = 1
+FUZZY_MATCH = 2
+
+keyword_word_pattern = re.compile(r'[^\W_]+')
+
+
+def get_keyword_tokens(text: str) -> tuple[str, ...]:
+    """The folded words of the text, the underscores of keywords like 'first_name' separate words too."""
+
+    return tuple(keyword_word_pattern.findall(fold_text(text)))
+
+
+def get_deletes(text: str) -> set[str]:
+    """All the strings made by removing one character of the text."""
+
+    return {text[:position] + text[position + 1:] for position in range(len(text))}
+
+
+class KeywordIndex:
+
+    def __init__(self, form: FormularInDB):
+        # folded keyword -> placeholder
+        self.exact: dict[str, str] = {}
+        # first word of the keyword -> (words of the keyword, placeholder), the longest keywords first
+        self.prefixes: dict[str, list[tuple[tuple[str, ...], str]]] = {}
+        # the keyword and the keyword without one character -> placeholder, None if it's the same for several fields
+        self.fuzzy: dict[str, str | None] = {}
+        # placeholder -> the function converting the value to the type of the field
+        self.coercers: dict[str, Callable[[Any], Any]] = {}
+
+        for field in form.dynamic_fields:
+            self.coercers[field.placeholder] = make_coercer(field)
+
+            for keyword in field.keywords or []:
+                tokens = get_keyword_tokens(keyword)
+
+                if not tokens:
+                    continue
+
+                phrase = ' '.join(tokens)
+
+                # The first field declaring a keyword gets it
+                if phrase in self.exact:
+                    continue
+
+                self.exact[phrase] = field.placeholder
+                self.prefixes.setdefault(tokens[0], []).append((tokens, field.placeholder))
+
+                if len(phrase) >= MIN_FUZZY_KEYWORD_LENGTH:
+                    for variant in {phrase} | get_deletes(phrase):
+                        if self.fuzzy.get(variant, field.placeholder) != field.placeholder:
+                            variant_placeholder = None
+                        else:
+                            variant_placeholder = field.placeholder
+
+                        self.fuzzy[variant] = variant_placeholder
+
+        for keywords in self.prefixes.values():
+            keywords.sort(key=lambda keyword: len(keyword[0]), reverse=True)
+
+    def match_prefix(self, tokens: tuple[str, ...]) -> str | None:
+        """The field of the longest keyword the key starts with, the last word of the keyword can be incomplete."""
+
+        first_token = tokens[0]
+
+        for length in range(len(first_token), 0, -1):
+            for keyword_tokens, placeholder in self.prefixes.get(first_token[:length], ()):
+                if len(keyword_tokens) == 1:
+                    return placeholder
+
+                if length == len(first_token) and len(tokens) >= len(keyword_tokens) \
+                        and tokens[1:len(keyword_tokens) - 1] == keyword_tokens[1:-1] \
+                        and tokens[len(keyword_tokens) - 1].startswith(keyword_tokens[-1]):
+                    return placeholder
+
+        return None
+
+    def match_fuzzy(self, phrase: str) -> str | None:
+        if len(phrase) < MIN_FUZZY_KEYWORD_LENGTH:
+            return None
+
+        for variant in (phrase, *get_deletes(phrase)):
+            placeholder = self.fuzzy.get(variant)
+
+            if placeholder is not None:
+                return placeholder
+
+        return None
+
+    def match(self, key: str) -> tuple[int, str] | None:
+        """
+        Returns the rank of the match and the placeholder of the field the key is for, or None if there isn't one.
+        The keys of the bilingual documents, like 'Nume/Nom/Last name', are also matched by every language.
+        """
+
+        candidates = [tokens for tokens in (get_keyword_tokens(part) for part in [key, *key.split('/')]) if tokens]
+
+        for tokens in candidates:
+            placeholder = self.exact.get(' '.join(tokens))
+
+            if placeholder is not None:
+                return EXACT_MATCH, placeholder
+
+        for tokens in candidates:
+            placeholder = self.match_prefix(tokens)
+
+            if placeholder is not None:
+                return PREFIX_MATCH, placeholder
+
+        for tokens in candidates:
+            placeholder = self.match_fuzzy(' '.join(tokens))
+
+            if placeholder is not None:
+                return FUZZY_MATCH, placeholder
+
+        return None
+
+    def complete_fields(self, key_value_pairs: list[tuple[str, str]]) -> dict:
+        """
+        Returns the completed dynamic fields, with the values converted to the types of the fields.
+        A field matched by several keys gets the value of the best match, then of the first one in the document.
+        The values that don't fit the type of their field are left out, for the user to complete.
+        """
+
+        best_matches: dict[str, tuple[int, Any]] = {}
+
+        for key, value in key_value_pairs:
+            match = self.match(key)
+
+            if match is None:
+                continue
+
+            rank, placeholder = match
+
+            if placeholder in best_matches and best_matches[placeholder][0] <= rank:
+                continue
+
+            try:
+                best_matches[placeholder] = (rank, self.coercers[placeholder](value))
+            except InvalidValue:
+                continue
+
+        return {placeholder: value for placeholder, (_, value) in best_matches.items()}
+
+
+def get_keyword_index(form: FormularInDB) -> KeywordIndex:
+    """Returns the keyword index of the form, compiling it the first time."""
+
+    if form._keyword_index is None:
+        form._keyword_index = KeywordIndex(form)
+
+    return form._keyword_index
+
+
+def autofill_form_submission(form: FormularInDB, key_value_pairs: list[tuple[str, str]]) -> FormSubmissionCreate:
+    return FormSubmissionCreate(completed_dynamic_fields=get_keyword_index(form).complete_fields(key_value_pairs))
@@ -0,0 +1,26 @@
+from fastapi import HTTPException, status
+
+
+class UnfilledFields(HTTPException):
+    def __init__(self, fields: list[str]):
+        super().__init__(status_code=status.HTTP_400_BAD_REQUEST,
+                         detail=f"All fields must be specified. The following fields are missing or empty:"
+                                f" {fields}.")
+
+
+class InvalidFieldValues(HTTPException):
+    def __init__(self, errors: dict[str, str]):
+        super().__init__(status_code=status.HTTP_400_BAD_REQUEST,
+                         detail=f"The following fields have invalid values: {errors}.")
+
+
+class InvalidSubmittedDuring(HTTPException):
+    def __init__(self, submitted_during: str):
+        super().__init__(status_code=status.HTTP_400_BAD_REQUEST,
+                         detail=f"Invalid 'submitted_during' value '{submitted_during}'. Specify it as hh-dd-mm-yyyy,"
+                                f" with 'x' for the parts that can be anything, for example xx-19-03-2023.")
+
+
+invalid_continuation_token = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail="Invalid 'continuation_token', use the one from the previous page.")
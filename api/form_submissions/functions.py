@@ -1,92 +1,346 @@
-import azure
+import asyncio
+import csv
+import datetime
+import io
+import json
+import os
+from typing import AsyncIterator
 
-import azure.cosmos.exceptions
 from fastapi import HTTPException, status
 
 from ..forms.models import FormularInDB
-from .models import FormSubmissionInDB, FormSubmissionCreate
-from ..database.cosmo_db import form_submits_container
-from ..forms.functions import get_formular_from_db
+from .exceptions import InvalidSubmittedDuring
+from .models import FormSubmissionInDB, FormSubmissionCreate, ExportFormat
+from .validators import get_submission_validator
+from .search_index import SEARCHABLE_FIELDS_COUNT, remove_submission_from_index, search_submission_ids
+from ..database.exceptions import ItemNotFoundError, TooManyRequestsError
+from ..database.repositories import SubmissionsFilter, Page
+from ..database.storage import storage
+from ..forms.functions import get_formular_from_db, invalidate_cached_formular
+from ..jobs.models import Job
+from ..jobs.runner import job_runner
 
 
 async def validate_form_submission(form: FormularInDB, new_from_submission: FormSubmissionCreate) -> None:
     """
-    Validates a new form submission, to verify if all the given form fields have been completed.
+    Validates a new form submission, to verify if all the mandatory form fields have been completed
+    with values of the right type. The completed values are replaced with the normalized ones.
 
     :param form: The formular being completed
     :param new_from_submission:  The new form submission
-    :raises HTTPException if one of the fields of the form has not been completed.
+    :raises HTTPException if one of the fields of the form has not been completed or has an invalid value.
     :return: None
     """
 
-    # Check to see if they send all the data the form requires
-    unfilled_fields = []
-    for dynamic_field in form.dynamic_fields:
-        # If the field is not specified or is empty
-        if dynamic_field.placeholder not in new_from_submission.completed_dynamic_fields \
-                or not new_from_submission.completed_dynamic_fields[dynamic_field.placeholder]:
-            unfilled_fields.append(dynamic_field.placeholder)
+    validator = get_submission_validator(form)
 
-    if unfilled_fields:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                            detail=f"All fields must be specified. The following fields are missing or empty:"
-                                   f" {unfilled_fields}.")
+    new_from_submission.completed_dynamic_fields = validator.validate(new_from_submission.completed_dynamic_fields)
 
 
-async def get_form_submission_from_db(form_submission_id: str) -> FormSubmissionInDB:
+# The parts of submitted_during, from the largest to the smallest, and their valid values
+date_part_ranges = {'year': range(1, 10_000), 'month': range(1, 13), 'day': range(1, 32), 'hour': range(0, 24)}
+
+
+def get_submissions_filter(form: FormularInDB, string_to_find: str = '', submitted_during: str = '') -> SubmissionsFilter:
+    """
+    Translates the search parameters of the submissions list into conditions for the database query.
+
+    :param form: The form of the submissions
+    :param string_to_find: Text to search in the first completed fields of the form
+    :param submitted_during: The UTC creation time, as hh-dd-mm-yyyy, parts that are not numbers can be anything
+    :raises InvalidSubmittedDuring if submitted_during doesn't have that format
+    :return: The filter for storage.submissions.list_page_by_form
+    """
+
+    created_from = created_until = None
+    created_parts = {}
+
+    if submitted_during:
+        values = submitted_during.split('-')
+
+        if len(values) != 4:
+            raise InvalidSubmittedDuring(submitted_during)
+
+        hour, day, month, year = [int(i) if i.isnumeric() else -1 for i in values]
+        given_parts = {part: value for part, value in zip(('year', 'month', 'day', 'hour'), (year, month, day, hour))
+                       if value >= 0}
+
+        if any(value not in date_part_ranges[part] for part, value in given_parts.items()):
+            raise InvalidSubmittedDuring(submitted_during)
+
+        # The parts given from the year down are one range of creation times, which can use the index.
+        # The ones after a missing part, like the hour of any day, are checked separately.
+        range_parts = {}
+
+        for part in date_part_ranges:
+            if part not in given_parts:
+                break
+
+            range_parts[part] = given_parts[part]
+
+        created_parts = {part: value for part, value in given_parts.items() if part not in range_parts}
+
+        if range_parts:
+            try:
+                created_from, created_until = get_date_range(**range_parts)
+            except ValueError:
+                # For example the 31st of February
+                raise InvalidSubmittedDuring(submitted_during)
+
+    return SubmissionsFilter(
+        created_from=created_from,
+        created_until=created_until,
+        created_parts=created_parts,
+        text=string_to_find,
+        text_fields=tuple(field.placeholder for field in form.dynamic_fields[:SEARCHABLE_FIELDS_COUNT]),
+    )
+
+
+def get_date_range(year: int, month: int | None = None, day: int | None = None,
+                   hour: int | None = None) -> tuple[int, int]:
+    """
+    Returns the UTC timestamps of the start and the end (exclusive) of the year, month, day or hour.
+
+    :raises ValueError if the date doesn't exist.
+    """
+
+    start = datetime.datetime(year, month or 1, day or 1, hour or 0, tzinfo=datetime.timezone.utc)
+
+    if hour is not None:
+        end = start + datetime.timedelta(hours=1)
+    elif day is not None:
+        end = start + datetime.timedelta(days=1)
+    elif month is not None:
+        end = start.replace(year=year + month // 12, month=month % 12 + 1)
+    else:
+        end = start.replace(year=year + 1)
+
+    return int(start.timestamp()), int(end.timestamp())
+
+
+async def get_form_submission_from_db(form_submission_id: str, form_id: str) -> FormSubmissionInDB:
     """
     Returns the form submission from the database if it exists.
 
     :raises HTTPException if the form submission doesn't exist
     :param form_submission_id: The ID of the form submission
+    :param form_id: The ID of the form of the submission
     :return: The form submission object
     """
 
     try:
-        form_submission_dict = form_submits_container.read_item(
-            item=form_submission_id,
-            partition_key=form_submission_id
-        )
-    except azure.cosmos.exceptions.CosmosHttpResponseError:
+        form_submission_dict = await storage.submissions.get(form_submission_id, form_id)
+    except ItemNotFoundError:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="The form submission was not found.")
 
     return FormSubmissionInDB(**form_submission_dict)
 
 
-async def delete_all_forms_submission(form_id: str, user_id: str):
-    query = """SELECT form.id FROM c form WHERE form.form_id = @form_id"""
+# How many submissions are deleted at the same time when all the submissions of a form are deleted
+DELETE_CONCURRENCY = int(os.getenv('DELETE_CONCURRENCY', 10))
+# How many times a throttled delete is tried again, waiting twice as long every time
+DELETE_MAX_RETRIES = 5
+DELETE_RETRY_SECONDS = 0.5
+
+
+async def delete_submission_with_retries(submission_id: str, form_id: str) -> bool:
+    """
+    Deletes a submission and its search index item, waiting and trying again while the database is throttling.
+    The search index item is only removed once the submission is gone, so a failed delete can be tried again.
+
+    :return: False if the submission was already deleted
+    :raises TooManyRequestsError if the database is still throttling after the retries.
+    """
+
+    deleted = True
+
+    for retry in range(DELETE_MAX_RETRIES + 1):
+        try:
+            await storage.submissions.delete(submission_id, form_id)
+            break
+        except ItemNotFoundError:
+            # Deleted by its ttl or by someone else, its index item may still be there
+            deleted = False
+            break
+        except TooManyRequestsError as e:
+            if retry == DELETE_MAX_RETRIES:
+                raise
+
+            await asyncio.sleep(e.retry_after_seconds or DELETE_RETRY_SECONDS * 2 ** retry)
+
+    await remove_submission_from_index(submission_id, form_id)
 
-    params = [dict(name="@form_id", value=form_id)]
+    return deleted
 
-    results = form_submits_container.query_items(query=query,
-                                                 parameters=params,
-                                                 enable_cross_partition_query=True)
 
-    items = list(results)
+@job_runner.job('delete_form_submissions')
+async def delete_form_submissions(params: dict, progress: dict) -> dict:
+    """
+    Deletes all the submissions of a form, DELETE_CONCURRENCY at a time.
+    The params have the form_id, and delete_form if the form is deleted first. It's also run as a background job,
+    which saves the progress.
+
+    :return: The number of deleted submissions
+    """
+
+    form_id = params['form_id']
+
+    # Deleted by the job, which is saved before, so a form is never deleted without a job deleting its submissions
+    if params.get('delete_form'):
+        try:
+            await storage.forms.delete(form_id)
+        except ItemNotFoundError:
+            # Deleted by a previous attempt
+            pass
+
+        invalidate_cached_formular(form_id)
+
     # Returns a list of all the form submits that are created from the same form
+    items = await storage.submissions.list_ids_by_form(form_id)
+
+    progress["total"] = len(items)
+    progress["deleted"] = 0
+
+    # DELETE_CONCURRENCY workers take the next id when they are done with one, so there aren't a coroutine and
+    # a task for every submission of the form
+    submission_ids = iter(items)
+
+    async def delete_next():
+        for submission_id in submission_ids:
+            if await delete_submission_with_retries(submission_id, form_id):
+                progress["deleted"] += 1
+
+    await asyncio.gather(*(delete_next() for _ in range(min(DELETE_CONCURRENCY, len(items)))))
 
-    result = 0
+    return dict(deleted=progress["deleted"])
+
+
+async def start_form_submissions_deletion(form_id: str, user_id: str, delete_form: bool = False) -> Job:
+    """Starts a background job that deletes the submissions of the form, and the form before them if delete_form."""
+
+    return await job_runner.submit('delete_form_submissions', dict(form_id=form_id, delete_form=delete_form),
+                                   owner_id=user_id)
+
+
+async def check_can_delete_form_submissions(form_id: str, user_id: str):
+    """
+    :raises HTTPException if the form exists and doesn't belong to the user
+    """
 
     form = None
 
+    # Read from the database, get_formular_from_db is a 404 when the form doesn't exist, and the submissions
+    # left behind by a deleted form can be deleted by anyone
     try:
-        form = get_formular_from_db(form_id)
-    except azure.cosmos.exceptions.CosmosResourceNotFoundError:
+        form = await storage.forms.get(form_id)
+    except ItemNotFoundError:
         pass
     # Verifies if the form exists
 
-    if form and form.owner_id != user_id:
+    if form and form['owner_id'] != user_id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You can only delete your own forms")
         # Checks if the form belongs to the user
 
-    for submitted_form_id in items:
-        form_submits_container.delete_item(
-            item=submitted_form_id["id"],
-            partition_key=submitted_form_id["id"],
-        )
 
-        result += 1
-        # Deletes all the form submits and returns the number that it has deleted
+async def delete_all_forms_submission(form_id: str, user_id: str):
+    await check_can_delete_form_submissions(form_id, user_id)
+
+    result = await delete_form_submissions(dict(form_id=form_id), {})
+    # Deletes all the form submits and returns the number that it has deleted
+
+    return f"Deleted {result['deleted']} forms with success."
+
+
+async def search_form_submissions(form_id: str, text: str, page_size: int,
+                                  continuation_token: str | None = None) -> Page:
+    """
+    Finds the submissions of the form with the search index, then reads only the matching ones.
+
+    :raises InvalidContinuationTokenError if the token is invalid.
+    :return: A page of submissions
+    """
+
+    page = await search_submission_ids(form_id, text, page_size, continuation_token)
+
+    async def read_submission(submission_id: str) -> dict | None:
+        try:
+            return await storage.submissions.get(submission_id, form_id)
+        except ItemNotFoundError:
+            # Deleted after the index was read
+            return None
+
+    submissions = await asyncio.gather(*(read_submission(item['id']) for item in page.items))
+
+    return Page(items=[submission for submission in submissions if submission is not None],
+                continuation_token=page.continuation_token)
+
+
+EXPORT_PAGE_SIZE = 500
+
+# The columns of the CSV export, before the form's fields
+submission_export_columns = ('id', 'user_that_completed_id', 'submission_creation_time', 'submission_expiration_time')
+
+
+async def iterate_form_submissions(form_id: str, filters: SubmissionsFilter = SubmissionsFilter(),
+                                   page_size: int = EXPORT_PAGE_SIZE) -> AsyncIterator[dict]:
+    """
+    Yields all the submissions of a form, reading them from the database one page at a time,
+    so only one page is in memory.
+    """
+
+    continuation_token = None
+
+    while True:
+        page = await storage.submissions.list_page_by_form(form_id, page_size, continuation_token, filters=filters)
+
+        for submission in page.items:
+            yield submission
+
+        continuation_token = page.continuation_token
+
+        if continuation_token is None:
+            break
+
+
+def format_csv_value(value) -> str:
+    # The multiple choice fields are lists
+    if isinstance(value, list):
+        return ';'.join(str(item) for item in value)
+
+    return '' if value is None else str(value)
+
+
+async def export_form_submissions(form: FormularInDB, export_format: ExportFormat) -> AsyncIterator[str]:
+    """
+    Yields the submissions of the form as NDJSON lines or CSV rows, as they are read from the database.
+    The CSV has a column for every dynamic field of the form.
+    """
+
+    if export_format == ExportFormat.ndjson:
+        async for submission in iterate_form_submissions(form.id):
+            yield json.dumps(FormSubmissionInDB(**submission).dict(), ensure_ascii=False) + '\n'
+
+        return
+
+    field_columns = [field.placeholder for field in form.dynamic_fields]
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush() -> str:
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+        return text
+
+    writer.writerow([*submission_export_columns, *field_columns])
+    yield flush()
+
+    async for submission in iterate_form_submissions(form.id):
+        completed_fields = submission['completed_dynamic_fields']
 
-    return f"Deleted {result} forms with success."
+        writer.writerow([*(format_csv_value(submission.get(column)) for column in submission_export_columns),
+                         *(format_csv_value(completed_fields.get(column)) for column in field_columns)])
+        yield flush()
@@ -49,4 +49,6 @@ class sorting_Order(str, Enum):
     descending = "descending"
 
 
-sort_Order_to_bool = {"ascending": True, "descending": False}
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
@@ -0,0 +1,220 @@
+"""
+Renders the PDF of a completed submission.
+
+fpdf is pure Python and takes the CPU for the whole rendering, so it runs in a process pool, where it can use all the
+cores without blocking the event loop. The PDFs are made in memory and cached by the versions of the submission and
+of the form, so downloading the same PDF again doesn't render it again.
+The PDFs of all the submissions of a form can also be downloaded as a ZIP, which is sent while they are rendered.
+The submissions whose PDF couldn't be rendered are listed in the 'errors.txt' file of the ZIP.
+"""
+import asyncio
+import hashlib
+import io
+import os
+import zipfile
+from typing import AsyncIterator
+
+import fpdf
+
+from fastapi import HTTPException, status
+
+from .functions import iterate_form_submissions
+from .models import FormSubmissionInDB
+from ..forms.functions import render_compiled_section
+from ..database.repositories import SubmissionsFilter
+from ..forms.models import FormularInDB
+from ..utility.cache import TTLCache
+from ..utility.executors import BoundedExecutor, ExecutorQueueFullError
+from ..utility.metrics import register_metrics
+
+PDF_CACHE_SIZE = int(os.getenv('PDF_CACHE_SIZE', 200))
+PDF_CACHE_TTL_SECONDS = float(os.getenv('PDF_CACHE_TTL_SECONDS', 60 * 60))
+# How many PDFs of a ZIP export are rendered at the same time, the others wait, so the memory used is bounded
+PDF_EXPORT_CONCURRENCY = int(os.getenv('PDF_EXPORT_CONCURRENCY', os.cpu_count() or 1))
+# The wait before rendering a PDF of a ZIP export again when the executor is full, the response was already started
+PDF_EXPORT_RETRY_SECONDS = 1
+
+pdf_rendering_executor = BoundedExecutor(
+    name='pdf-rendering',
+    kind=os.getenv('PDF_RENDERING_EXECUTOR', 'process'),
+    max_workers=int(os.getenv('PDF_RENDERING_WORKERS', os.cpu_count() or 1)),
+    max_queue=int(os.getenv('PDF_RENDERING_MAX_QUEUE', 100)),
+)
+
+# (submission id, submission _etag, form _etag) -> the bytes of the PDF.
+# The _etag of an item changes on every write, so an edited submission or form has a new key.
+pdf_cache = TTLCache(max_size=PDF_CACHE_SIZE, ttl_seconds=PDF_CACHE_TTL_SECONDS)
+
+register_metrics('pdf_rendering_executor', pdf_rendering_executor.stats)
+register_metrics('pdf_cache', pdf_cache.stats)
+
+pdf_queue_full_exception = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Too many PDFs are being generated, try again in a few seconds.",
+    headers={"Retry-After": "1"},
+)
+
+
+def render_pdf(title: str, lines: list[str]) -> bytes:
+    """Runs in the worker processes, so it only gets and returns picklable values."""
+
+    pdf = fpdf.FPDF()
+
+    pdf.add_page()
+
+    pdf.set_font("Arial", size=20)
+
+    pdf.cell(200, 10, txt=title, ln=1, align='C')
+    pdf.cell(200, 10, txt=' ', ln=1, align='C')
+
+    pdf.set_font("Arial", size=15)
+
+    for line in lines:
+        pdf.cell(200, 10, txt=line, ln=1, align='L')
+
+    # fpdf 1.7 returns the document as a latin-1 string
+    return pdf.output(dest='S').encode('latin-1')
+
+
+def get_pdf_lines(form: FormularInDB, form_submission: FormSubmissionInDB) -> list[str]:
+    return [render_compiled_section(segments, form_submission.completed_dynamic_fields)
+            for segments in form.compiled_sections]
+
+
+def get_pdf_etag(form: FormularInDB, submission: dict) -> str:
+    """The ETag header of the PDF, it changes when the submission or the form changes."""
+
+    version = f"{submission['id']}:{submission.get('_etag')}:{form._etag}"
+
+    return '"' + hashlib.sha256(version.encode()).hexdigest()[:32] + '"'
+
+
+async def render_submission_pdf(form: FormularInDB, submission: dict, cache_result: bool = True) -> bytes:
+    """
+    Returns the PDF of the submission, from the cache or rendered in the process pool.
+
+    :param submission: The submission as it was read from the database, with its '_etag'
+    :param cache_result: If the rendered PDF is cached, false for the exports, which would replace the whole cache
+    :raises ExecutorQueueFullError if too many PDFs are waiting to be rendered.
+    """
+
+    key = (submission['id'], submission.get('_etag'), form._etag)
+
+    pdf_bytes = pdf_cache.get(key)
+
+    if pdf_bytes is not None:
+        return pdf_bytes
+
+    lines = get_pdf_lines(form, FormSubmissionInDB(**submission))
+
+    pdf_bytes = await pdf_rendering_executor.run(render_pdf, form.title, lines)
+
+    if cache_result:
+        pdf_cache.set(key, pdf_bytes)
+
+    return pdf_bytes
+
+
+async def get_submission_pdf_bytes(form: FormularInDB, submission: dict) -> bytes:
+    """
+    :raises HTTPException if too many PDFs are waiting to be rendered.
+    """
+
+    try:
+        return await render_submission_pdf(form, submission)
+    except ExecutorQueueFullError:
+        raise pdf_queue_full_exception
+
+
+async def render_export_pdf(form: FormularInDB, submission: dict) -> tuple[str, bytes | None, str]:
+    """
+    Returns the id of the submission, its PDF, and the error if it couldn't be rendered, for example because of a
+    character that fpdf can't encode, so one submission doesn't stop the whole export.
+    """
+
+    # The response was already started, so it can't be a 503, it waits for the other PDFs instead
+    while True:
+        try:
+            return submission['id'], await render_submission_pdf(form, submission, cache_result=False), ''
+        except ExecutorQueueFullError:
+            await asyncio.sleep(PDF_EXPORT_RETRY_SECONDS)
+        except Exception as e:
+            return submission['id'], None, f"{type(e).__name__}: {e}"
+
+
+class ZipStream(io.RawIOBase):
+    """
+    The file the ZIP is written to, it keeps the bytes only until they are sent.
+    It can't seek, so zipfile writes the sizes after every file, which is allowed by the ZIP format.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.buffer += data
+        return len(data)
+
+    def take(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+
+        return data
+
+
+async def export_submission_pdfs_zip(form: FormularInDB,
+                                     filters: SubmissionsFilter = SubmissionsFilter()) -> AsyncIterator[bytes]:
+    """
+    Yields a ZIP with the PDF of every submission of the form that matches the filters, named '{submission id}.pdf'.
+
+    The submissions are read one page at a time and at most PDF_EXPORT_CONCURRENCY of them are rendered at the same
+    time, every PDF is added to the ZIP and sent as soon as it's rendered, so the order of the files is the order in
+    which they were rendered. The PDFs are already compressed, so they are stored in the ZIP as they are.
+    The submissions that couldn't be rendered are left out and listed with their errors in 'errors.txt'.
+    """
+
+    stream = ZipStream()
+    archive = zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_STORED)
+    rendering: set[asyncio.Task] = set()
+    errors: list[str] = []
+
+    def add_rendered(done: set[asyncio.Task]):
+        for task in done:
+            submission_id, pdf_bytes, error = task.result()
+
+            if pdf_bytes is None:
+                errors.append(f'{submission_id}: {error}')
+            else:
+                archive.writestr(f'{submission_id}.pdf', pdf_bytes)
+
+    try:
+        async for submission in iterate_form_submissions(form.id, filters):
+            if len(rendering) >= PDF_EXPORT_CONCURRENCY:
+                done, rendering = await asyncio.wait(rendering, return_when=asyncio.FIRST_COMPLETED)
+                add_rendered(done)
+                yield stream.take()
+
+            rendering.add(asyncio.create_task(render_export_pdf(form, submission)))
+
+        while rendering:
+            done, rendering = await asyncio.wait(rendering, return_when=asyncio.FIRST_COMPLETED)
+            add_rendered(done)
+            yield stream.take()
+
+        if errors:
+            archive.writestr('errors.txt', '\n'.join(errors) + '\n')
+
+        # Writes the list of the files at the end of the ZIP
+        archive.close()
+        yield stream.take()
+    finally:
+        # The client disconnected or the database failed, the PDFs that weren't rendered yet aren't needed
+        for task in rendering:
+            task.cancel()
+
+        # Otherwise it's closed when it's garbage collected, writing to the stream that was already closed
+        archive.close()
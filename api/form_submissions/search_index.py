@@ -0,0 +1,106 @@
+"""
+The search index of the submissions.
+
+For every submission, the words of the first completed fields are stored in storage.submissions_search,
+lowercase and without diacritics, so 'Ștefan' is found by 'stefan' and by 'ste'.
+A search reads only the index items of the form that have the words, then the matching submissions,
+so it doesn't get slower as the form gets more submissions.
+"""
+import re
+import unicodedata
+
+from ..database.exceptions import ItemNotFoundError
+from ..database.repositories import Page
+from ..database.storage import storage
+from ..forms.models import FormularInDB
+
+# The requirements of the app say that the search string should be only between the first
+# 5 completed fields of the submission
+SEARCHABLE_FIELDS_COUNT = 5
+
+# The prefixes longer than this are not stored, the longer searched words are checked against the full tokens
+MAX_TERM_LENGTH = 12
+
+word_pattern = re.compile(r'\w+')
+
+
+def fold_text(text: str) -> str:
+    """Lowercase and without diacritics, both the comma (ș, ț) and the cedilla (ş, ţ) forms."""
+
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+
+    return ''.join(character for character in decomposed if not unicodedata.combining(character))
+
+
+def get_search_tokens(text: str) -> list[str]:
+    """Returns the folded words of the text, without duplicates, in the order they appear."""
+
+    return list(dict.fromkeys(word_pattern.findall(fold_text(text))))
+
+
+def get_search_terms(tokens: list[str]) -> list[str]:
+    """Returns all the prefixes of the tokens, up to MAX_TERM_LENGTH characters."""
+
+    terms = {token[:length] for token in tokens for length in range(1, min(len(token), MAX_TERM_LENGTH) + 1)}
+
+    return sorted(terms)
+
+
+def get_submission_text(form: FormularInDB, completed_fields: dict) -> str:
+    values = []
+
+    for field in form.dynamic_fields[:SEARCHABLE_FIELDS_COUNT]:
+        value = completed_fields.get(field.placeholder)
+
+        # The multiple choice fields are lists
+        if isinstance(value, list):
+            values.extend(str(item) for item in value)
+        elif value is not None:
+            values.append(str(value))
+
+    return ' '.join(values)
+
+
+async def index_submission(form: FormularInDB, submission: dict) -> None:
+    """Adds the submission to the search index, or replaces its words if it was already added."""
+
+    tokens = get_search_tokens(get_submission_text(form, submission['completed_dynamic_fields']))
+
+    await storage.submissions_search.upsert(
+        dict(id=submission['id'], form_id=submission['form_id'],
+             submission_expiration_time=submission['submission_expiration_time'],
+             tokens=tokens, terms=get_search_terms(tokens))
+    )
+
+
+async def remove_submission_from_index(submission_id: str, form_id: str) -> None:
+    try:
+        await storage.submissions_search.delete(submission_id, form_id)
+    except ItemNotFoundError:
+        # The submissions created before the index existed
+        pass
+
+
+async def search_submission_ids(form_id: str, text: str, page_size: int,
+                                continuation_token: str | None = None) -> Page:
+    """
+    Returns the ids of the submissions of the form that have all the words of the text, or words starting with them.
+
+    :raises InvalidContinuationTokenError if the token is invalid.
+    :return: A page of index items with the 'id' of the submissions
+    """
+
+    searched_tokens = get_search_tokens(text)
+
+    if not searched_tokens:
+        return Page(items=[], continuation_token=None)
+
+    terms = [token[:MAX_TERM_LENGTH] for token in searched_tokens]
+
+    page = await storage.submissions_search.search_page(form_id, terms, page_size, continuation_token)
+
+    # Only needed for the searched words longer than the stored prefixes
+    items = [item for item in page.items
+             if all(any(token.startswith(searched) for token in item['tokens']) for searched in searched_tokens)]
+
+    return Page(items=items, continuation_token=page.continuation_token)
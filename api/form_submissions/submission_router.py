@@ -1,23 +1,30 @@
-import datetime
 import time
 import uuid
 
-import fpdf
+from fastapi import APIRouter, Depends, File, Header, Path, HTTPException, Query, Response, UploadFile, status
+from fastapi.responses import StreamingResponse
 
-import azure.cosmos.exceptions
-from fastapi import APIRouter, Depends, Path, HTTPException, Query, Response, status
-
-from .models import FormSubmissionInDB, FormSubmissionCreate, FormSubmissionUpdate, sorting_Order, sort_Order_to_bool
+from .models import FormSubmissionInDB, FormSubmissionCreate, FormSubmissionUpdate, sorting_Order, ExportFormat
+from .exceptions import invalid_continuation_token
 from ..users.models import User
 from ..authentication.encryption import get_current_user
-from .functions import validate_form_submission, get_form_submission_from_db, delete_all_forms_submission
+from .functions import validate_form_submission, get_form_submission_from_db, delete_all_forms_submission, \
+    get_submissions_filter, export_form_submissions, search_form_submissions, check_can_delete_form_submissions, \
+    start_form_submissions_deletion
+from .search_index import index_submission, remove_submission_from_index
+from .autofill import autofill_form_submission
+from .pdf import get_submission_pdf_bytes, get_pdf_etag, export_submission_pdfs_zip
 from ..forms.functions import get_formular_from_db
-from ..database.cosmo_db import form_submits_container
+from ..database.exceptions import InvalidContinuationTokenError
+from ..database.storage import storage
+from ..utility.document_recognizer import scan_uploaded_document
+from ..utility.document_uploads import DocumentUploadRoute
 
 SECONDS_IN_ONE_DAY = 60 * 60 * 24
 
 router = APIRouter(
-    prefix="/api/v1/users/{user_id}/forms/{form_id}/submissions"
+    prefix="/api/v1/users/{user_id}/forms/{form_id}/submissions",
+    route_class=DocumentUploadRoute
 )
 
 
@@ -29,7 +36,7 @@ async def add_form_submission(
         new_from_submission: FormSubmissionCreate,
 ) -> FormSubmissionInDB:
     # Check if form exists
-    form = get_formular_from_db(form_id)
+    form = await get_formular_from_db(form_id)
 
     # No need to check if it's the owner of the form, as anyone can add a submission
 
@@ -50,13 +57,148 @@ async def add_form_submission(
         **new_from_submission.dict()
     )
 
-    form_submits_container.create_item(
-        new_from_submission.dict(exclude_none=True)
-    )
+    submission = new_from_submission.dict(exclude_none=True)
+
+    await storage.submissions.create(submission)
+
+    # Added after the submission, so a search never finds a submission that wasn't saved
+    await index_submission(form, submission)
 
     return new_from_submission
 
 
+@router.post(path="/autofill",
+             tags=["form submission"],
+             description="Scans a document and completes the fields of the form with the values found in it,"
+                         " by the keywords of the fields. The fields that weren't found are left out.")
+async def autofill_form_submission_from_document(
+        document: UploadFile = File(description="The scanned document, like an identity or a student card."),
+        user_id: str = Path(example="c6c1b8ae-44cd-4e83-a5f9-d6bbc8eeebcf",
+                            description="The id of the user completing the form."),
+        form_id: str = Path(example="67b64054-db84-489a-af92-fe87f9be9899",
+                            description="The id of the form"),
+        current_user: User = Depends(get_current_user)
+) -> FormSubmissionCreate:
+    if current_user.id != user_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="User ID from path doesnt match your user id.")
+
+    # Anyone can complete a form
+    form = await get_formular_from_db(form_id)
+
+    key_value_pairs = await scan_uploaded_document(document)
+
+    return autofill_form_submission(form, key_value_pairs)
+
+
+# Declared before the "/{form_submission_id}" routes, so "export" isn't taken as an id
+@router.get(path="/export",
+            tags=["form submission"],
+            description="Download all the submissions of a form, as NDJSON (one JSON object per line) or CSV.")
+async def export_all_form_submissions(
+        export_format: ExportFormat = Query(default=ExportFormat.ndjson, alias="format",
+                                            description="The format of the file."),
+        user_id: str = Path(example="c6c1b8ae-44cd-4e83-a5f9-d6bbc8eeebcf",
+                            description="The id of the user."),
+        form_id: str = Path(example="67b64054-db84-489a-af92-fe87f9be9899",
+                            description="The id of the form"),
+        current_user: User = Depends(get_current_user)
+) -> StreamingResponse:
+    if current_user.id != user_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="You can't access other's people submissions.")
+
+    form = await get_formular_from_db(form_id)
+
+    if form.owner_id != user_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="You can't access other's people submissions.")
+
+    # The rows are sent as the pages are read from the database, so the memory used doesn't depend on
+    # how many submissions the form has
+    media_type = 'text/csv' if export_format == ExportFormat.csv else 'application/x-ndjson'
+    headers = {'Content-Disposition': f'attachment; filename="{form_id}.{export_format.value}"'}
+
+    return StreamingResponse(export_form_submissions(form, export_format), media_type=media_type, headers=headers)
+
+
+@router.get(path="/pdfs",
+            tags=["form submission"],
+            description="Download the PDFs of all the submissions of a form, or of the ones that match the filters,"
+                        " as a ZIP with a '{submission id}.pdf' file for every submission.")
+async def export_form_submission_pdfs(
+        string_to_find: str = Query(default='',
+                                    example="Valentin",
+                                    description="A string to search for in the form submission completed values."),
+        submitted_during: str = Query(default='',
+                                      example="12-19-03-2023",
+                                      description="The date and time (UTC) when the submission was created."
+                                                  " Specify them as hh-dd-mm-yyyy, use 'x' for the parts that can"
+                                                  " be anything."),
+        user_id: str = Path(example="c6c1b8ae-44cd-4e83-a5f9-d6bbc8eeebcf",
+                            description="The id of the user."),
+        form_id: str = Path(example="67b64054-db84-489a-af92-fe87f9be9899",
+                            description="The id of the form"),
+        current_user: User = Depends(get_current_user)
+) -> StreamingResponse:
+    if current_user.id != user_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="You can't access other's people submissions.")
+
+    # The form is read once for all the PDFs
+    form = await get_formular_from_db(form_id)
+
+    if form.owner_id != user_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="You can't access other's people submissions.")
+
+    filters = get_submissions_filter(form, string_to_find, submitted_during)
+
+    headers = {'Content-Disposition': f'attachment; filename="{form_id}.zip"'}
+
+    return StreamingResponse(export_submission_pdfs_zip(form, filters), media_type='application/zip', headers=headers)
+
+
+@router.get(path="/search",
+            tags=["form submission"],
+            description="Search the submissions of a form by the words of their first completed fields."
+                        " The case and the diacritics don't matter and the words can be incomplete,"
+                        " for example 'stef pop' finds 'Ștefan Popescu'.")
+async def search_form_submissions_by_text(
+        response: Response,
+        text: str = Query(example="Valentin",
+                          description="The words to search for, all of them must be found."),
+        page_size: int = Query(default=100, ge=1, le=1000,
+                               description="The maximum number of submissions to return."),
+        continuation_token: str | None = Query(default=None,
+                                               description="The 'X-Continuation-Token' header of the previous page."),
+        user_id: str = Path(example="c6c1b8ae-44cd-4e83-a5f9-d6bbc8eeebcf",
+                            description="The id of the user."),
+        form_id: str = Path(example="67b64054-db84-489a-af92-fe87f9be9899",
+                            description="The id of the form"),
+        current_user: User = Depends(get_current_user)
+) -> list[FormSubmissionInDB]:
+    if current_user.id != user_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="You can't access other's people submissions.")
+
+    form = await get_formular_from_db(form_id)
+
+    if form.owner_id != user_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="You can't access other's people submissions.")
+
+    try:
+        page = await search_form_submissions(form_id, text, page_size, continuation_token)
+    except InvalidContinuationTokenError:
+        raise invalid_continuation_token
+
+    if page.continuation_token:
+        response.headers['X-Continuation-Token'] = page.continuation_token
+
+    return page.items
+
+
 @router.put(path="/{form_submission_id}",
             tags=["form submission"])
 async def update_form_submission(
@@ -67,11 +209,11 @@ async def update_form_submission(
         current_user: User = Depends(get_current_user)
 ) -> FormSubmissionInDB:
     # Check if form exists
-    form = get_formular_from_db(form_id)
+    form = await get_formular_from_db(form_id)
 
     # Verify if the submission exists
     # Raises an exception if the submission does not exist
-    form_submission = await get_form_submission_from_db(form_submission_id)
+    form_submission = await get_form_submission_from_db(form_submission_id, form_id)
 
     # Verify if they are allowed to update the submission
     if form.owner_id != current_user.id and form_submission.user_that_completed_id != current_user:
@@ -88,9 +230,10 @@ async def update_form_submission(
     form_submission.completed_dynamic_fields = updated_from_submission.completed_dynamic_fields
 
     # Update the submission
-    form_submits_container.upsert_item(
-        form_submission.dict(exclude_none=True)
-    )
+    submission = form_submission.dict(exclude_none=True)
+
+    await storage.submissions.upsert(submission)
+    await index_submission(form, submission)
 
     return form_submission
 
@@ -111,23 +254,14 @@ async def get_one_form_submission(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You can delete only your own data.")
         # Verifies if the owner of the form and the user are the same
 
-    try:
-        form = get_formular_from_db(form_id)
-    except azure.cosmos.exceptions.CosmosResourceNotFoundError:
-        await delete_all_forms_submission(form_id, user_id)
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"Form ''{form_id}'' does not exist."
-                            )
+    form = await get_formular_from_db(form_id)
     # Verifies if the form and the form submission exist in the database
 
     if form.owner_id != user_id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You can only delete your own forms")
         # Checks if the form belongs to the user
 
-    form_submits = form_submits_container.read_item(
-        item=form_submission_id,
-        partition_key=form_submission_id,
-    )
+    form_submits = await storage.submissions.get(form_submission_id, form_id)
     # Reads the form submit from the database
 
     if form_submits["form_id"] != form.id:
@@ -140,6 +274,7 @@ async def get_one_form_submission(
 @router.get(path="",
             tags=["form submission"])
 async def get_all_form_submissions_by_form_data(
+        response: Response,
         sort_order: sorting_Order = Query(
             default=sorting_Order.ascending,
             description="The order of the form submission, sorted by the submission time."),
@@ -148,8 +283,13 @@ async def get_all_form_submissions_by_form_data(
                                     description="A string to search for in the form submission completed values."),
         submitted_during: str = Query(default='',
                                       example="12-19-03-2023",
-                                      description="The date and time when the submission was created."
-                                                  " Specify them as hh-dd-mm-yyyy."),
+                                      description="The date and time (UTC) when the submission was created."
+                                                  " Specify them as hh-dd-mm-yyyy, use 'x' for the parts that can"
+                                                  " be anything."),
+        page_size: int = Query(default=100, ge=1, le=1000,
+                               description="The maximum number of submissions to return."),
+        continuation_token: str | None = Query(default=None,
+                                               description="The 'X-Continuation-Token' header of the previous page."),
         user_id: str = Path(example="c6c1b8ae-44cd-4e83-a5f9-d6bbc8eeebcf",
                             description="The id of the user."),
         form_id: str = Path(example="67b64054-db84-489a-af92-fe87f9be9899",
@@ -163,88 +303,29 @@ async def get_all_form_submissions_by_form_data(
                             detail="You can't access other's people submissions.")
 
     # Verify if the form still exists
-    # If it doesn't exist we can delete all it's submissions
-    try:
-        form = get_formular_from_db(form_id)
-    except azure.cosmos.exceptions.CosmosResourceNotFoundError:
-        await delete_all_forms_submission(form_id, user_id)
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"Form ''{form_id}'' does not exist."
-                            )
+    form = await get_formular_from_db(form_id)
 
     # Verify if its the form owner
     if form.owner_id != user_id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail="You can't access other's people submissions.")
 
-    # Query all the form submissions
-    query = """
-SELECT 
-
-submission.id, 
-submission.form_id, 
-submission.completed_dynamic_fields, 
-submission.user_that_completed_id, 
-submission.submission_creation_time, 
-submission.submission_expiration_time 
-
-FROM c submission WHERE submission.form_id = @form_id"""
-
-    params = [dict(name="@form_id", value=form_id)]
-
-    results = form_submits_container.query_items(query=query,
-                                                 parameters=params,
-                                                 enable_cross_partition_query=True)
-
-    # Sort the submissions by the expiration time
-    form_submissions_list = sorted(list(results),
-                                   key=lambda x: x["submission_expiration_time"],
-                                   reverse=sort_Order_to_bool[sort_order.value])
-
-    # If they specified a string to find, remove the ones that don't meet the criteria
-    if string_to_find:
-        mach_list = []
-
-        for submission in form_submissions_list:
-            for i, field in enumerate(submission["completed_dynamic_fields"]):
+    # The sorting, the filters and the paging are done by the database query,
+    # so only one page of submissions is read
+    filters = get_submissions_filter(form, string_to_find, submitted_during)
 
-                # The requirements of the app say that the search string should be only between the first
-                # 5 completed fields of the submission
-                if i >= 5:
-                    break
-
-                if string_to_find in str(submission["completed_dynamic_fields"][field]):
-                    mach_list.append(submission)
-    else:
-        mach_list = form_submissions_list
-
-    # Give only the submissions that happened during this time
-    if submitted_during:
-        form_submissions_list = mach_list
-        mach_list = []
-
-        hour, day, month, year = [int(i) if i.isnumeric() else -1 for i in submitted_during.split('-')]
-
-        for submission in form_submissions_list:
-            submitted_at = datetime.datetime.fromtimestamp(submission['submission_creation_time'])
-
-            # For all the time specifiers, if they are not -1 (this means they were given by the user),
-            # verify if the submission was created during this time
-            if 0 <= hour != submitted_at.hour:
-                continue
-
-            if 0 <= day != submitted_at.day:
-                continue
-
-            if 0 <= month != submitted_at.month:
-                continue
-
-            if 0 <= year != submitted_at.year:
-                continue
+    try:
+        page = await storage.submissions.list_page_by_form(form_id, page_size, continuation_token,
+                                                           descending=sort_order == sorting_Order.descending,
+                                                           filters=filters)
+    except InvalidContinuationTokenError:
+        raise invalid_continuation_token
 
-            mach_list.append(submission)
+    # The body stays a list, the token for the next page is sent in a header
+    if page.continuation_token:
+        response.headers['X-Continuation-Token'] = page.continuation_token
 
-    return mach_list
+    return page.items
 
 
 @router.delete(path="/{form_submission_id}",
@@ -262,36 +343,22 @@ async def delete_form_submission(
     if current_user.id != user_id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You can delete only your own data.")
         # Verifies if the owner of the form and the user are the same
-    try:
-        form = get_formular_from_db(form_id)
-    except azure.cosmos.exceptions.CosmosResourceNotFoundError:
-        form_submit = form_submits_container.delete_item(
-            item=form_id,
-            partition_key=form_id,
-        )
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"Form ''{form_id}'' does not exist."
-                            )
+    form = await get_formular_from_db(form_id)
     # Verifies if the form exists in the database
 
     if form.owner_id != user_id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You can only delete your own forms")
         # Checks if the form belongs to the user
 
-    form_submits = form_submits_container.read_item(
-        item=form_submission_id,
-        partition_key=form_submission_id,
-    )
+    form_submits = await storage.submissions.get(form_submission_id, form_id)
     # Reads the form submit from the database
 
     if form_submits["form_id"] != form.id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forms ids do not match")
         # Form id does not match
 
-    form_submits_container.delete_item(
-        item=form_submission_id,
-        partition_key=form_submission_id,
-    )
+    await storage.submissions.delete(form_submission_id, form_id)
+    await remove_submission_from_index(form_submission_id, form_id)
     # Deletes the form submit and returns it
     return FormSubmissionInDB(**form_submits)
 
@@ -299,6 +366,10 @@ async def delete_form_submission(
 @router.delete(path="/",
                tags=["form submission"])
 async def delete_all_form_submission(
+        response: Response,
+        wait: bool = Query(default=True,
+                           description="With false, the submissions are deleted by a background job and the response"
+                                       " is 202 with the job, which can be followed at '/api/v1/jobs/{job_id}'."),
         user_id: str = Path(example="c6c1b8ae-44cd-4e83-a5f9-d6bbc8eeebcf",
                             description="The id of the user."),
         form_id: str = Path(example="f38f905c-caab-4565-bf49-969d0802fac4",
@@ -310,7 +381,17 @@ async def delete_all_form_submission(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You can delete only your own data.")
         # Verifies if the owner of the form and the user are the same
 
-    return await delete_all_forms_submission(form_id, user_id)
+    if wait:
+        return await delete_all_forms_submission(form_id, user_id)
+
+    await check_can_delete_form_submissions(form_id, user_id)
+
+    job = await start_form_submissions_deletion(form_id, user_id)
+
+    response.status_code = status.HTTP_202_ACCEPTED
+    response.headers['Location'] = f'/api/v1/jobs/{job.id}'
+
+    return job
 
 
 @router.get(path="/{form_submission_id}/pdf",
@@ -322,6 +403,9 @@ async def get_submission_pdf(
                             description="The id of the user."),
         form_id: str = Path(example="f38f905c-caab-4565-bf49-969d0802fac4",
                             description="The id of the form"),
+        if_none_match: str | None = Header(default=None,
+                                           description="The 'ETag' of a PDF downloaded before, if it didn't change"
+                                                       " the response is 304 without a body."),
         current_user: User = Depends(get_current_user)
 
 ):
@@ -331,13 +415,7 @@ async def get_submission_pdf(
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                                 detail="You can create ")
 
-        try:
-            form = get_formular_from_db(form_id)
-        except azure.cosmos.exceptions.CosmosResourceNotFoundError:
-            await delete_all_forms_submission(form_id, user_id)
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                detail=f"Form '{form_id}' does not exist."
-                                )
+        form = await get_formular_from_db(form_id)
 
         # Verify if it's the owner of the form
         if form.owner_id != user_id:
@@ -345,46 +423,23 @@ async def get_submission_pdf(
             # Checks if the form belongs to the user
 
         # Reads the form submit from the database
-        form_submission = form_submits_container.read_item(
-            item=form_submission_id,
-            partition_key=form_submission_id,
-        )
+        form_submission = await storage.submissions.get(form_submission_id, form_id)
 
-        form_submission = FormSubmissionInDB(**form_submission)
-
-        if form_submission.form_id != form.id:
+        if form_submission['form_id'] != form.id:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                                 detail="Forms id is not the same as form submission id")
 
-        pdf = fpdf.FPDF()
-
-        pdf.add_page()
-
-        pdf.set_font("Arial", size=20)
+        # The PDF is private, the browser can keep it but has to check if it changed
+        headers = {'ETag': get_pdf_etag(form, form_submission), 'Cache-Control': 'private, no-cache'}
 
-        pdf.cell(200, 10, txt=form.title, ln=1, align='C')
-        pdf.cell(200, 10, txt=' ', ln=1, align='C')
+        if if_none_match == headers['ETag']:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
 
-        pdf.set_font("Arial", size=15)
+        pdf_bytes = await get_submission_pdf_bytes(form, form_submission)
 
-        for section in form.sections:
-            text = section.text
-
-            for field in form_submission.completed_dynamic_fields:
-                completed_value = form_submission.completed_dynamic_fields[field]
-                field_token_in_text = '{' + field + '}'
-
-                text = text.replace(field_token_in_text, str(completed_value))
-
-            pdf.cell(200, 10, txt=text, ln=1, align='L')
-
-        pdf.output("./generated_data/completed_form.pdf")
-
-        pdf.close()
-
-        with open("./generated_data/completed_form.pdf", 'rb') as file:
-            headers = {'Content-Disposition': 'attachment; filename="out.pdf"'}
-            return Response(file.read(), headers=headers, media_type='application/pdf')
+        headers['Content-Disposition'] = 'attachment; filename="out.pdf"'
+        return Response(pdf_bytes, headers=headers, media_type='application/pdf')
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-
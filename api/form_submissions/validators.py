@@ -0,0 +1,185 @@
+"""
+Submission validators compiled once per form.
+
+A validator is a list of (placeholder, mandatory, coerce function) built from the form's dynamic fields,
+so validating a submission is a loop over that list. It is stored on the cached form object, so it's
+rebuilt only when the form changes.
+"""
+import datetime
+import math
+import re
+from typing import Any, Callable
+
+from ..forms.models import FormularInDB, DynamicFieldData, FieldType
+from .exceptions import UnfilledFields, InvalidFieldValues
+
+accepted_date_formats = ('%Y-%m-%d', '%d.%m.%Y', '%d/%m/%Y', '%d-%m-%Y')
+
+# Only digits, int() would also accept forms like '1_000'
+whole_number_pattern = re.compile(r'[+-]?\d+', re.ASCII)
+
+
+class InvalidValue(ValueError):
+    pass
+
+
+def is_empty(value: Any) -> bool:
+    return value is None or value == '' or value == [] or value == {}
+
+
+def coerce_text(value: Any) -> str:
+    if isinstance(value, (dict, list)):
+        raise InvalidValue("must be a text")
+
+    return str(value)
+
+
+def coerce_number(value: Any) -> int:
+    if isinstance(value, bool):
+        raise InvalidValue("must be a whole number")
+
+    if isinstance(value, int):
+        return value
+
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+
+    if isinstance(value, str) and whole_number_pattern.fullmatch(value.strip()):
+        digits = value.strip().lstrip('+-')
+
+        # A code like a phone number or a CNP would lose its leading zeros as a number
+        if len(digits) > 1 and digits.startswith('0'):
+            raise InvalidValue("must be a whole number without leading zeros, use a text field for codes")
+
+        return int(value.strip())
+
+    raise InvalidValue("must be a whole number")
+
+
+def coerce_decimal(value: Any) -> float:
+    if isinstance(value, bool):
+        raise InvalidValue("must be a number")
+
+    number = None
+
+    try:
+        if isinstance(value, (int, float)):
+            number = float(value)
+
+        if isinstance(value, str):
+            # Both 3.5 and 3,5 are used
+            number = float(value.strip().replace(',', '.'))
+    except (ValueError, OverflowError):
+        pass
+
+    # 'nan' and 'inf' are floats too, but they can't be saved or sent as JSON
+    if number is None or not math.isfinite(number):
+        raise InvalidValue("must be a number")
+
+    return number
+
+
+def coerce_date(value: Any) -> str:
+    """Accepts the usual date formats and returns the date as YYYY-MM-DD."""
+
+    if isinstance(value, str):
+        for date_format in accepted_date_formats:
+            try:
+                return datetime.datetime.strptime(value.strip(), date_format).date().isoformat()
+            except ValueError:
+                continue
+
+    raise InvalidValue("must be a date, like 2023-03-19 or 19.03.2023")
+
+
+def make_single_choice_coercer(options: list[str]) -> Callable[[Any], str]:
+    valid_options = frozenset(options)
+
+    def coerce_single_choice(value: Any) -> str:
+        if isinstance(value, (list, dict)) or str(value) not in valid_options:
+            raise InvalidValue(f"must be one of {options}")
+
+        return str(value)
+
+    return coerce_single_choice
+
+
+def make_multiple_choice_coercer(options: list[str]) -> Callable[[Any], list[str]]:
+    valid_options = frozenset(options)
+
+    def coerce_multiple_choice(value: Any) -> list[str]:
+        values = value if isinstance(value, list) else [value]
+        chosen = list(dict.fromkeys(str(item) for item in values))
+
+        if any(item not in valid_options for item in chosen):
+            raise InvalidValue(f"must be a list of options from {options}")
+
+        return chosen
+
+    return coerce_multiple_choice
+
+
+def make_coercer(field: DynamicFieldData) -> Callable[[Any], Any]:
+    if field.type == FieldType.single_choice:
+        return make_single_choice_coercer(field.options or [])
+
+    if field.type == FieldType.multiple_choice:
+        return make_multiple_choice_coercer(field.options or [])
+
+    return {
+        FieldType.text: coerce_text,
+        FieldType.number: coerce_number,
+        FieldType.decimal: coerce_decimal,
+        FieldType.data: coerce_date,
+    }[field.type]
+
+
+class SubmissionValidator:
+
+    def __init__(self, form: FormularInDB):
+        self.checks = tuple((field.placeholder, field.mandatory, make_coercer(field)) for field in form.dynamic_fields)
+
+    def validate(self, completed_dynamic_fields: dict) -> dict:
+        """
+        Checks the completed values against the form's fields.
+
+        :return: The completed values converted to the types of the fields (numbers, decimals, dates as
+        YYYY-MM-DD, choices as the option strings). Values for fields the form doesn't have are kept as they are.
+        :raises UnfilledFields if a mandatory field is missing or empty.
+        :raises InvalidFieldValues if a value doesn't match the type or the options of its field.
+        """
+
+        normalized = dict(completed_dynamic_fields)
+        unfilled_fields = []
+        errors = {}
+
+        for placeholder, mandatory, coerce in self.checks:
+            value = completed_dynamic_fields.get(placeholder)
+
+            if is_empty(value):
+                if mandatory:
+                    unfilled_fields.append(placeholder)
+
+                continue
+
+            try:
+                normalized[placeholder] = coerce(value)
+            except InvalidValue as e:
+                errors[placeholder] = str(e)
+
+        if unfilled_fields:
+            raise UnfilledFields(unfilled_fields)
+
+        if errors:
+            raise InvalidFieldValues(errors)
+
+        return normalized
+
+
+def get_submission_validator(form: FormularInDB) -> SubmissionValidator:
+    """Returns the validator of the form, compiling it the first time."""
+
+    if form._submission_validator is None:
+        form._submission_validator = SubmissionValidator(form)
+
+    return form._submission_validator
@@ -4,6 +4,10 @@ invalid_data_retention_period = HTTPException(
     status_code=status.HTTP_400_BAD_REQUEST,
     detail="'data_retention_period' should should be between 1 and 60.")
 
+invalid_continuation_token = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail="Invalid 'continuation_token', use the one from the previous page.")
+
 
 class UnspecifiedField(HTTPException):
     def __init__(self, field: str):
@@ -1,14 +1,15 @@
 
 import uuid
 
-from fastapi import APIRouter, Depends, Path
-from ..database.cosmo_db import forms_container
+from fastapi import APIRouter, Depends, Path, Query, Response, status
+from ..database.storage import storage
 from .models import FormularInDB, FormularCreate, FormularUpdate, PaginatedFormularResponse
 from ..authentication.encryption import get_current_user
 from ..users.models import User
-from .functions import get_formular_from_db, get_short_user_forms_from_db, validate_form_data
+from .functions import get_formular_from_db, get_short_user_forms_from_db, validate_form_data, \
+    invalidate_cached_formular
 from .exceptions import *
-from ..form_submissions.functions import delete_all_forms_submission
+from ..form_submissions.functions import delete_all_forms_submission, start_form_submissions_deletion
 router = APIRouter(
     prefix="/api/v1/users/{user_id}/forms"
 )
@@ -27,16 +28,17 @@ async def create_new_form(
                                    " user that's logged in.")
 
     # Validate the given form data
-    validate_form_data(new_from)
+    compiled_sections = validate_form_data(new_from)
 
     new_form_id = str(uuid.uuid4())
 
     formular = FormularInDB(id=new_form_id,
                             owner_id=user_id,
+                            compiled_sections=compiled_sections,
                             **new_from.dict())
 
     # The new item created doesn't include empty values
-    forms_container.create_item(
+    await storage.forms.create(
         formular.dict(exclude_none=True)
     )
 
@@ -54,18 +56,21 @@ async def edit_form_data(
 
     # Try to see if the form exists, there is no function to only update for the CosmoDB, only upsert
     # and we don't want to create a new form with an id given by the user
-    form = get_formular_from_db(form_id)
+    form = await get_formular_from_db(form_id)
 
     if form.owner_id != user_id or user_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You can modify only your own forms.")
 
-    validate_form_data(updated_from)
+    compiled_sections = validate_form_data(updated_from)
 
     form_to_save = FormularInDB(id=form_id,
                                 owner_id=user_id,
+                                compiled_sections=compiled_sections,
                                 **updated_from.dict(exclude_none=True))
 
-    forms_container.upsert_item(form_to_save.dict(exclude_none=True))
+    await storage.forms.upsert(form_to_save.dict(exclude_none=True))
+
+    invalidate_cached_formular(form_id)
 
     return form_to_save
 
@@ -74,13 +79,17 @@ async def edit_form_data(
             tags=['forms'])
 async def get_all_user_forms_description(
         user_id: str,
+        page_size: int = Query(default=100, ge=1, le=1000,
+                               description="The maximum number of forms to return."),
+        continuation_token: str | None = Query(default=None,
+                                               description="The 'continuation_token' from the previous page."),
         current_user: User = Depends(get_current_user)
 ) -> PaginatedFormularResponse:
 
     if user_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You can view only your own forms.")
 
-    forms = get_short_user_forms_from_db(user_id)
+    forms = await get_short_user_forms_from_db(user_id, page_size, continuation_token)
 
     return forms
 
@@ -95,12 +104,16 @@ async def get_form_data(
 ) -> FormularInDB:
 
     # All users should be allowed to fetch a form, so they can complete it
-    return get_formular_from_db(form_id)
+    return await get_formular_from_db(form_id)
 
 
 @router.delete(path="/{form_id}",
                tags=['forms'])
 async def delete_form(
+        response: Response,
+        wait: bool = Query(default=True,
+                           description="With false, the form and its submissions are deleted by a background job,"
+                                       " the response is 202 and the 'Location' header is the job."),
         user_id: str = Path(example="c6c1b8ae-44cd-4e83-a5f9-d6bbc8eeebcf",
                             description="The id of the user."),
         form_id: str = Path(example="67b64054-db84-489a-af92-fe87f9be9899",
@@ -113,20 +126,28 @@ async def delete_form(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You can delete only your own data.")
         # Verifies if the owner is the form and the user are the same
 
-    form = get_formular_from_db(form_id)
+    form = await get_formular_from_db(form_id)
     # Retrieves the form from the database
 
     if form.owner_id != user_id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You can delete only your own forms.")
         # Checks if the form belongs to the user
 
+    if not wait:
+        # The job deletes the form, then its submissions, it's run again if the server stops before it finishes
+        job = await start_form_submissions_deletion(form_id, user_id, delete_form=True)
+
+        response.status_code = status.HTTP_202_ACCEPTED
+        response.headers['Location'] = f'/api/v1/jobs/{job.id}'
+
+        return form
+
     await delete_all_forms_submission(form_id, user_id)
     # Before deleting the form it will delete all the form submissions
 
-    forms_container.delete_item(
-        item=form_id,
-        partition_key=form_id,
-    )
+    await storage.forms.delete(form_id)
     # Deletes the form from the database and returns it
 
+    invalidate_cached_formular(form_id)
+
     return form
@@ -1,15 +1,41 @@
+import os
+import re
 import time
-import azure.cosmos.exceptions
 
 from fastapi import HTTPException, status
 
-from ..database.cosmo_db import forms_container
+from ..database.exceptions import ItemNotFoundError, InvalidContinuationTokenError
+from ..database.storage import storage
+from ..utility.cache import TTLCache, SingleFlight
+from ..utility.metrics import register_metrics
 from .models import FormularInDB, FormularCreate, PaginatedFormularResponse, FieldType
-from .exceptions import invalid_data_retention_period, NoFieldOptionsProvided, NoFieldKeywordsProvided, UnspecifiedField
+from .exceptions import invalid_data_retention_period, invalid_continuation_token, NoFieldOptionsProvided, \
+    NoFieldKeywordsProvided, UnspecifiedField
 
+FORMS_CACHE_SIZE = int(os.getenv('FORMS_CACHE_SIZE', 1_000))
+FORMS_CACHE_TTL_SECONDS = float(os.getenv('FORMS_CACHE_TTL_SECONDS', 300))
 
-def validate_form_data(form: FormularCreate):
-    """Takes a form and validates if it's data is correct."""
+# Forms are read on every submission, but rarely change, so the parsed forms are kept in memory.
+# Editing or deleting a form invalidates it, the other workers see the change after at most the TTL.
+forms_cache = TTLCache(max_size=FORMS_CACHE_SIZE, ttl_seconds=FORMS_CACHE_TTL_SECONDS)
+
+# When a form is shared, many requests miss the cache at the same time, they all wait for one database read
+forms_reads = SingleFlight()
+
+register_metrics('forms_cache', forms_cache.stats)
+register_metrics('forms_reads', forms_reads.stats)
+
+
+# A placeholder is a field name between braces, like {nume}
+placeholder_pattern = re.compile(r'{([^{}]+)}')
+
+
+def validate_form_data(form: FormularCreate) -> list[list[str]]:
+    """
+    Takes a form and validates if it's data is correct.
+
+    :return: The compiled sections of the form, to be saved with it.
+    """
 
     # data_retention_period should be between 1 and 60 days
 
@@ -30,62 +56,122 @@ def validate_form_data(form: FormularCreate):
                 and not field_data.keywords:
             raise NoFieldKeywordsProvided(field_data.placeholder, field_data.type.value)
 
-    # All placeholder keywords declared in the RTF text sections must be specified in the dynamic fields
-    for section in form.sections:
-        section_fields = get_tokens_from_rtf_text(section.text)
+    compiled_sections = compile_form_sections(form)
 
-        for field in section_fields:
+    # All placeholder keywords declared in the RTF text sections must be specified in the dynamic fields
+    for segments in compiled_sections:
+        for field in segments[1::2]:
             if field not in valid_fields:
                 raise UnspecifiedField(field)
 
+    return compiled_sections
 
-def get_formular_from_db(form_id: str) -> FormularInDB:
+
+async def get_formular_from_db(form_id: str) -> FormularInDB:
     """
-    Fetches the form data from the database.
+    Fetches the form data from the cache, or from the database if it's not cached.
+    The returned object is shared by all the requests, so it must not be modified.
 
     :param form_id: The ID of the form you want to get the data for.
     :return: The FormularInDB object.
     :raises HTTPException the form could not be found.
     """
+
+    form = forms_cache.get(form_id)
+
+    if form is not None:
+        return form
+
+    return await forms_reads.run(form_id, lambda: read_formular_into_cache(form_id))
+
+
+async def read_formular_into_cache(form_id: str) -> FormularInDB:
+    """
+    Reads the form from the database and caches it.
+
+    :raises HTTPException the form could not be found.
+    """
+
+    generation = forms_cache.generation
+
     try:
-        form = forms_container.read_item(
-            item=form_id,
-            partition_key=form_id,
-        )
+        form_dict = await storage.forms.get(form_id)
 
-    except azure.cosmos.exceptions.CosmosResourceNotFoundError:
+    except ItemNotFoundError:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Form '{form_id}' does not exist."
                             )
 
-    return FormularInDB(**form)
+    form = FormularInDB(**form_dict)
+    form._etag = form_dict.get('_etag')
+
+    # Forms saved before the sections were compiled
+    if form.compiled_sections is None:
+        form.compiled_sections = compile_form_sections(form)
+
+    forms_cache.set(form_id, form, generation)
+
+    return form
+
+
+def invalidate_cached_formular(form_id: str) -> None:
+    """Removes the form from the cache, after it was modified or deleted."""
 
+    forms_cache.invalidate(form_id)
+    forms_reads.forget(form_id)
 
-def get_short_user_forms_from_db(user_id: str) -> PaginatedFormularResponse:
+
+async def get_short_user_forms_from_db(user_id: str, page_size: int,
+                                       continuation_token: str | None = None) -> PaginatedFormularResponse:
     """
-    Returns the id and title of all the forms of the user.
+    Returns the id and title of the forms of the user, one page at a time.
 
     :param user_id: The id of the user to get the forms of
+    :param page_size: The maximum number of forms to return
+    :param continuation_token: The token returned with the previous page, None for the first page
+
+    :return: The list of forms and the token for the next page
+    :raises HTTPException if the continuation token is invalid.
+    """
+
+    try:
+        page = await storage.forms.list_short_by_owner(user_id, page_size, continuation_token)
+    except InvalidContinuationTokenError:
+        raise invalid_continuation_token
 
-    :return: The list of forms
+    return PaginatedFormularResponse(form_list=page.items, continuation_token=page.continuation_token)
+
+
+def compile_section_text(text: str) -> list[str]:
     """
+    Splits the text of a section in literal chunks and placeholders, in one pass, so it doesn't have to be
+    parsed again when it's validated or rendered.
 
-    # When getting the user it will be possible to search with both name or email
-    # So we can each by both at once, and works correctly
+    Example: "Studentul {nume}, grupa {grupa}." => ['Studentul ', 'nume', ', grupa ', 'grupa', '.']
 
-    query = """SELECT form.id, form.title
-                    FROM c form 
-                    WHERE form.owner_id = @user_id"""
+    :param text: Text in RFT format
+    :return: The literal chunks on the even positions and the field names on the odd positions
+    """
 
-    params = [dict(name="@user_id", value=user_id)]
+    return placeholder_pattern.split(text)
 
-    results = forms_container.query_items(query=query,
-                                          parameters=params,
-                                          enable_cross_partition_query=True)
 
-    items = list(results)
+def compile_form_sections(form: FormularCreate) -> list[list[str]]:
+    return [compile_section_text(section.text) for section in form.sections]
 
-    return PaginatedFormularResponse(form_list=items)
+
+def render_compiled_section(segments: list[str], completed_fields: dict) -> str:
+    """
+    Replaces the placeholders of a compiled section with the completed values.
+    Placeholders without a value are left as they are in the text.
+    """
+
+    return ''.join(
+        segment if i % 2 == 0
+        else str(completed_fields[segment]) if segment in completed_fields
+        else '{' + segment + '}'
+        for i, segment in enumerate(segments)
+    )
 
 
 def get_tokens_from_rtf_text(text: str):
@@ -95,16 +181,5 @@ def get_tokens_from_rtf_text(text: str):
     :param text: Text in RFT format
     :return: a list of tokens extracted from the text
     """
-    tokens = []
-    token = ""
-
-    for letter in text:
-        if letter == '{':
-            token = ''
-
-        if letter == '}' and len(token) > 1:
-            tokens.append(token[1:])
-
-        token += letter
 
-    return tokens
+    return compile_section_text(text)[1::2]
@@ -1,6 +1,6 @@
 from enum import Enum
 
-from pydantic import BaseModel,  validator
+from pydantic import BaseModel, Field, PrivateAttr, validator
 from typing import Optional
 
 
@@ -76,6 +76,17 @@ class FormularInDB(FormularCreate):
     """How the formular is stored in the database."""
     id: str
     owner_id: str
+    compiled_sections: Optional[list[list[str]]] = Field(
+        default=None,
+        description="The text of every section split in literal chunks (even positions) and field placeholders"
+                    " (odd positions). Computed when the form is saved.")
+
+    # The submission validator compiled for this version of the form, see form_submissions/validators.py
+    _submission_validator = PrivateAttr(default=None)
+    # The keywords of the fields compiled for the autofill, see form_submissions/autofill.py
+    _keyword_index = PrivateAttr(default=None)
+    # The '_etag' of the database item the form was read from, it changes on every write of the form
+    _etag: Optional[str] = PrivateAttr(default=None)
 
     class Config:
         schema_extra = {
@@ -94,6 +105,11 @@ class FormularInDB(FormularCreate):
                         "text": "Cu CNP {cnp}, seria {seria}, nr {nr_carte_identitate}."
                     }
                 ],
+                "compiled_sections": [
+                    ["Studentul ", "nume", " ", "prenume", ", din grupa ", "grupa", ", anul ", "anul",
+                     ". Aleg optiunea ", "opt1", "."],
+                    ["Cu CNP ", "cnp", ", seria ", "seria", ", nr ", "nr_carte_identitate", "."]
+                ],
                 "dynamic_fields": [
                     {"label": "First name", "placeholder": "nume", "type": "text",
                      "keywords": ["name", "nume", "first_name"], "mandatory": True},
@@ -125,3 +141,6 @@ class ShortForm(BaseModel):
 class PaginatedFormularResponse(BaseModel):
     """The list of forms to send when the user is browsing the forms they created"""
     form_list: list[ShortForm]
+    continuation_token: Optional[str] = Field(
+        default=None,
+        description="Send it back to get the next page. It's missing on the last page.")
@@ -0,0 +1,52 @@
+from fastapi import APIRouter, Depends, HTTPException, Path, status
+
+from .models import Job
+from .runner import job_runner, get_job_from_db
+from ..authentication.encryption import get_current_user
+from ..database.exceptions import ItemNotFoundError
+from ..users.models import User
+
+router = APIRouter(
+    prefix="/api/v1/jobs"
+)
+
+
+async def get_own_job(job_id: str, current_user: User) -> Job:
+    """
+    :raises HTTPException if the job doesn't exist or was started by someone else
+    """
+
+    try:
+        job = await get_job_from_db(job_id)
+    except ItemNotFoundError:
+        job = None
+
+    # The jobs of other people are reported as missing, so their ids can't be guessed
+    if job is None or job.owner_id != current_user.id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job '{job_id}' does not exist.")
+
+    return job
+
+
+@router.get(path="/{job_id}",
+            tags=['jobs'],
+            description="The status, progress and result of a background job you started.")
+async def get_job(
+        job_id: str = Path(example="5f0c6a8e-3d0e-4f57-a3a9-2b8f0f1d6c11",
+                           description="The id of the job."),
+        current_user: User = Depends(get_current_user)
+) -> Job:
+    return await get_own_job(job_id, current_user)
+
+
+@router.delete(path="/{job_id}",
+               tags=['jobs'],
+               description="Cancels a queued or running job. The work it already did is not undone.")
+async def cancel_job(
+        job_id: str = Path(example="5f0c6a8e-3d0e-4f57-a3a9-2b8f0f1d6c11",
+                           description="The id of the job."),
+        current_user: User = Depends(get_current_user)
+) -> Job:
+    job = await get_own_job(job_id, current_user)
+
+    return await job_runner.cancel(job)
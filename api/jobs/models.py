@@ -0,0 +1,56 @@
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class JobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+    cancelled = "cancelled"
+
+
+finished_job_statuses = {JobStatus.succeeded, JobStatus.failed, JobStatus.cancelled}
+
+
+class Job(BaseModel):
+    id: str
+    kind: str
+    # None for the jobs started by the server, like the expiry sweeps
+    owner_id: Optional[str] = None
+    params: dict = {}
+    status: JobStatus = JobStatus.queued
+    attempts: int = 0
+    max_attempts: int = 3
+    # Updated by the job while it runs, for example {"total": 1200, "deleted": 300}
+    progress: dict = {}
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    cancel_requested: bool = False
+    created_at: int
+    started_at: Optional[int] = None
+    finished_at: Optional[int] = None
+    updated_at: int
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "id": "5f0c6a8e-3d0e-4f57-a3a9-2b8f0f1d6c11",
+                "kind": "delete_form_submissions",
+                "owner_id": "c6c1b8ae-44cd-4e83-a5f9-d6bbc8eeebcf",
+                "params": {"form_id": "67b64054-db84-489a-af92-fe87f9be9899"},
+                "status": "running",
+                "attempts": 1,
+                "max_attempts": 3,
+                "progress": {"total": 1200, "deleted": 300},
+                "result": None,
+                "error": None,
+                "cancel_requested": False,
+                "created_at": 1678028760,
+                "started_at": 1678028761,
+                "finished_at": None,
+                "updated_at": 1678028763,
+            }
+        }
@@ -0,0 +1,433 @@
+"""
+Runs the long operations in the background, off the request path.
+
+A job is a record in storage.jobs and a coroutine function registered for its kind. The request that starts a job
+only saves the record and returns it, a few workers run the queued jobs one at a time each, so at most
+JOB_WORKERS long operations run at the same time.
+The workers save the progress of the running jobs every few seconds, try the failed jobs again and stop the
+cancelled ones. The jobs that were queued or running when a server stopped are run again when it starts, and every
+JOB_STALE_SECONDS the servers look for the jobs that stopped being saved, so the job functions must be safe to run
+more than once.
+A worker claims a job by saving it as running only if it wasn't written since it was read, with its '_etag', and
+every later save of the job is conditional the same way, so a job is run by one worker at a time and a cancellation
+saved by another server isn't overwritten.
+The periodic operations, like the expiry sweep, are registered with 'every', the runner submits their jobs while it
+runs. The exports and the ZIP of the PDFs aren't jobs, they are streamed to the client while they are made, so they
+don't keep the whole file anywhere.
+"""
+import asyncio
+import os
+import time
+import traceback
+import uuid
+from typing import Awaitable, Callable
+
+from .models import Job, JobStatus, finished_job_statuses
+from ..database.exceptions import ItemNotFoundError, ItemModifiedError
+from ..database.storage import storage
+from ..utility.metrics import register_metrics
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+# How often the progress of a running job is saved, which is also when the cancellation from another server is seen
+JOB_PROGRESS_SAVE_SECONDS = 2
+# A running job that wasn't saved for this long belonged to a server that stopped, it's run again
+JOB_STALE_SECONDS = 60
+# The wait before the first retry of a failed job, doubled for every retry after it
+JOB_RETRY_SECONDS = 5
+# How long the finished jobs are kept, only with Cosmos, which deletes them by their ttl
+JOB_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+# Gets the params of the job and a progress dictionary it can update while it runs, returns the result
+JobFunction = Callable[[dict, dict], Awaitable[dict | None]]
+
+
+class JobRunner:
+
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = workers
+
+        self.job_functions: dict[str, JobFunction] = {}
+
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+        self.cancelled = 0
+
+        self._queue: asyncio.Queue[str] | None = None
+        self._worker_tasks: list[asyncio.Task] = []
+        # The rescan of the stale jobs and the periodic jobs
+        self._scheduler_tasks: list[asyncio.Task] = []
+        # (kind, interval in seconds, the options of submit) of the jobs submitted periodically
+        self._schedules: list[tuple[str, float, dict]] = []
+        # job id -> the task running the job function on this server
+        self._running: dict[str, asyncio.Task] = {}
+        # job id -> the '_etag' of the last save of the job running on this server
+        self._etags: dict[str, str] = {}
+        # The running jobs cancelled by their owner, the other cancelled tasks are stopped by the shutdown
+        self._cancelled_ids: set[str] = set()
+        # The running jobs claimed by another server, which thought this one stopped, they are stopped without saving
+        self._lost_ids: set[str] = set()
+        self._retry_tasks: set[asyncio.Task] = set()
+
+    def job(self, kind: str) -> Callable[[JobFunction], JobFunction]:
+        """Registers the decorated coroutine function as the one that runs the jobs of this kind."""
+
+        def register(function: JobFunction) -> JobFunction:
+            self.job_functions[kind] = function
+            return function
+
+        return register
+
+    def every(self, kind: str, interval_seconds: float, params: dict | None = None, **submit_options):
+        """
+        Submits a job of this kind every interval_seconds while the runner runs, the first one when it starts.
+        A new job isn't submitted while the previous one isn't finished.
+
+        Example: job_runner.every('expire_submissions', 5 * 60, max_attempts=1)
+        """
+
+        self._schedules.append((kind, interval_seconds, dict(params=params or {}, **submit_options)))
+
+    async def start(self):
+        """Starts the workers and queues the jobs left unfinished by the servers that stopped."""
+
+        self._queue = asyncio.Queue()
+        self._worker_tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+        await self._queue_unfinished(all_queued=True)
+
+        self._scheduler_tasks = [asyncio.create_task(self._rescan()),
+                                 *(asyncio.create_task(self._submit_periodically(kind, interval_seconds, options))
+                                   for kind, interval_seconds, options in self._schedules)]
+
+    async def stop(self):
+        """Stops the workers. The running jobs are queued again, to be run when a server starts."""
+
+        tasks = [*self._scheduler_tasks, *self._worker_tasks, *self._retry_tasks]
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        self._worker_tasks = []
+        self._scheduler_tasks = []
+        self._queue = None
+
+    async def _submit_periodically(self, kind: str, interval_seconds: float, options: dict):
+        last_job_id = None
+
+        while True:
+            try:
+                # A job that is still running isn't started a second time
+                if last_job_id is None or (await get_job_from_db(last_job_id)).status in finished_job_statuses:
+                    last_job_id = (await self.submit(kind, **options)).id
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # The failed jobs are counted by the runner, the next one tries again
+                traceback.print_exc()
+
+            await asyncio.sleep(interval_seconds)
+
+    async def _queue_unfinished(self, all_queued: bool):
+        """
+        Queues the jobs that weren't saved for JOB_STALE_SECONDS, their server stopped or lost them.
+        The jobs queued by another server are only claimed by one of the workers.
+
+        :param all_queued: If the queued jobs are queued even if they were saved recently, when the server starts
+        """
+
+        for job in await storage.jobs.list_unfinished():
+            job = Job(**job)
+
+            if job.id in self._running:
+                continue
+
+            if (all_queued and job.status == JobStatus.queued) or job.updated_at < time.time() - JOB_STALE_SECONDS:
+                self._queue.put_nowait(job.id)
+
+    async def _rescan(self):
+        while True:
+            await asyncio.sleep(JOB_STALE_SECONDS)
+
+            try:
+                await self._queue_unfinished(all_queued=False)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+
+    async def submit(self, kind: str, params: dict, owner_id: str | None = None, max_attempts: int = 3) -> Job:
+        """Saves a new job and queues it, returns right away."""
+
+        if kind not in self.job_functions:
+            raise ValueError(f"Unknown job kind '{kind}'.")
+
+        now = int(time.time())
+        job = Job(id=str(uuid.uuid4()), kind=kind, owner_id=owner_id, params=params, max_attempts=max_attempts,
+                  created_at=now, updated_at=now)
+
+        await save_job(job)
+
+        if self._queue is not None:
+            self._queue.put_nowait(job.id)
+
+        return job
+
+    async def cancel(self, job: Job) -> Job:
+        """
+        Cancels a queued or running job. A job running on another server is stopped when it saves its progress.
+        """
+
+        task = self._running.get(job.id)
+
+        if task is not None:
+            # The worker saves the cancelled job
+            if job.status not in finished_job_statuses:
+                job.cancel_requested = True
+                self._cancelled_ids.add(job.id)
+                task.cancel()
+
+            return job
+
+        while True:
+            item = await storage.jobs.get(job.id)
+            job = Job(**item)
+
+            if job.status in finished_job_statuses:
+                return job
+
+            job.cancel_requested = True
+
+            if job.status == JobStatus.queued:
+                finish_job(job, JobStatus.cancelled)
+
+            try:
+                await save_job(job, item['_etag'])
+            except ItemModifiedError:
+                # Claimed or saved by a worker in the meantime
+                continue
+
+            if job.status == JobStatus.cancelled:
+                self.cancelled += 1
+
+            return job
+
+    async def _work(self):
+        while True:
+            job_id = await self._queue.get()
+
+            try:
+                await self._run(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Only the errors of the storage get here, the ones of the jobs are saved in the job
+                traceback.print_exc()
+
+    async def _claim(self, job_id: str) -> Job | None:
+        """
+        Saves the job as running if it wasn't written since it was read.
+        Returns None if the job doesn't need to run or if another worker claimed it first.
+        """
+
+        try:
+            item = await storage.jobs.get(job_id)
+        except ItemNotFoundError:
+            return None
+
+        job = Job(**item)
+
+        if job.status in finished_job_statuses or job_id in self._running:
+            return None
+
+        # Running on another server, which still saves its progress
+        if job.status == JobStatus.running and job.updated_at >= time.time() - JOB_STALE_SECONDS:
+            return None
+
+        if job.cancel_requested:
+            finish_job(job, JobStatus.cancelled)
+        elif job.kind not in self.job_functions:
+            job.error = f"Unknown job kind '{job.kind}'."
+            finish_job(job, JobStatus.failed)
+        else:
+            job.status = JobStatus.running
+            job.attempts += 1
+            job.started_at = job.started_at or int(time.time())
+            job.error = None
+
+        try:
+            etag = await save_job(job, item['_etag'])
+        except (ItemModifiedError, ItemNotFoundError):
+            return None
+
+        if job.status == JobStatus.cancelled:
+            self.cancelled += 1
+            return None
+
+        if job.status == JobStatus.failed:
+            self.failed += 1
+            return None
+
+        self._etags[job_id] = etag
+
+        return job
+
+    async def _save(self, job: Job) -> bool:
+        """
+        Saves the job running on this server, keeping the cancellation saved by another server in the meantime.
+        Returns False if another server claimed the job since.
+        """
+
+        while True:
+            try:
+                self._etags[job.id] = await save_job(job, self._etags[job.id])
+                return True
+            except ItemModifiedError:
+                pass
+            except ItemNotFoundError:
+                return False
+
+            try:
+                item = await storage.jobs.get(job.id)
+            except ItemNotFoundError:
+                return False
+
+            stored = Job(**item)
+
+            # Every claim is a new attempt
+            if stored.attempts != job.attempts:
+                return False
+
+            job.cancel_requested = job.cancel_requested or stored.cancel_requested
+            self._etags[job.id] = item['_etag']
+
+    async def _run(self, job_id: str):
+        job = await self._claim(job_id)
+
+        if job is None:
+            return
+
+        task = asyncio.create_task(self.job_functions[job.kind](job.params, job.progress))
+        self._running[job_id] = task
+        saver = asyncio.create_task(self._save_progress(job, task))
+
+        try:
+            job.result = await task
+        except asyncio.CancelledError:
+            if job_id in self._lost_ids:
+                return
+
+            if job_id not in self._cancelled_ids:
+                # The server is stopping, the job is run again when a server starts
+                job.status = JobStatus.queued
+                await asyncio.shield(self._save(job))
+                raise
+
+            job.cancel_requested = True
+            finish_job(job, JobStatus.cancelled)
+            self.cancelled += 1
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+
+            if job.attempts < job.max_attempts:
+                job.status = JobStatus.queued
+                self.retried += 1
+                self._retry_later(job_id, JOB_RETRY_SECONDS * 2 ** (job.attempts - 1))
+            else:
+                finish_job(job, JobStatus.failed)
+                self.failed += 1
+        else:
+            finish_job(job, JobStatus.succeeded)
+            self.succeeded += 1
+        finally:
+            # Waits for the progress being saved, so it doesn't overwrite the final status
+            saver.cancel()
+            await asyncio.gather(saver, return_exceptions=True)
+
+            self._running.pop(job_id, None)
+            self._cancelled_ids.discard(job_id)
+
+            if job_id in self._lost_ids:
+                self._lost_ids.discard(job_id)
+                self._etags.pop(job_id, None)
+
+        await self._save(job)
+        self._etags.pop(job_id, None)
+
+    async def _save_progress(self, job: Job, task: asyncio.Task):
+        while True:
+            await asyncio.sleep(JOB_PROGRESS_SAVE_SECONDS)
+
+            if not await self._save(job):
+                self._lost_ids.add(job.id)
+                task.cancel()
+                return
+
+            # The cancellation can be saved by another server, the save then sees it
+            if job.cancel_requested:
+                self._cancelled_ids.add(job.id)
+                task.cancel()
+                return
+
+    def _retry_later(self, job_id: str, delay_seconds: float):
+        async def retry():
+            await asyncio.sleep(delay_seconds)
+
+            if self._queue is not None:
+                self._queue.put_nowait(job_id)
+
+        task = asyncio.create_task(retry())
+        self._retry_tasks.add(task)
+        task.add_done_callback(self._retry_tasks.discard)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "running": len(self._running),
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "retried": self.retried,
+            "cancelled": self.cancelled,
+        }
+
+
+def finish_job(job: Job, job_status: JobStatus):
+    job.status = job_status
+    job.finished_at = int(time.time())
+
+
+async def save_job(job: Job, etag: str | None = None) -> str:
+    """
+    Returns the new '_etag' of the job.
+
+    :param etag: If given, the job is only saved if it wasn't written since it had this '_etag'
+    :raises ItemModifiedError if the job was written since.
+    """
+
+    job.updated_at = int(time.time())
+
+    item = job.dict()
+
+    if job.status in finished_job_statuses:
+        item['ttl'] = JOB_RETENTION_SECONDS
+
+    if etag is None:
+        return (await storage.jobs.upsert(item))['_etag']
+
+    return (await storage.jobs.replace(item, etag))['_etag']
+
+
+async def get_job_from_db(job_id: str) -> Job:
+    """
+    :raises ItemNotFoundError if the job doesn't exist
+    """
+
+    return Job(**await storage.jobs.get(job_id))
+
+
+job_runner = JobRunner()
+
+register_metrics('jobs', job_runner.stats)
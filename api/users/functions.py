@@ -1,39 +1,52 @@
-from ..database.cosmo_db import users_container
+import asyncio
+import hashlib
+import time
 
+from ..database.exceptions import ItemNotFoundError, ItemAlreadyExistsError, ItemModifiedError
+from ..database.storage import storage
 
-def get_user_by_email_or_name(account_name: str = "", email: str = "") -> dict:
-    """
-    Returns the user data based on an email or account name.
+public_user_fields = ('name', 'email', 'account_type', 'address', 'fiscal_code')
 
-    :param account_name: The account name of the user
-    :param email: The email of the user
-    :return: A dictionary with the user's data
+# A lookup without a user is only taken over after this long, before it may belong to a signup that didn't
+# create its user yet
+ABANDONED_LOOKUP_SECONDS = 60
+
+
+def get_lookup_id(field: str, value: str) -> str:
     """
+    Returns the id of the lookup item for an email or account name.
+    The value is hashed, since the ids in Cosmos can't contain characters like '/', '?' or '#'.
+    """
+
+    return f"{field}-{hashlib.sha256(value.encode()).hexdigest()}"
 
-    # When getting the user it will be possible to search with both name or email
-    # So we can each by both at once, and works correctly
 
-    query = """SELECT user.name, user.email, user.account_type, user.address , user.fiscal_code
-                    FROM c user 
-                    WHERE user.email = @email OR user.name = @name"""
+async def get_user_by_lookup(field: str, value: str) -> dict:
+    """
+    Returns the user with the given email or account name, using the lookup items.
 
-    params = [dict(name="@email", value=email),
-              dict(name="@name", value=account_name)]
+    :param field: 'email' or 'name'
+    :param value: The email or account name
+    :return: A dictionary with the user's data, empty if there is no user
+    """
 
-    results = users_container.query_items(query=query,
-                                          parameters=params,
-                                          enable_cross_partition_query=True,
-                                          max_item_count=1)
+    if not value:
+        return {}
 
-    items = list(results)
+    try:
+        lookup = await storage.user_lookups.get(get_lookup_id(field, value))
+        user = await storage.users.get(lookup['user_id'])
+    except ItemNotFoundError:
+        return {}
 
-    if not items:
+    # Ignore lookups left behind by a write that failed halfway
+    if user.get(field) != value:
         return {}
-    else:
-        return items[0]
 
+    return user
 
-def get_all_user_data_by_email_or_name(email: str = "", account_name: str = "") -> dict:
+
+async def get_all_user_data_by_email_or_name(email: str = "", account_name: str = "") -> dict:
     """
     Returns the user data based on an email.
 
@@ -42,25 +55,102 @@ def get_all_user_data_by_email_or_name(email: str = "", account_name: str = "")
     :return: A dictionary with the user's data
     """
 
-    # When getting the user it will be possible to search with both name or email
-    # So we can each by both at once, and works correctly
+    # Both lookups are point reads, so do them at the same time
+    users = await asyncio.gather(get_user_by_lookup('email', email),
+                                 get_user_by_lookup('name', account_name))
 
-    # Return everything
-    query = """SELECT *
-                    FROM c user 
-                    WHERE user.email = @email OR user.name = @name"""
+    for user in users:
+        if user:
+            return user
 
-    params = [dict(name="@email", value=email),
-              dict(name="@name", value=account_name)]
+    return {}
 
-    results = users_container.query_items(query=query,
-                                          parameters=params,
-                                          enable_cross_partition_query=True,
-                                          max_item_count=1)
 
-    items = list(results)
+async def get_user_by_email_or_name(account_name: str = "", email: str = "") -> dict:
+    """
+    Returns the user data based on an email or account name.
 
-    if not items:
-        return {}
-    else:
-        return items[0]
+    :param account_name: The account name of the user
+    :param email: The email of the user
+    :return: A dictionary with the user's data
+    """
+
+    user = await get_all_user_data_by_email_or_name(email=email, account_name=account_name)
+
+    # Only the public data of the user, without the password
+    return {field: user[field] for field in public_user_fields if field in user}
+
+
+async def take_over_user_lookup(lookup: dict, value: str) -> None:
+    """
+    Called when the lookup of the value already exists. It's kept if it's already the user's, and taken over if it
+    was left behind by a write that failed halfway.
+
+    :raises ItemAlreadyExistsError if the value belongs to another user, or may belong to a write in progress.
+    """
+
+    try:
+        existing = await storage.user_lookups.get(lookup['id'])
+    except ItemNotFoundError:
+        # Removed in the meantime
+        await storage.user_lookups.create(lookup)
+        return
+
+    if existing['user_id'] == lookup['user_id']:
+        return
+
+    # The lookups are added before their user is created or updated, so a lookup whose user doesn't have the value
+    # is only abandoned once it's old enough
+    if existing.get('_ts', 0) > time.time() - ABANDONED_LOOKUP_SECONDS:
+        raise ItemAlreadyExistsError(lookup['id'])
+
+    if await get_user_by_lookup(lookup['field'], value):
+        raise ItemAlreadyExistsError(lookup['id'])
+
+    try:
+        await storage.user_lookups.replace(lookup, existing['_etag'])
+    except (ItemModifiedError, ItemNotFoundError):
+        # Another write took it over or removed it first
+        raise ItemAlreadyExistsError(lookup['id'])
+
+
+async def add_user_lookups(user_id: str, **values: str) -> None:
+    """
+    Reserves the given emails or account names for the user.
+    If one of them is already used by another user, the ones already added are removed.
+
+    Example: await add_user_lookups(user_id, email="a@b.com", name="Vizitiu Valentin")
+
+    :raises ItemAlreadyExistsError if one of the values belongs to another user.
+    """
+
+    added = []
+
+    try:
+        for field, value in values.items():
+            lookup = dict(id=get_lookup_id(field, value), user_id=user_id, field=field)
+
+            try:
+                await storage.user_lookups.create(lookup)
+            except ItemAlreadyExistsError:
+                await take_over_user_lookup(lookup, value)
+
+            added.append(field)
+
+    except ItemAlreadyExistsError:
+        await remove_user_lookups(**{field: values[field] for field in added})
+        raise
+
+
+async def remove_user_lookups(**values: str) -> None:
+    """
+    Frees the given emails or account names.
+
+    Example: await remove_user_lookups(email="a@b.com")
+    """
+
+    for field, value in values.items():
+        try:
+            await storage.user_lookups.delete(get_lookup_id(field, value))
+        except ItemNotFoundError:
+            pass
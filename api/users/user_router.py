@@ -10,9 +10,10 @@ import uuid
 from fastapi import APIRouter, HTTPException, Body, Depends, Path, status
 
 from .models import User, UpdatedUser, NewUser, AccountType
-from .functions import get_user_by_email_or_name
-from ..database.cosmo_db import users_container
-from ..authentication.encryption import get_current_user, get_password_hash
+from .functions import get_user_by_email_or_name, add_user_lookups, remove_user_lookups
+from ..database.exceptions import ItemAlreadyExistsError
+from ..database.storage import storage
+from ..authentication.encryption import get_current_user, get_password_hash, invalidate_cached_user
 
 router = APIRouter(
     prefix="/api/v1/users"
@@ -43,7 +44,7 @@ async def create_new_user(
                             detail=f"Fiscal code for {new_user.account_type} is empty.")
 
     # Try to see if the user already exists
-    user = get_user_by_email_or_name(email=new_user.email,
+    user = await get_user_by_email_or_name(email=new_user.email,
                                      account_name=new_user.name)
 
     # If this is not empty, then a user with that name or email exists
@@ -56,7 +57,7 @@ async def create_new_user(
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=detail)
 
     # Hash the user password
-    new_user.password = get_password_hash(new_user.password)
+    new_user.password = await get_password_hash(new_user.password)
     new_user_id = str(uuid.uuid4())
 
     new_user = User(id=new_user_id, **new_user.dict())
@@ -65,7 +66,18 @@ async def create_new_user(
     if not new_user.fiscal_code:
         del new_user.fiscal_code
 
-    users_container.create_item(new_user.dict())
+    # Reserve the email and name first, so two users created at the same time can't both get them
+    try:
+        await add_user_lookups(new_user_id, email=new_user.email, name=new_user.name)
+    except ItemAlreadyExistsError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f"User with the name '{new_user.name}' or email '{new_user.email}' already exists.")
+
+    try:
+        await storage.users.create(new_user.dict())
+    except Exception:
+        await remove_user_lookups(email=new_user.email, name=new_user.name)
+        raise
 
     return new_user
 
@@ -103,7 +115,7 @@ async def update_user(
 
     # Hash the new password if needed
     if updated_user.password:
-        updated_user.password = get_password_hash(updated_user.password)
+        updated_user.password = await get_password_hash(updated_user.password)
 
     # For the empty values in the updated user, set them the same as the current user's data,
     # so they are not modified
@@ -125,14 +137,14 @@ async def update_user(
 
     # If they modified the email or account name, check if one already exists
     if updated_user.email != current_user.email:
-        user = get_user_by_email_or_name(email=updated_user.email)
+        user = await get_user_by_email_or_name(email=updated_user.email)
 
         if user:
             raise HTTPException(status_code=status.HTTP_409_CONFLICT,
                                 detail=f"User with the email '{updated_user.email}' already exists.")
 
     elif updated_user.name != current_user.name:
-        user = get_user_by_email_or_name(account_name=updated_user.name)
+        user = await get_user_by_email_or_name(account_name=updated_user.name)
 
         if user:
             raise HTTPException(status_code=status.HTTP_409_CONFLICT,
@@ -144,8 +156,28 @@ async def update_user(
 
     updated_user.id = current_user.id
 
+    # Reserve the new email or name before saving, and free the old ones after
+    changed_lookups = {field: getattr(updated_user, field) for field in ('email', 'name')
+                       if getattr(updated_user, field) != getattr(current_user, field)}
+
+    try:
+        await add_user_lookups(current_user.id, **changed_lookups)
+    except ItemAlreadyExistsError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f"User with the name '{updated_user.name}' or email '{updated_user.email}'"
+                                   f" already exists.")
+
     # Now we can save the updated data
-    users_container.upsert_item(updated_user.dict())
+    try:
+        await storage.users.upsert(updated_user.dict())
+    except Exception:
+        await remove_user_lookups(**changed_lookups)
+        raise
+
+    await remove_user_lookups(**{field: getattr(current_user, field) for field in changed_lookups})
+
+    # The tokens are issued for the old email, so that's the cached entry
+    invalidate_cached_user(current_user.email)
 
     return updated_user
 
@@ -163,7 +195,8 @@ async def delete_user(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You can delete only your own data.")
 
     # User is guaranteed to exist, otherwise they cant authenticate
-    users_container.delete_item(
-        item=user_id,
-        partition_key=user_id,
-    )
+    await storage.users.delete(user_id)
+
+    await remove_user_lookups(email=current_user.email, name=current_user.name)
+
+    invalidate_cached_user(current_user.email)
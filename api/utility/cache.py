@@ -0,0 +1,126 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class TTLCache:
+    """
+    An in process cache with a maximum size and a time to live for every entry.
+    When it's full, the least recently used entry is removed.
+    It's only used from the event loop, so it doesn't need locks.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+
+        self.hits = 0
+        self.misses = 0
+
+        # Changes on every invalidation, so a value read from the database before an invalidation isn't cached
+        self.generation = 0
+
+        # key -> (expiration time, value), ordered from the least to the most recently used
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable) -> Any | None:
+        """Returns the cached value, or None if it's missing or expired."""
+
+        entry = self._entries.get(key)
+
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, generation: int | None = None) -> None:
+        """
+        Caches the value.
+
+        :param generation: The cache generation from before the value was read. If an entry was invalidated since
+        then, the value may be stale and is not cached.
+        """
+
+        if self.max_size <= 0 or (generation is not None and generation != self.generation):
+            return
+
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+        self.generation += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.generation += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
+
+
+class SingleFlight:
+    """
+    Makes the concurrent calls for the same key share one execution of a coroutine function.
+    The first caller starts it in a task and the others await the same task, so they get the same result
+    or the same exception. Cancelling one caller doesn't cancel the others.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared_calls = 0
+
+        self._in_flight: dict[Hashable, asyncio.Task] = {}
+
+    async def run(self, key: Hashable, function: Callable[[], Awaitable[Any]]) -> Any:
+        self.calls += 1
+
+        task = self._in_flight.get(key)
+
+        if task is None:
+            task = asyncio.ensure_future(function())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done_task: self._remove(key, done_task))
+        else:
+            self.shared_calls += 1
+
+        return await asyncio.shield(task)
+
+    def forget(self, key: Hashable) -> None:
+        """The next call for the key starts a new execution, even if one is still running."""
+
+        self._in_flight.pop(key, None)
+
+    def _remove(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._in_flight),
+            "calls": self.calls,
+            "shared_calls": self.shared_calls,
+        }
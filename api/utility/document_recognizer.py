@@ -1,14 +1,184 @@
+"""
+Scans the documents with the OCR backend, Azure Form Recognizer or the recorded results, see ocr.py.
+
+The scans are async, so the event loop isn't blocked while Form Recognizer analyzes a document, which
+takes a few seconds. At most DOCUMENT_SCAN_CONCURRENCY documents are analyzed at the same time, the others wait, so
+the scans don't use all the connections and the quota of the resource.
+The results are cached by the SHA-256 of the uploaded document and the model, so scanning the same document again,
+for example the same identity card, returns right away without processing the image or calling Form Recognizer.
+"""
+import asyncio
 import os
+from typing import Awaitable, Callable
+
+from fastapi import HTTPException, UploadFile, status
+
+from .cache import TTLCache, SingleFlight
+from .document_uploads import DOCUMENT_SCAN_BATCH_SIZE, hash_document, read_document
+from .metrics import register_metrics
+from .ocr import ocr, OcrError, OcrThrottledError, OcrUnavailableError
+from ..forms.models import ScannableDocuments
+
+DOCUMENT_MODEL_ID = "prebuilt-document"
+
+DOCUMENT_SCAN_CONCURRENCY = int(os.getenv('DOCUMENT_SCAN_CONCURRENCY', 4))
+# The documents are personal data, so their results are only kept for a few minutes
+DOCUMENT_SCAN_CACHE_SIZE = int(os.getenv('DOCUMENT_SCAN_CACHE_SIZE', 500))
+DOCUMENT_SCAN_CACHE_TTL_SECONDS = float(os.getenv('DOCUMENT_SCAN_CACHE_TTL_SECONDS', 10 * 60))
+# How many times a scan throttled by the OCR backend (429) is tried again
+DOCUMENT_SCAN_MAX_RETRIES = 3
+# The wait before the first retry, when the response doesn't have a Retry-After header, doubled for every retry after it
+DOCUMENT_SCAN_RETRY_SECONDS = 1
+
+# (SHA-256 of the document, model id) -> the key value pairs found in the document
+document_scan_cache = TTLCache(max_size=DOCUMENT_SCAN_CACHE_SIZE, ttl_seconds=DOCUMENT_SCAN_CACHE_TTL_SECONDS)
+document_scans = SingleFlight()
+
+document_scan_stats = {
+    "analyzing": 0,
+    "waiting": 0,
+    "analyzed": 0,
+    "throttled": 0,
+}
+
+register_metrics('document_scan_cache', document_scan_cache.stats)
+register_metrics('document_scans', lambda: dict(document_scan_stats, backend=ocr.backend_name))
+
+_document_scan_semaphore: asyncio.Semaphore | None = None
+
+
+def get_document_scan_semaphore() -> asyncio.Semaphore:
+    # Made on the first scan, so it belongs to the event loop of the app
+    global _document_scan_semaphore
+
+    if _document_scan_semaphore is None:
+        _document_scan_semaphore = asyncio.Semaphore(DOCUMENT_SCAN_CONCURRENCY)
+
+    return _document_scan_semaphore
+
+
+def get_retry_after_seconds(error: OcrThrottledError, attempt: int) -> float:
+    if error.retry_after_seconds is not None:
+        return error.retry_after_seconds
+
+    return DOCUMENT_SCAN_RETRY_SECONDS * 2 ** attempt
+
+
+async def analyze_document(document_hash: str, read_document_content: Callable[[], Awaitable[bytes]],
+                           model_id: str = DOCUMENT_MODEL_ID) -> list[tuple[str, str]]:
+    """
+    Returns the (key, value) pairs found in the document, from the cache or analyzed by Form Recognizer.
+    The concurrent scans of the same document wait for the same analysis.
+
+    :param document_hash: The SHA-256 of the document, the key of the cache
+    :param read_document_content: Returns the document to send to Form Recognizer, only called if it's not cached
+    :raises HTTPException if Form Recognizer is still throttling the scans after the retries, or if it failed.
+    """
+
+    cache_key = (document_hash, model_id)
+
+    key_value_pairs = document_scan_cache.get(cache_key)
+
+    if key_value_pairs is not None:
+        return key_value_pairs
+
+    async def analyze():
+        analyzed_pairs = await analyze_document_with_retries(await read_document_content(), model_id)
+        document_scan_cache.set(cache_key, analyzed_pairs)
+
+        return analyzed_pairs
+
+    return await document_scans.run(cache_key, analyze)
+
+
+async def scan_uploaded_document(document: UploadFile, model_id: str = DOCUMENT_MODEL_ID) -> list[tuple[str, str]]:
+    """
+    Returns the (key, value) pairs found in the uploaded document.
+
+    :raises HTTPException if the document is too large or it couldn't be scanned.
+    """
+
+    document_hash = await hash_document(document)
+
+    return await analyze_document(document_hash, lambda: read_document(document), model_id)
+
+
+async def analyze_document_with_retries(document_content: bytes, model_id: str) -> list[tuple[str, str]]:
+    document_scan_stats["waiting"] += 1
+
+    try:
+        await get_document_scan_semaphore().acquire()
+    finally:
+        document_scan_stats["waiting"] -= 1
+
+    document_scan_stats["analyzing"] += 1
+
+    try:
+        for attempt in range(DOCUMENT_SCAN_MAX_RETRIES + 1):
+            try:
+                key_value_pairs = await ocr.analyze(document_content, model_id)
+                break
+            except OcrThrottledError as e:
+                document_scan_stats["throttled"] += 1
+                retry_after_seconds = get_retry_after_seconds(e, attempt)
+
+                if attempt == DOCUMENT_SCAN_MAX_RETRIES:
+                    raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                        detail="Too many documents are being scanned, try again in a few seconds.",
+                                        headers={"Retry-After": str(int(retry_after_seconds) or 1)})
+
+                await asyncio.sleep(retry_after_seconds)
+            except OcrUnavailableError:
+                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                    detail="The document scanning service can't be reached, try again in a few"
+                                           " seconds.",
+                                    headers={"Retry-After": str(DOCUMENT_SCAN_RETRY_SECONDS)})
+            except OcrError as e:
+                raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY,
+                                    detail=f"The document couldn't be scanned: {e}")
+    finally:
+        document_scan_stats["analyzing"] -= 1
+        get_document_scan_semaphore().release()
+
+    document_scan_stats["analyzed"] += 1
+
+    return key_value_pairs
+
+
+def get_scanned_fields(key_value_pairs: list[tuple[str, str]]) -> dict[str, str]:
+    """Names the values found in the document by the first word of their key."""
+
+    api_result = {}
+
+    for key_content, value_content in key_value_pairs:
+        if '/' in key_content:
+            key_splits = key_content.split('/')
+        else:
+            key_splits = key_content.split()
+
+        if 'Loc nastere' in key_content:
+            clean_key = 'loc nastere'
+        else:
+            clean_key = key_splits[0]
+
+        api_result[clean_key] = value_content
+
+    return api_result
+
 
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.formrecognizer import DocumentAnalysisClient
+async def scan_documents(documents: list[tuple[ScannableDocuments, UploadFile]]
+                         ) -> dict[ScannableDocuments, dict[str, str]]:
+    """
+    Scans all the documents at the same time, so it takes about as long as the slowest scan.
+    The fields of the documents of the same type, for example the two sides of an identity card, are merged in the
+    order of the documents.
+    """
 
-from fastapi import APIRouter
+    scanned_pairs = await asyncio.gather(*(scan_uploaded_document(document) for _, document in documents))
 
-endpoint = os.environ["AZURE_FORM_RECOGNIZER_ENDPOINT"]
-key = os.environ["AZURE_FORM_RECOGNIZER_KEY"]
+    scanned_fields: dict[ScannableDocuments, dict[str, str]] = {}
 
-document_analysis_client = DocumentAnalysisClient(
-    endpoint=endpoint, credential=AzureKeyCredential(key)
-)
+    for (document_type, _), key_value_pairs in zip(documents, scanned_pairs):
+        scanned_fields.setdefault(document_type, {}).update(get_scanned_fields(key_value_pairs))
 
+    return scanned_fields
@@ -0,0 +1,237 @@
+"""
+Reads the uploaded documents for the scans.
+
+The routes receiving documents use DocumentUploadRoute, which refuses a request as soon as its body is larger than
+the documents it can have, by its Content-Length or by the bytes received so far, before the body is parsed.
+Starlette keeps the uploads over 1 MB in a temporary file, so they are read from it only when they are needed:
+the SHA-256 of the document is computed from the file one chunk at a time, and a photo is decoded from the file and
+made smaller before it's sent to Form Recognizer. A phone photo is usually much larger than what Form Recognizer
+needs to read a card, so it's turned the right way by its EXIF orientation, downscaled to at most
+DOCUMENT_IMAGE_MAX_SIDE pixels and encoded again as JPEG, which makes the upload and the analysis faster.
+Both run in worker threads, Pillow doesn't hold the GIL while it decodes and resizes the images.
+"""
+import hashlib
+import io
+import os
+from typing import Any, BinaryIO, Callable, Coroutine
+
+from PIL import ExifTags, Image, ImageOps, UnidentifiedImageError
+from pydantic.fields import SHAPE_SINGLETON
+from pydantic.utils import lenient_issubclass
+
+from fastapi import HTTPException, Request, Response, UploadFile, status
+from fastapi.routing import APIRoute
+
+from .executors import BoundedExecutor, ExecutorQueueFullError
+from .metrics import register_metrics
+
+DOCUMENT_UPLOAD_MAX_BYTES = int(os.getenv('DOCUMENT_UPLOAD_MAX_BYTES', 32 * 1024 * 1024))
+# The longest side of the images sent to Form Recognizer, enough to read the text of a card or an A4 page
+DOCUMENT_IMAGE_MAX_SIDE = int(os.getenv('DOCUMENT_IMAGE_MAX_SIDE', 2048))
+DOCUMENT_IMAGE_JPEG_QUALITY = int(os.getenv('DOCUMENT_IMAGE_JPEG_QUALITY', 85))
+
+DOCUMENT_READ_CHUNK_BYTES = 1024 * 1024
+# The maximum number of documents scanned by one batch request
+DOCUMENT_SCAN_BATCH_SIZE = 10
+# The room in a request for the rest of the multipart form, like the boundaries and the types of the documents
+DOCUMENT_FORM_OVERHEAD_BYTES = 64 * 1024
+
+document_processing_executor = BoundedExecutor(
+    name='document-processing',
+    max_workers=int(os.getenv('DOCUMENT_PROCESSING_WORKERS', os.cpu_count() or 1)),
+    max_queue=int(os.getenv('DOCUMENT_PROCESSING_MAX_QUEUE', 100)),
+)
+
+document_upload_stats = {
+    "rejected_too_large": 0,
+    "images_processed": 0,
+    "bytes_received": 0,
+    "bytes_sent": 0,
+}
+
+register_metrics('document_processing_executor', document_processing_executor.stats)
+register_metrics('document_uploads', lambda: dict(document_upload_stats))
+
+document_too_large_exception = HTTPException(
+    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+    detail=f"The document can have at most {DOCUMENT_UPLOAD_MAX_BYTES // (1024 * 1024)} MB."
+)
+
+request_too_large_exception = HTTPException(
+    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+    detail=f"The documents can have at most {DOCUMENT_UPLOAD_MAX_BYTES // (1024 * 1024)} MB each."
+)
+
+document_processing_queue_full_exception = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Too many documents are being processed, try again in a few seconds.",
+    headers={"Retry-After": "1"},
+)
+
+
+def get_max_body_bytes(route: APIRoute) -> int | None:
+    """The largest body the route can receive, None if it doesn't receive documents."""
+
+    max_documents = 0
+
+    for field in route.dependant.body_params:
+        if lenient_issubclass(field.type_, UploadFile):
+            max_documents += 1 if field.shape == SHAPE_SINGLETON else DOCUMENT_SCAN_BATCH_SIZE
+
+    if not max_documents:
+        return None
+
+    return max_documents * DOCUMENT_UPLOAD_MAX_BYTES + DOCUMENT_FORM_OVERHEAD_BYTES
+
+
+class DocumentUploadRoute(APIRoute):
+    """
+    Limits the size of the body of the routes with UploadFile parameters, the other routes of the router are left as
+    they are. A request can't send a body larger than the documents it can have, and isn't spooled to the disk first.
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handle = super().get_route_handler()
+        max_body_bytes = get_max_body_bytes(self)
+
+        if max_body_bytes is None:
+            return handle
+
+        async def handle_limited(request: Request) -> Response:
+            content_length = request.headers.get('content-length', '')
+
+            if content_length.isdigit() and int(content_length) > max_body_bytes:
+                document_upload_stats["rejected_too_large"] += 1
+                raise request_too_large_exception
+
+            received_bytes = 0
+
+            # Without a Content-Length, or with a wrong one, the body is counted while it's parsed
+            async def receive_limited():
+                nonlocal received_bytes
+
+                message = await request.receive()
+
+                if message['type'] == 'http.request':
+                    received_bytes += len(message.get('body', b''))
+
+                    if received_bytes > max_body_bytes:
+                        document_upload_stats["rejected_too_large"] += 1
+                        raise request_too_large_exception
+
+                return message
+
+            return await handle(Request(request.scope, receive_limited))
+
+        return handle_limited
+
+
+def check_document_size(document: UploadFile) -> None:
+    """
+    :raises HTTPException if the document is over DOCUMENT_UPLOAD_MAX_BYTES.
+    """
+
+    if document.size is not None and document.size > DOCUMENT_UPLOAD_MAX_BYTES:
+        document_upload_stats["rejected_too_large"] += 1
+        raise document_too_large_exception
+
+
+def hash_document_file(file: BinaryIO) -> str:
+    """Runs in the worker threads."""
+
+    file.seek(0)
+    sha256 = hashlib.sha256()
+
+    while chunk := file.read(DOCUMENT_READ_CHUNK_BYTES):
+        sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def read_document_file(file: BinaryIO) -> bytes:
+    """
+    Runs in the worker threads.
+
+    :return: The image turned and downscaled as JPEG, or the document as it is if it's not an image Pillow can
+    decode, like a PDF, or if it's already a JPEG that doesn't need to be changed.
+    """
+
+    file.seek(0)
+
+    try:
+        image = Image.open(file)
+    except (UnidentifiedImageError, Image.DecompressionBombError):
+        file.seek(0)
+        return file.read()
+
+    with image:
+        # The pages after the first one of the TIFF files would be lost
+        if getattr(image, 'n_frames', 1) > 1:
+            file.seek(0)
+            return file.read()
+
+        try:
+            orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+            needs_downscale = max(image.size) > DOCUMENT_IMAGE_MAX_SIDE
+
+            if image.format == 'JPEG' and orientation == 1 and not needs_downscale:
+                file.seek(0)
+                return file.read()
+
+            # Decodes a JPEG directly at a smaller scale, which is much faster than decoding it whole and resizing it
+            image.draft('RGB', (DOCUMENT_IMAGE_MAX_SIDE, DOCUMENT_IMAGE_MAX_SIDE))
+
+            processed = ImageOps.exif_transpose(image)
+            processed.thumbnail((DOCUMENT_IMAGE_MAX_SIDE, DOCUMENT_IMAGE_MAX_SIDE), Image.Resampling.LANCZOS)
+
+            if processed.mode not in ('RGB', 'L'):
+                processed = processed.convert('RGB')
+
+            buffer = io.BytesIO()
+            processed.save(buffer, format='JPEG', quality=DOCUMENT_IMAGE_JPEG_QUALITY, optimize=True)
+        except OSError:
+            # A truncated or damaged image, Form Recognizer may still read some of it
+            file.seek(0)
+            return file.read()
+
+    document_upload_stats["images_processed"] += 1
+
+    return buffer.getvalue()
+
+
+async def hash_document(document: UploadFile) -> str:
+    """
+    :raises HTTPException if the document is too large or too many documents are waiting to be processed.
+    """
+
+    check_document_size(document)
+
+    try:
+        return await document_processing_executor.run(hash_document_file, document.file)
+    except ExecutorQueueFullError:
+        raise document_processing_queue_full_exception
+
+
+async def read_document(document: UploadFile) -> bytes:
+    """
+    Returns the document as it should be sent to Form Recognizer.
+
+    :raises HTTPException if the document is too large or too many documents are waiting to be processed.
+    """
+
+    check_document_size(document)
+
+    try:
+        document_content = await document_processing_executor.run(read_document_file, document.file)
+    except ExecutorQueueFullError:
+        raise document_processing_queue_full_exception
+
+    # Without the size from the upload, it's checked after reading the document
+    if len(document_content) > DOCUMENT_UPLOAD_MAX_BYTES:
+        document_upload_stats["rejected_too_large"] += 1
+        raise document_too_large_exception
+
+    document_upload_stats["bytes_received"] += document.size or 0
+    document_upload_stats["bytes_sent"] += len(document_content)
+
+    return document_content
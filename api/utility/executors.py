@@ -0,0 +1,95 @@
+import asyncio
+import concurrent.futures
+import functools
+from typing import Any, Callable
+
+
+class ExecutorQueueFullError(Exception):
+    """Raised when too many calls are already waiting for a worker."""
+
+
+class BoundedExecutor:
+    """
+    Runs blocking or CPU heavy functions in a thread or process pool, so they don't block the event loop.
+
+    At most max_workers calls run at the same time and at most max_queue wait for a free worker,
+    after that new calls are rejected instead of making every caller wait longer.
+    The pool is created on the first call, so importing the app doesn't start any workers.
+    For the process pool, the function and its arguments must be picklable (functions defined at module level).
+    """
+
+    def __init__(self, name: str, kind: str = 'thread', max_workers: int = 4, max_queue: int = 64):
+        if kind not in ('thread', 'process'):
+            raise ValueError(f"Unknown executor kind '{kind}', expected 'thread' or 'process'.")
+
+        self.name = name
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+
+        # Calls that were submitted and didn't finish yet, the ones over max_workers are waiting in the queue
+        self.pending = 0
+        # The calls that returned, and the ones that raised an exception
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+        self._pool: concurrent.futures.Executor | None = None
+
+    @property
+    def pool(self) -> concurrent.futures.Executor:
+        if self._pool is None:
+            if self.kind == 'process':
+                self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                                   thread_name_prefix=self.name)
+
+        return self._pool
+
+    @property
+    def queue_depth(self) -> int:
+        return max(self.pending - self.max_workers, 0)
+
+    async def run(self, function: Callable, *args, **kwargs) -> Any:
+        """
+        Runs the function in the pool and waits for the result.
+
+        :raises ExecutorQueueFullError if max_queue calls are already waiting.
+        """
+
+        if self.pending >= self.max_workers + self.max_queue:
+            self.rejected += 1
+            raise ExecutorQueueFullError(f"The '{self.name}' executor has {self.queue_depth} calls waiting.")
+
+        self.pending += 1
+
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self.pool, functools.partial(function, *args, **kwargs))
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+
+        self.completed += 1
+
+        return result
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "running": min(self.pending, self.max_workers),
+            "queue_depth": self.queue_depth,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
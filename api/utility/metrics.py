@@ -0,0 +1,14 @@
+from typing import Callable
+
+# name -> function returning the current counters of a cache, executor, background task, etc.
+_metrics_sources: dict[str, Callable[[], dict]] = {}
+
+
+def register_metrics(name: str, source: Callable[[], dict]) -> None:
+    """Adds the counters returned by 'source' to the metrics endpoint, under 'name'."""
+
+    _metrics_sources[name] = source
+
+
+def collect_metrics() -> dict:
+    return {name: source() for name, source in _metrics_sources.items()}
@@ -0,0 +1,17 @@
+from fastapi import APIRouter, Depends
+
+from .metrics import collect_metrics
+from ..users.models import User
+from ..authentication.encryption import get_current_user
+
+router = APIRouter(
+    prefix="/api/v1/metrics"
+)
+
+
+@router.get(path="/",
+            tags=['metrics'],
+            description="The counters of the caches, worker pools and background tasks of this worker."
+                        " Only for the logged-in users.")
+async def get_metrics(current_user: User = Depends(get_current_user)) -> dict:
+    return collect_metrics()
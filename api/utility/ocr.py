@@ -0,0 +1,226 @@
+"""
+Selects what reads the scanned documents.
+
+The backend is chosen with the OCR_BACKEND environment variable:
+    * 'azure' (default) - Azure Form Recognizer, at AZURE_FORM_RECOGNIZER_ENDPOINT with AZURE_FORM_RECOGNIZER_KEY
+    * 'recorded' - replays the results recorded in OCR_RECORDINGS_PATH after a configurable latency, without any
+      network, to run and load test the scans on a computer that isn't connected to Azure
+
+With the 'azure' backend and OCR_RECORD_PATH set, the results are also appended to that file, in the format read
+by the 'recorded' backend. They contain the personal data of the documents, so only record test documents.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+from abc import ABC, abstractmethod
+
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ServiceRequestError
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient
+from fastapi.concurrency import run_in_threadpool
+
+OCR_BACKEND = os.getenv('OCR_BACKEND', 'azure')
+OCR_RECORD_PATH = os.getenv('OCR_RECORD_PATH')
+OCR_RECORDINGS_PATH = os.getenv('OCR_RECORDINGS_PATH', './api/utility/ocr_recordings.jsonl')
+# The time the 'recorded' backend takes for a document, uniformly between the latency minus and plus the jitter
+OCR_LATENCY_SECONDS = float(os.getenv('OCR_LATENCY_SECONDS', 2.0))
+OCR_LATENCY_JITTER_SECONDS = float(os.getenv('OCR_LATENCY_JITTER_SECONDS', 0.5))
+# The part of the documents the 'recorded' backend answers as throttled, to test the retries
+OCR_THROTTLE_RATE = float(os.getenv('OCR_THROTTLE_RATE', 0.0))
+
+valid_ocr_backends = {'azure', 'recorded'}
+
+# The recordings are appended from the worker threads, one line at a time
+_record_lock = threading.Lock()
+
+
+class OcrError(Exception):
+    """Raised when the backend couldn't read the document."""
+
+
+class OcrThrottledError(OcrError):
+    """Raised when the backend is receiving too many documents, the document can be sent again later."""
+
+    def __init__(self, retry_after_seconds: float | None = None):
+        super().__init__("Too many documents are being scanned.")
+        self.retry_after_seconds = retry_after_seconds
+
+
+class OcrUnavailableError(OcrError):
+    """Raised when the backend can't be reached, the document can be sent again later."""
+
+
+class OcrBackend(ABC):
+
+    @abstractmethod
+    async def analyze(self, document_content: bytes, model_id: str) -> list[tuple[str, str]]:
+        """
+        Returns the (key, value) pairs found in the document.
+
+        :raises OcrThrottledError if the document should be sent again later.
+        :raises OcrUnavailableError if the backend can't be reached.
+        :raises OcrError if the document couldn't be read.
+        """
+
+    async def close(self):
+        pass
+
+
+class AzureOcrBackend(OcrBackend):
+
+    def __init__(self, record_path: str | None = OCR_RECORD_PATH):
+        self.record_path = record_path
+
+        self._client: DocumentAnalysisClient | None = None
+
+    @property
+    def client(self) -> DocumentAnalysisClient:
+        # Made on the first scan, so the app can start without the Form Recognizer settings
+        if self._client is None:
+            try:
+                endpoint = os.environ["AZURE_FORM_RECOGNIZER_ENDPOINT"]
+                key = os.environ["AZURE_FORM_RECOGNIZER_KEY"]
+            except KeyError as e:
+                raise OcrError(f"The {e.args[0]} environment variable is not set.")
+
+            # The throttled requests are tried again by the scans, which wait while holding their place in the
+            # semaphore, so the client itself doesn't retry them
+            self._client = DocumentAnalysisClient(endpoint=endpoint, credential=AzureKeyCredential(key),
+                                                  retry_status=0)
+
+        return self._client
+
+    async def analyze(self, document_content: bytes, model_id: str) -> list[tuple[str, str]]:
+        try:
+            poller = await self.client.begin_analyze_document(model_id, document=document_content)
+            result = await poller.result()
+        except HttpResponseError as e:
+            if e.status_code == 429:
+                raise OcrThrottledError(get_retry_after_seconds(e))
+
+            raise OcrError(e.message)
+        except ServiceRequestError as e:
+            # The connection failed, the request didn't reach Form Recognizer
+            raise OcrUnavailableError(str(e))
+
+        key_value_pairs = [(kv_pair.key.content, kv_pair.value.content)
+                           for kv_pair in result.key_value_pairs
+                           if kv_pair.key and kv_pair.value and kv_pair.key.content and kv_pair.value.content]
+
+        if self.record_path:
+            await run_in_threadpool(record_ocr_result, self.record_path, document_content, model_id, key_value_pairs)
+
+        return key_value_pairs
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+class RecordedOcrBackend(OcrBackend):
+    """
+    Answers with the recorded result of the same document if there is one, otherwise with the recorded results of
+    the model in turn, so any document can be scanned.
+    """
+
+    def __init__(self, recordings_path: str = OCR_RECORDINGS_PATH, latency_seconds: float = OCR_LATENCY_SECONDS,
+                 latency_jitter_seconds: float = OCR_LATENCY_JITTER_SECONDS, throttle_rate: float = OCR_THROTTLE_RATE):
+        self.latency_seconds = latency_seconds
+        self.latency_jitter_seconds = latency_jitter_seconds
+        self.throttle_rate = throttle_rate
+
+        # (SHA-256 of the document, model id) -> key value pairs
+        self.recorded_documents: dict[tuple[str, str], list[tuple[str, str]]] = {}
+        # model id -> the key value pairs of all its recordings
+        self.recorded_models: dict[str, list[list[tuple[str, str]]]] = {}
+        self._next_recording: dict[str, int] = {}
+
+        with open(recordings_path, encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+
+                recording = json.loads(line)
+                key_value_pairs = [(key, value) for key, value in recording['key_value_pairs']]
+
+                if recording.get('sha256'):
+                    self.recorded_documents[(recording['sha256'], recording['model_id'])] = key_value_pairs
+
+                self.recorded_models.setdefault(recording['model_id'], []).append(key_value_pairs)
+
+    async def analyze(self, document_content: bytes, model_id: str) -> list[tuple[str, str]]:
+        latency = self.latency_seconds + random.uniform(-self.latency_jitter_seconds, self.latency_jitter_seconds)
+        await asyncio.sleep(max(latency, 0.0))
+
+        if random.random() < self.throttle_rate:
+            raise OcrThrottledError(retry_after_seconds=1.0)
+
+        key_value_pairs = self.recorded_documents.get((hashlib.sha256(document_content).hexdigest(), model_id))
+
+        if key_value_pairs is not None:
+            return key_value_pairs
+
+        recordings = self.recorded_models.get(model_id)
+
+        if not recordings:
+            raise OcrError(f"There are no recorded results for the model '{model_id}'.")
+
+        index = self._next_recording.get(model_id, 0)
+        self._next_recording[model_id] = (index + 1) % len(recordings)
+
+        return recordings[index]
+
+
+def get_retry_after_seconds(error: HttpResponseError) -> float | None:
+    retry_after = error.response.headers.get('Retry-After') if error.response is not None else None
+
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+
+def record_ocr_result(record_path: str, document_content: bytes, model_id: str,
+                      key_value_pairs: list[tuple[str, str]]) -> None:
+    """Runs in the worker threads."""
+
+    recording = dict(sha256=hashlib.sha256(document_content).hexdigest(), model_id=model_id,
+                     key_value_pairs=key_value_pairs)
+
+    with _record_lock, open(record_path, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(recording, ensure_ascii=False) + '\n')
+
+
+class Ocr:
+    """
+    Holds the selected backend.
+    The modules import the 'ocr' object once, so switching the backend with 'use' is seen everywhere.
+    """
+
+    backend: OcrBackend
+
+    def __init__(self, backend: str):
+        self.backend_name = ''
+        self.use(backend)
+
+    def use(self, backend: str, **options):
+        if backend not in valid_ocr_backends:
+            raise ValueError(f"Unknown OCR backend '{backend}', expected one of {valid_ocr_backends}.")
+
+        self.backend_name = backend
+        self.backend = AzureOcrBackend(**options) if backend == 'azure' else RecordedOcrBackend(**options)
+
+    async def analyze(self, document_content: bytes, model_id: str) -> list[tuple[str, str]]:
+        return await self.backend.analyze(document_content, model_id)
+
+    async def close(self):
+        """Called when the app shuts down."""
+
+        await self.backend.close()
+
+
+ocr = Ocr(OCR_BACKEND)
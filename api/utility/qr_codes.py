@@ -0,0 +1,133 @@
+"""
+Makes the QR code images.
+
+The images are made in memory by a worker thread, so the event loop isn't blocked, and cached by the encoded string
+and the options, so the QR code of the same link, for example the one of a form, is made only once.
+The same string and options always give the same image, so it can be cached by the browsers too.
+"""
+import hashlib
+import io
+import os
+from enum import Enum
+from importlib.metadata import version
+
+import qrcode
+import qrcode.image.svg
+
+from fastapi import HTTPException, status
+
+from .cache import TTLCache, SingleFlight
+from .executors import BoundedExecutor, ExecutorQueueFullError
+from .metrics import register_metrics
+
+QR_CODE_CACHE_SIZE = int(os.getenv('QR_CODE_CACHE_SIZE', 1000))
+QR_CODE_CACHE_TTL_SECONDS = float(os.getenv('QR_CODE_CACHE_TTL_SECONDS', 24 * 60 * 60))
+# How long the browsers keep a QR code, it never changes
+QR_CODE_MAX_AGE_SECONDS = 365 * 24 * 60 * 60
+
+# Part of the ETag, a new version of qrcode may make different images
+QRCODE_VERSION = version('qrcode')
+
+
+class QrCodeFormat(str, Enum):
+    png = "png"
+    svg = "svg"
+
+
+class QrCodeErrorCorrection(str, Enum):
+    # The percent of the QR code that can be damaged and still be read
+    L = "L"  # 7%
+    M = "M"  # 15%
+    Q = "Q"  # 25%
+    H = "H"  # 30%
+
+
+qr_code_error_corrections = {
+    QrCodeErrorCorrection.L: qrcode.constants.ERROR_CORRECT_L,
+    QrCodeErrorCorrection.M: qrcode.constants.ERROR_CORRECT_M,
+    QrCodeErrorCorrection.Q: qrcode.constants.ERROR_CORRECT_Q,
+    QrCodeErrorCorrection.H: qrcode.constants.ERROR_CORRECT_H,
+}
+
+qr_code_media_types = {
+    QrCodeFormat.png: "image/png",
+    QrCodeFormat.svg: "image/svg+xml",
+}
+
+qr_code_executor = BoundedExecutor(
+    name='qr-codes',
+    max_workers=int(os.getenv('QR_CODE_WORKERS', 2)),
+    max_queue=int(os.getenv('QR_CODE_MAX_QUEUE', 100)),
+)
+
+# (string, size, error correction, format) -> the bytes of the image
+qr_code_cache = TTLCache(max_size=QR_CODE_CACHE_SIZE, ttl_seconds=QR_CODE_CACHE_TTL_SECONDS)
+qr_code_generations = SingleFlight()
+
+register_metrics('qr_code_executor', qr_code_executor.stats)
+register_metrics('qr_code_cache', qr_code_cache.stats)
+register_metrics('qr_code_generations', qr_code_generations.stats)
+
+qr_code_queue_full_exception = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Too many QR codes are being generated, try again in a few seconds.",
+    headers={"Retry-After": "1"},
+)
+
+
+def make_qr_code(string_to_encode: str, size: int, error_correction: QrCodeErrorCorrection,
+                 image_format: QrCodeFormat) -> bytes:
+    """Runs in the worker threads."""
+
+    qr_code = qrcode.QRCode(box_size=size, error_correction=qr_code_error_corrections[error_correction])
+    qr_code.add_data(string_to_encode)
+
+    image_factory = qrcode.image.svg.SvgPathImage if image_format == QrCodeFormat.svg else None
+    image = qr_code.make_image(image_factory=image_factory)
+
+    buffer = io.BytesIO()
+    image.save(buffer)
+
+    return buffer.getvalue()
+
+
+def get_qr_code_etag(string_to_encode: str, size: int, error_correction: QrCodeErrorCorrection,
+                     image_format: QrCodeFormat) -> str:
+    """
+    The ETag header of the image. It's known without making the image, since the image only depends on the options
+    and on the version of qrcode.
+    """
+
+    options = f"{QRCODE_VERSION}:{size}:{error_correction.value}:{image_format.value}:{string_to_encode}"
+
+    return '"' + hashlib.sha256(options.encode()).hexdigest()[:32] + '"'
+
+
+async def get_qr_code_bytes(string_to_encode: str, size: int, error_correction: QrCodeErrorCorrection,
+                            image_format: QrCodeFormat) -> bytes:
+    """
+    Returns the image of the QR code, from the cache or made in a worker thread.
+    The concurrent requests for the same QR code wait for the same image.
+
+    :raises HTTPException if too many QR codes are waiting to be made.
+    """
+
+    key = (string_to_encode, size, error_correction, image_format)
+
+    image_bytes = qr_code_cache.get(key)
+
+    if image_bytes is not None:
+        return image_bytes
+
+    async def make():
+        try:
+            made_bytes = await qr_code_executor.run(make_qr_code, string_to_encode, size, error_correction,
+                                                    image_format)
+        except ExecutorQueueFullError:
+            raise qr_code_queue_full_exception
+
+        qr_code_cache.set(key, made_bytes)
+
+        return made_bytes
+
+    return await qr_code_generations.run(key, make)
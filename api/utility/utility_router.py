@@ -1,16 +1,19 @@
 import asyncio.subprocess
 
-import qrcode
-
-from fastapi import APIRouter, Response, Depends, HTTPException, status, File, UploadFile
+from fastapi import APIRouter, Response, Depends, Header, HTTPException, Query, status, File, Form, UploadFile
 
 from ..users.models import User
 from ..authentication.encryption import get_current_user
+from ..forms.models import ScannableDocuments
 
-from .document_recognizer import document_analysis_client
+from .document_recognizer import DOCUMENT_SCAN_BATCH_SIZE, get_scanned_fields, scan_documents, scan_uploaded_document
+from .document_uploads import DocumentUploadRoute
+from .qr_codes import QrCodeFormat, QrCodeErrorCorrection, QR_CODE_MAX_AGE_SECONDS, qr_code_media_types, \
+    get_qr_code_bytes, get_qr_code_etag
 
 router = APIRouter(
-    prefix="/api/v1/users/{user_id}/utility"
+    prefix="/api/v1/users/{user_id}/utility",
+    route_class=DocumentUploadRoute
 )
 
 
@@ -19,6 +22,16 @@ router = APIRouter(
 async def get_form_qr_code(
         user_id: str,
         string_to_encode: str,
+        size: int = Query(default=10, ge=1, le=40,
+                          description="The size in pixels of every square of the QR code."),
+        error_correction: QrCodeErrorCorrection = Query(default=QrCodeErrorCorrection.M,
+                                                        description="How much of the QR code can be damaged and still"
+                                                                    " be read, L is 7%, M 15%, Q 25% and H 30%."),
+        image_format: QrCodeFormat = Query(default=QrCodeFormat.png, alias="format",
+                                           description="The format of the image."),
+        if_none_match: str | None = Header(default=None,
+                                           description="The 'ETag' of a QR code downloaded before, if it's the same"
+                                                       " the response is 304 without a body."),
         current_user: User = Depends(get_current_user),
 ):
 
@@ -26,16 +39,21 @@ async def get_form_qr_code(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail="User ID from path doesnt match your user id.")
 
-    # Converts the link in a qr code and saves the image
-    img = qrcode.make(string_to_encode)
-    img.save("./api/utility/qr_code.png")
+    # The same string and options always give the same image, so the browser doesn't have to ask again
+    headers = {
+        'ETag': get_qr_code_etag(string_to_encode, size, error_correction, image_format),
+        'Cache-Control': f'private, max-age={QR_CODE_MAX_AGE_SECONDS}, immutable',
+    }
+
+    if if_none_match == headers['ETag']:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # Converts the link in a qr code, in memory
+    image_bytes = await get_qr_code_bytes(string_to_encode, size, error_correction, image_format)
 
-    # Opens the image in byte format, since that's what we can send
-    with open("./api/utility/qr_code.png", "rb") as file:
-        return Response(content=file.read(), media_type="image/png")
+    return Response(content=image_bytes, media_type=qr_code_media_types[image_format], headers=headers)
 
 
-# This endpoint function is not declared as async so it runs in another thread
 @router.post(path="scan_document/",
             tags=['utility'])
 async def scan_document(
@@ -48,31 +66,33 @@ async def scan_document(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail="User ID from path doesnt match your user id.")
 
-    document_content = await document.read()
+    key_value_pairs = await scan_uploaded_document(document)
 
-    poller = document_analysis_client.begin_analyze_document(
-            "prebuilt-document", document=document_content
-        )
+    return get_scanned_fields(key_value_pairs)
 
-    result = poller.result()
 
-    api_result = {}
-
-    for kv_pair in result.key_value_pairs:
-        key = kv_pair.key
-        value = kv_pair.value
+@router.post(path="scan_documents/",
+             tags=['utility'],
+             description="Scans the documents of all the sections of a form at the same time. Send every document with"
+                         " its type, in the same order. The fields found are returned by the type of the document,"
+                         " the ones of the documents of the same type are merged.")
+async def scan_documents_batch(
+        user_id: str,
+        documents: list[UploadFile] = File(description=f"At most {DOCUMENT_SCAN_BATCH_SIZE} documents."),
+        document_types: list[ScannableDocuments] = Form(description="The type of every document, in the same order."),
+        current_user: User = Depends(get_current_user),
+) -> dict[ScannableDocuments, dict[str, str]]:
 
-        if key and value and key.content and value.content:
-            if '/' in key.content:
-                key_splits = key.content.split('/')
-            else:
-                key_splits = key.content.split()
+    if user_id != current_user.id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="User ID from path doesnt match your user id.")
 
-            if 'Loc nastere' in key.content:
-                clean_key = 'loc nastere'
-            else:
-                clean_key = key_splits[0]
+    if len(documents) != len(document_types):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"Got {len(documents)} documents and {len(document_types)} document types.")
 
-            api_result[clean_key] = value.content
+    if len(documents) > DOCUMENT_SCAN_BATCH_SIZE:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"At most {DOCUMENT_SCAN_BATCH_SIZE} documents can be scanned at once.")
 
-    return api_result
+    return await scan_documents(list(zip(document_types, documents)))
@@ -0,0 +1,33 @@
+"""
+Creates the email and account name lookup items for the users that were created before the lookups existed.
+It's safe to run more than once.
+
+Usage: python -m background_tasks.backfill_user_lookups
+"""
+import asyncio
+
+from api.database.storage import storage
+from api.users.functions import get_lookup_id
+
+
+async def backfill_user_lookups():
+    await storage.connect()
+
+    try:
+        users = await storage.users.list_all()
+
+        for i, user in enumerate(users, start=1):
+            for field in ('email', 'name'):
+                if user.get(field):
+                    await storage.user_lookups.upsert(
+                        dict(id=get_lookup_id(field, user[field]), user_id=user['id'], field=field)
+                    )
+
+            if i % 100 == 0 or i == len(users):
+                print(f"Backfilled the lookups of {i}/{len(users)} users.")
+    finally:
+        await storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(backfill_user_lookups())
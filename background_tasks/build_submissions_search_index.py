@@ -0,0 +1,48 @@
+"""
+Adds the submissions that were created before the search index existed to the index.
+It's safe to run more than once, the index items of the submissions are replaced.
+
+Usage: python -m background_tasks.build_submissions_search_index
+"""
+import asyncio
+
+from api.database.exceptions import ItemNotFoundError
+from api.database.storage import storage
+from api.forms.models import FormularInDB
+from api.form_submissions.search_index import index_submission
+
+
+async def build_submissions_search_index():
+    await storage.connect()
+
+    try:
+        submissions = await storage.submissions.list_expiration_times()
+
+        # The forms are read once, most forms have many submissions
+        forms: dict[str, FormularInDB | None] = {}
+
+        for i, item in enumerate(submissions, start=1):
+            form_id = item['form_id']
+
+            try:
+                submission = await storage.submissions.get(item['id'], form_id)
+            except ItemNotFoundError:
+                continue
+
+            if form_id not in forms:
+                try:
+                    forms[form_id] = FormularInDB(**await storage.forms.get(form_id))
+                except ItemNotFoundError:
+                    forms[form_id] = None
+
+            if forms[form_id] is not None:
+                await index_submission(forms[form_id], submission)
+
+            if i % 100 == 0 or i == len(submissions):
+                print(f"Indexed {i}/{len(submissions)} submissions.")
+    finally:
+        await storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(build_submissions_search_index())
@@ -1,34 +1,78 @@
 import asyncio
+import os
 import time
 
-from api.database.cosmo_db import form_submits_container
+from api.database.repositories import RequestChargeCounter
+from api.database.storage import storage
+from api.form_submissions.functions import delete_submission_with_retries
+from api.jobs.runner import job_runner
+from api.utility.metrics import register_metrics
 
-SECONDS_IN_ONE_DAY = 24 * 60 * 60
+# With Cosmos, the submissions are deleted by their ttl and the sweep only finds the few it didn't delete yet,
+# so it can run often
+EXPIRY_SWEEP_INTERVAL_SECONDS = int(os.getenv('EXPIRY_SWEEP_INTERVAL_SECONDS', 5 * 60))
+EXPIRY_SWEEP_BATCH_SIZE = int(os.getenv('EXPIRY_SWEEP_BATCH_SIZE', 100))
+# How many deletes are sent at the same time, so the sweep doesn't use all the request units
+EXPIRY_SWEEP_CONCURRENCY = int(os.getenv('EXPIRY_SWEEP_CONCURRENCY', 5))
 
+expiry_stats = {
+    "sweeps": 0,
+    "expired_submissions": 0,
+    "request_charge": 0.0,
+    "last_sweep_seconds": 0.0,
+    "last_sweep_time": None,
+}
 
-async def delete_expired_form_submissions():
+register_metrics('submissions_expiry', lambda: dict(expiry_stats))
+
+
+async def delete_expired_submission(item: dict, semaphore: asyncio.Semaphore) -> bool:
+    async with semaphore:
+        # A throttled delete waits and is tried again. A submission deleted by its ttl or by the owner since it was
+        # found is False.
+        return await delete_submission_with_retries(item['id'], item['form_id'])
+
+
+async def sweep_expired_form_submissions() -> int:
     """
-    Background task that runs daily, to delete submissions that are past the data retention period.
+    Deletes the submissions that are past the data retention period, one batch at a time.
+    Only the expired submissions are read, so a sweep costs little when there is nothing to delete.
+
+    :return: How many submissions were deleted
     """
 
-    query = """SELECT form.id, form.submission_expiration_time FROM c form"""
+    start_time = time.monotonic()
+
+    semaphore = asyncio.Semaphore(EXPIRY_SWEEP_CONCURRENCY)
+    expired_before = int(time.time())
+    deleted = 0
+
+    # Only the request units of the sweep, not the ones of the API requests made at the same time
+    with RequestChargeCounter() as request_charge:
+        while True:
+            # The deleted submissions aren't found again, so the next batch is always the first one
+            items = await storage.submissions.list_expired(expired_before, EXPIRY_SWEEP_BATCH_SIZE)
+
+            results = await asyncio.gather(*(delete_expired_submission(item, semaphore) for item in items))
+            deleted += sum(results)
+
+            # Stops if a batch was already deleted by someone else too, instead of finding it again
+            if len(items) < EXPIRY_SWEEP_BATCH_SIZE or not any(results):
+                break
+
+    expiry_stats["sweeps"] += 1
+    expiry_stats["expired_submissions"] += deleted
+    expiry_stats["request_charge"] += request_charge.total
+    expiry_stats["last_sweep_seconds"] = time.monotonic() - start_time
+    expiry_stats["last_sweep_time"] = int(time.time())
 
-    while True:
-        # Fetch all the submissions from the database
-        results = form_submits_container.query_items(query=query,
-                                                     enable_cross_partition_query=True)
+    return deleted
 
-        items = list(results)
 
-        # Get the current time
-        current_time = int(time.time())
+@job_runner.job('expire_submissions')
+async def expire_submissions(params: dict, progress: dict) -> dict:
+    return dict(deleted=await sweep_expired_form_submissions())
 
-        # Delete all the expired submissions
-        for item in items:
-            if item['submission_expiration_time'] <= current_time:
-                form_submits_container.delete_item(
-                    item=item['id'],
-                    partition_key=item['id']
-                )
 
-        await asyncio.sleep(SECONDS_IN_ONE_DAY)
+# With several servers, every one of them starts a sweep, the sweeps skip the submissions already deleted
+job_runner.every('expire_submissions', EXPIRY_SWEEP_INTERVAL_SECONDS, max_attempts=1)
@@ -0,0 +1,101 @@
+"""
+Moves the submissions from the legacy container, partitioned by id, to the container partitioned by form_id.
+
+The submissions are moved in batches: every submission is created in the new container, then deleted from the
+legacy one. The API keeps working during the migration, with READ_LEGACY_SUBMISSIONS=true it reads the submissions
+that weren't moved yet from the legacy container.
+It can be stopped and started again at any time, it continues with the submissions left in the legacy container.
+When it's done, set READ_LEGACY_SUBMISSIONS=false.
+
+Usage: python -m background_tasks.migrate_submissions_to_form_partitions [--batch-size 100]
+"""
+import argparse
+import asyncio
+import time
+
+import azure.cosmos.exceptions
+from azure.core import MatchConditions
+
+from api.database import cosmo_db
+from api.database.exceptions import ItemAlreadyExistsError, ItemNotFoundError
+
+# The properties set by Cosmos, they can't be written
+system_properties = ('_rid', '_self', '_etag', '_attachments', '_ts')
+
+
+async def move_submission(submission: dict, legacy: cosmo_db.CosmosRepository,
+                          submissions: cosmo_db.CosmosFormPartitionedRepository) -> bool:
+    """
+    Moves one submission. Returns False if the API changed or deleted it while it was moved,
+    in that case the version written by the API is kept.
+    """
+
+    # The ttl is set on every write of a submission, so the moved ones are deleted by Cosmos when they expire too
+    submission = cosmo_db.with_expiration_ttl({key: value for key, value in submission.items()
+                                               if key not in system_properties})
+
+    try:
+        created = await submissions.create(submission)
+    except ItemAlreadyExistsError:
+        # The API updated it during the migration, the new container has the latest version
+        created = None
+
+    try:
+        await legacy.delete(submission['id'])
+    except ItemNotFoundError:
+        # The API deleted it during the migration. The copy is removed, unless the API wrote it after the copy.
+        if created is not None:
+            try:
+                await submissions.container.delete_item(item=submission['id'], partition_key=submission['form_id'],
+                                                        etag=created['_etag'],
+                                                        match_condition=MatchConditions.IfNotModified)
+            except (azure.cosmos.exceptions.CosmosResourceNotFoundError,
+                    azure.cosmos.exceptions.CosmosAccessConditionFailedError):
+                pass
+
+        return False
+
+    return created is not None
+
+
+async def migrate_submissions(batch_size: int):
+    await cosmo_db.create_database_and_containers()
+
+    legacy = cosmo_db.CosmosRepository(cosmo_db.LEGACY_SUBMITTED_FORMS_CONTAINER_NAME)
+    submissions = cosmo_db.CosmosFormPartitionedRepository(cosmo_db.SUBMITTED_FORMS_CONTAINER_NAME)
+
+    try:
+        total = (await legacy.query("SELECT VALUE COUNT(1) FROM c"))[0]
+        moved = skipped = 0
+        start_time = time.monotonic()
+
+        print(f"{total} submissions to move.")
+
+        while True:
+            # The moved submissions are deleted from the legacy container, so the first page is always the next batch
+            page = await legacy.query_page("SELECT * FROM c", None, batch_size)
+
+            if not page.items:
+                break
+
+            results = await asyncio.gather(*(move_submission(submission, legacy, submissions)
+                                             for submission in page.items))
+
+            moved += sum(results)
+            skipped += len(results) - sum(results)
+
+            elapsed = time.monotonic() - start_time
+            print(f"Moved {moved}/{total} submissions, {skipped} were changed by the API,"
+                  f" {moved / elapsed:.1f} submissions/s.")
+
+        print("Done, set READ_LEGACY_SUBMISSIONS=false.")
+    finally:
+        await cosmo_db.close_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Moves the submissions to the container partitioned by form_id.")
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help="How many submissions are moved at the same time.")
+
+    asyncio.run(migrate_submissions(parser.parse_args().batch_size))
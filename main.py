@@ -1,5 +1,3 @@
-import asyncio
-
 from fastapi import FastAPI
 from fastapi.responses import RedirectResponse
 import uvicorn
@@ -7,12 +5,21 @@ import uvicorn
 from api.users import user_router
 from api.forms import form_router
 from api.form_submissions import submission_router
-from api.utility import utility_router
+from api.utility import utility_router, metrics_router
+from api.jobs import job_router
+from api.jobs.runner import job_runner
 
-from background_tasks.delete_old_submissions import delete_expired_form_submissions
+# Registers the expiry sweep, which the job runner runs every few minutes
+import background_tasks.delete_old_submissions  # noqa: F401
+from api.database.storage import storage
 
 
 from api.authentication import oath2
+from api.authentication.encryption import password_hashing_executor
+from api.form_submissions.pdf import pdf_rendering_executor
+from api.utility.qr_codes import qr_code_executor
+from api.utility.ocr import ocr
+from api.utility.document_uploads import document_processing_executor
 
 description = """
 The Bizonii backend API. 🐂
@@ -36,16 +43,30 @@ The Bizonii backend API. 🐂
 ## Submissions
 
 * You can **GET** a list of all form submissions.
+* You can **GET** the form submissions that contain some words.
 * You can **POST** to create a new form submission.
+* You can **POST** a document to get the fields of a form completed with the values found in it.
 * You can **GET** all the info about one form submission.
 * You can **PUT** to update a form submission if you are the owner of the form or the one who created the submission.
 * You can **DELETE** a form submission.
-* You can **DELETE** all form submissions for a given form.
+* You can **DELETE** all form submissions for a given form, also in the background and **GET** the progress.
 * You can **GET** a pdf with the completed submission.
+* You can **GET** the pdfs of all the submissions of a form as a ZIP file.
+* You can **GET** all the submissions of a form as a NDJSON or CSV file.
 
 ## Utility
 
-* You can **GET** a QR Code from a string, for example to get a QR Code to the page where you can fill a submission.
+* You can **GET** a QR Code from a string, for example to get a QR Code to the page where you can fill a submission, as PNG or SVG.
+* You can **POST** a document to scan it, or the documents of all the sections of a form to scan them at once.
+
+## Jobs
+
+* You can **GET** the status and progress of a long operation you started, like deleting all the submissions of a form.
+* You can **DELETE** a job to cancel it.
+
+## Metrics
+
+* You can **GET** the counters of the caches and worker pools of the server.
 
 """
 
@@ -66,13 +87,35 @@ app.include_router(form_router.router)
 app.include_router(submission_router.router)
 app.include_router(utility_router.router)
 app.include_router(oath2.router)
+app.include_router(metrics_router.router)
+app.include_router(job_router.router)
 
 
-# Adds a background task to run every day to delete old submissions
 @app.on_event("startup")
-async def schedule_periodic():
-    loop = asyncio.get_event_loop()
-    loop.create_task(delete_expired_form_submissions())
+async def connect_to_database():
+    await storage.connect()
+
+    # Also runs the jobs left unfinished when the server stopped, and the periodic ones like the expiry sweep
+    await job_runner.start()
+
+
+@app.on_event("shutdown")
+async def disconnect_from_database():
+    await job_runner.stop()
+    await storage.close()
+
+
+@app.on_event("shutdown")
+async def stop_executors():
+    password_hashing_executor.shutdown()
+    pdf_rendering_executor.shutdown()
+    qr_code_executor.shutdown()
+    document_processing_executor.shutdown()
+
+
+@app.on_event("shutdown")
+async def close_ocr():
+    await ocr.close()
 
 
 @app.get("/", include_in_schema=False)
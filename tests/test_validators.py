@@ -0,0 +1,30 @@
+import pytest
+
+from api.form_submissions.validators import InvalidValue, coerce_decimal, coerce_number
+
+
+@pytest.mark.parametrize("value", ["nan", "NaN", "inf", "-inf", "infinity", float("nan"), float("inf")])
+def test_coerce_decimal_rejects_non_finite_numbers(value):
+    with pytest.raises(InvalidValue):
+        coerce_decimal(value)
+
+
+@pytest.mark.parametrize("value, expected", [("3.5", 3.5), ("3,5", 3.5), (" -2 ", -2.0), (4, 4.0)])
+def test_coerce_decimal(value, expected):
+    assert coerce_decimal(value) == expected
+
+
+def test_coerce_decimal_rejects_too_large_numbers():
+    with pytest.raises(InvalidValue):
+        coerce_decimal(10 ** 400)
+
+
+@pytest.mark.parametrize("value", ["1_000", "0745123456", "+05", "1.5", "١٢", ""])
+def test_coerce_number_rejects_non_digit_strings(value):
+    with pytest.raises(InvalidValue):
+        coerce_number(value)
+
+
+@pytest.mark.parametrize("value, expected", [("0", 0), (" 42 ", 42), ("-7", -7), ("+7", 7), (12, 12), (3.0, 3)])
+def test_coerce_number(value, expected):
+    assert coerce_number(value) == expected